@@ -3,7 +3,7 @@ from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsetMixin
 from .models import (ProcedureType, Session, Surgery, WaterAdministration, Weighing, WaterType,
                      WaterRestriction)
 from subjects.models import Subject, Project
@@ -129,17 +129,21 @@ class SessionWaterAdminSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'water_type', 'water_administered')
 
 
-class SessionListSerializer(BaseActionSerializer):
+class SessionListSerializer(SparseFieldsetMixin, BaseActionSerializer):
     projects = serializers.SlugRelatedField(read_only=False,
                                             slug_field='name',
                                             queryset=Project.objects.all(),
                                             many=True)
 
-    @staticmethod
-    def setup_eager_loading(queryset):
-        """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related('subject', 'lab')
-        queryset = queryset.prefetch_related('projects', 'procedures')
+    field_loading = {
+        'subject': {'select_related': ('subject',)},
+        'lab': {'select_related': ('lab',)},
+        'projects': {'prefetch_related': ('projects',)},
+    }
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, request=None):
+        queryset = super().setup_eager_loading(queryset, request)
         return queryset.order_by('-start_time')
 
     class Meta:
@@ -1,7 +1,13 @@
 import datetime
+import io
+
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.timezone import now
 
@@ -95,6 +101,47 @@ class APIActionsSessionsTests(APIActionsBaseTests):
         )
         self.assertEqual(len(d), 1)
 
+    def test_sessions_export(self):
+        for number, projects in ((1, [self.projectX, self.projectY]), (2, [])):
+            ses = Session.objects.create(
+                subject=self.subject, lab=self.lab01, number=number,
+                start_time=datetime.datetime(2020, 7, 9, 12), task_protocol=self.test_protocol)
+            ses.projects.set(projects)
+        url = reverse("session-list") + f"?lab={self.lab01.name}"
+        r = self.client.get(url + "&format=arrow")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "application/vnd.apache.arrow.stream")
+        table = pa.ipc.open_stream(b"".join(r.streaming_content)).read_all()
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(
+            table.schema.names,
+            ["lab", "subject", "date", "number", "task_protocol", "projects", "id"])
+        df = table.to_pandas().sort_values("number")
+        self.assertEqual(df["projects"].tolist(), ["projectX,projectY", ""])
+        self.assertEqual(set(df["lab"]), {self.lab01.name})
+        # Filters apply to the export
+        r = self.client.get(url + f"&projects={self.projectY.name}",
+                            HTTP_ACCEPT="application/vnd.apache.parquet")
+        table = pq.read_table(io.BytesIO(b"".join(r.streaming_content)))
+        self.assertEqual(table["number"].to_pylist(), [1])
+
+    def test_sessions_sparse_fieldsets(self):
+        for number, hour in ((1, 12), (2, 14)):
+            ses = Session.objects.create(
+                subject=self.subject, lab=self.lab01, number=number,
+                start_time=datetime.datetime(2020, 7, 9, hour))
+            ses.projects.set([self.projectX])
+        url = reverse("session-list") + f"?lab={self.lab01.name}"
+        with CaptureQueriesContext(connection) as queries:
+            d = self.ar(self.client.get(url + "&fields=number,start_time"))
+        # Still in reverse chronological order, without the projects query
+        self.assertEqual([s["number"] for s in d], [2, 1])
+        self.assertEqual(set(d[0]), {"number", "start_time"})
+        self.assertFalse(any("subjects_project" in q["sql"] for q in queries.captured_queries))
+        d = self.ar(self.client.get(url + "&omit=projects,url"))
+        self.assertEqual(set(d[0]),
+                         {"id", "subject", "start_time", "number", "lab", "task_protocol"})
+
     def test_sessions(self):
         a_dict4json = {
             "String": "this is not a JSON",
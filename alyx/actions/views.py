@@ -17,6 +17,7 @@ from rest_framework.views import APIView
 from one.alf.spec import QC
 
 from alyx.base import base_json_filter, BaseFilterSet, rest_permission_classes
+from alyx.renderers import TableExportMixin
 from data.models import Dataset
 from subjects.models import Subject
 from experiments.views import _filter_qs_with_brain_regions
@@ -345,7 +346,7 @@ class WaterAdministrationFilter(BaseActionFilter):
         model = WaterAdministration
 
 
-class SessionAPIList(generics.ListCreateAPIView):
+class SessionAPIList(TableExportMixin, generics.ListCreateAPIView):
     """
         get: **FILTERS**
 
@@ -387,13 +388,28 @@ class SessionAPIList(generics.ListCreateAPIView):
         `/sessions?django=~projects__name__icontains,matlab`
         does the exclusive set: filters sessions that do not have matlab in the project names
 
+    **EXPORT**: `/sessions?format=parquet` or `/sessions?format=arrow` (or an Accept header of
+    `application/vnd.apache.parquet` or `application/vnd.apache.arrow.stream`) returns all
+    filtered sessions as a ONE cache sessions table, without pagination
+
+    **FIELDS**: `/sessions?fields=id,start_time` returns only these fields and
+    `/sessions?omit=projects` all fields but these
+
     [===> session model reference](/admin/doc/models/actions.session)
     """
     queryset = Session.objects.all()
-    queryset = SessionListSerializer.setup_eager_loading(queryset)
     permission_classes = rest_permission_classes()
 
     filterset_class = SessionFilter
+    export_name = 'sessions'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return SessionListSerializer.setup_eager_loading(queryset, self.request)
+
+    def table_batches(self, queryset, batch_size):
+        from misc.management.commands.one_cache import SESSIONS_SCHEMA, iter_session_batches
+        return SESSIONS_SCHEMA, iter_session_batches(queryset, batch_size)
 
     def get_serializer_class(self):
         if not self.request:
@@ -1,3 +1,4 @@
+import base64
 import json
 import logging
 import os
@@ -11,22 +12,31 @@ from datetime import datetime
 import traceback
 
 from django import forms
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.db import models
+from django.db.models import Q
 from django.db import connection
 from django.conf import settings
 from django.contrib import admin
+from django.core.cache import cache
 from django.core.mail import send_mail
+from django.core.paginator import EmptyPage, Paginator
 from django.core.management import call_command
 from django.template.response import TemplateResponse
 from django.urls import reverse
 from django.utils import termcolors, timezone
+from django.utils.functional import cached_property
 from django.test import TestCase
 from django_filters import CharFilter
 from django_filters import rest_framework as filters
 from rest_framework.views import exception_handler
 from rest_framework import serializers
 from rest_framework import permissions
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from dateutil.parser import parse
 from reversion.admin import VersionAdmin
 from alyx import __version__ as version
@@ -304,6 +314,91 @@ class JsonWidget(forms.Textarea):
         return out
 
 
+def estimate_count(queryset):
+    """
+    Return the PostgreSQL estimate of the number of rows of a queryset, without counting them.
+
+    The row count statistics of the table are used for unfiltered querysets, and the query
+    planner's estimate otherwise.
+
+    :param queryset: A Django queryset
+    :return: The estimated number of rows, or None if the table has never been analyzed
+    """
+    query = queryset.query
+    if not query.where and not query.distinct and query.group_by is None:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            estimate = cursor.fetchone()[0]
+        return int(estimate) if estimate >= 0 else None
+    plan = queryset.order_by().explain(format='json')
+    if not plan:  # The query can't return any rows, e.g. `pk__in=[]`
+        return 0
+    return int(json.loads(plan)[0]['Plan']['Plan Rows'])
+
+
+def count_queryset(queryset, threshold=None):
+    """
+    Count the rows of a queryset, or estimate them if there are many.
+
+    Exact counts of large tables, often joined by the filters, take seconds.  Result sets whose
+    estimated size is below the threshold are counted exactly.
+
+    :param queryset: A Django queryset
+    :param threshold: The estimated number of rows from which the estimate is returned; defaults
+     to the COUNT_ESTIMATE_THRESHOLD setting; 0 always counts exactly
+    :return: The number of rows and whether it is an estimate
+    """
+    if threshold is None:
+        threshold = getattr(settings, 'COUNT_ESTIMATE_THRESHOLD', 100_000)
+    if threshold and connection.vendor == 'postgresql':
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate >= threshold:
+            return estimate, True
+    return queryset.count(), False
+
+
+class EstimatedCountPaginator(Paginator):
+    """Admin changelist paginator that estimates the number of rows of large tables.
+
+    The `count_estimated` attribute is set once the count is evaluated, and the changelist
+    prefixes estimated counts with a tilde.  As the estimate may be short of the actual count,
+    e.g. until the table statistics are updated after a bulk registration, the pages past the
+    estimate are valid: a full page adds a next page and a short page marks the end.
+    """
+    count_estimated = False
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return super().count
+        count, self.count_estimated = count_queryset(self.object_list)
+        return count
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.count_estimated and int(number) > 1:
+                return int(number)
+            raise
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.count_estimated:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        object_list = self.object_list[bottom:bottom + self.per_page]
+        if len(object_list) < self.per_page:  # Evaluates the page
+            count = bottom + len(object_list)
+        else:
+            count = max(self.count, bottom + self.per_page + 1)
+        # Update the page count, e.g. for the changelist page links
+        self.__dict__.update(count=count)
+        self.__dict__.pop('num_pages', None)
+        return self._get_page(object_list, number, self)
+
+
 class BaseAdmin(VersionAdmin):
     formfield_overrides = {
         models.TextField: {'widget': forms.Textarea(
@@ -420,6 +515,11 @@ class BaseTests(TestCase):
         globals()['DISABLE_MAIL'] = True
         call_command('loaddata', op.join(DATA_DIR, 'all_dumped_anon.json.gz'), verbosity=1)
 
+    def run(self, result=None):
+        # Rolling back the changes of a test doesn't invalidate the responses it cached
+        cache.clear()
+        return super().run(result)
+
     def ar(self, r, code=200):
         """
         Asserts that HTTP status code matches expected value and parse data with or without
@@ -430,7 +530,8 @@ class BaseTests(TestCase):
         """
         self.assertTrue(r.status_code == code, r.data)
         pkeys = {'count', 'next', 'previous', 'results'}
-        if isinstance(r.data, dict) and set(r.data.keys()) == pkeys:
+        keys = set(r.data.keys()) - {'count_estimated'} if isinstance(r.data, dict) else None
+        if keys in (pkeys, pkeys - {'count'}):
             return r.data['results']
         else:
             return r.data
@@ -580,6 +681,90 @@ class BaseSerializerContentTypeField(serializers.SlugRelatedField):
         return obj
 
 
+class SparseFieldsetMixin:
+    """
+    Serializer mixin selecting the fields of GET responses with the `fields` or `omit` query
+    parameters, e.g. `/datasets?fields=url,name,hash` or `/datasets?omit=file_records,tags`.
+
+    The `field_loading` class attribute maps field names to the loading their representation
+    needs, a dict with any of the keys:
+        - select_related: the relations to join
+        - prefetch_related: the relations to prefetch
+        - annotate: a dict of the annotations to add
+        - columns: the (large) columns deferred unless the field is requested
+    setup_eager_loading only applies that of the requested fields, so that narrow queries are
+    cheaper.  Views call it with their request in get_queryset.
+    """
+    field_loading = {}
+    fields_query_param = 'fields'
+    omit_query_param = 'omit'
+
+    @classmethod
+    def sparse_fieldset(cls, request):
+        """
+        Return the names of the fields requested and omitted by a request.
+
+        :param request: A REST framework request, or None
+        :return: The set of requested field names, or None for all fields, and the set of
+         omitted field names
+        """
+        if request is None or request.method not in ('GET', 'HEAD'):
+            return None, set()
+
+        def parse(param):
+            value = request.query_params.get(param)
+            return None if value is None else {x.strip() for x in value.split(',') if x.strip()}
+        return parse(cls.fields_query_param), parse(cls.omit_query_param) or set()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, request=None):
+        """
+        Perform the eager loading of the fields requested, to avoid horrible performance.
+
+        :param queryset: The queryset to serialize
+        :param request: The request whose sparse fieldset to load; all fields by default
+        :return: The queryset with the related tables and annotations of the requested fields
+        """
+        include, omit = cls.sparse_fieldset(request)
+        if include is not None or omit:
+            queryset = queryset.select_related(None)  # e.g. the joins of the model manager
+        select_related, prefetch_related, annotations, deferred = [], [], {}, []
+        for name, loading in cls.field_loading.items():
+            if (include is not None and name not in include) or name in omit:
+                deferred.extend(loading.get('columns', ()))
+                continue
+            select_related.extend(loading.get('select_related', ()))
+            prefetch_related.extend(loading.get('prefetch_related', ()))
+            annotations.update(loading.get('annotate', {}))
+        if select_related:
+            queryset = queryset.select_related(*dict.fromkeys(select_related))
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*dict.fromkeys(prefetch_related))
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        return queryset
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Only the top level serializer of the response is restricted, not the nested ones
+        parent = getattr(self, 'parent', None)
+        if isinstance(parent, serializers.ListSerializer):
+            parent = getattr(parent, 'parent', None)
+        if parent is not None:
+            return fields
+        include, omit = self.sparse_fieldset(self.context.get('request'))
+        if include is None and not omit:
+            return fields
+        unknown = ((include or set()) | omit) - set(fields)
+        if unknown:
+            raise serializers.ValidationError(
+                {self.fields_query_param: f'Unknown fields: {", ".join(sorted(unknown))}'})
+        return {name: field for name, field in fields.items()
+                if (include is None or name in include) and name not in omit}
+
+
 class BaseSerializerEnumField(serializers.Field):
     """
     Field serializer for an int model field with enumerated choices.
@@ -603,13 +788,224 @@ class BaseSerializerEnumField(serializers.Field):
         return status[0][0]
 
 
+class KeysetPagination(BasePagination):
+    """Keyset (cursor) pagination, whose cost doesn't depend on the depth of the page.
+
+    The rows are ordered by the view's `cursor_field` (e.g. 'created_datetime') then primary key,
+    or by primary key only if the view has none, and each page is selected with a
+    `WHERE key > position` filter on this indexed key instead of an OFFSET.  The next and
+    previous links contain an opaque cursor encoding the position of the last or first row of
+    the page, and no count is returned.  Rows with a null cursor_field come first, in primary
+    key order.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    max_limit = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+        self.field = getattr(view, 'cursor_field', None)
+        self.position, self.reverse = self.decode_cursor(request, queryset.model)
+
+        # Fetch one extra row to find out whether there is another page in that direction
+        rows = []
+        for segment in self._segments(queryset.order_by()):
+            rows.extend(segment[:self.limit + 1 - len(rows)])
+            if len(rows) > self.limit:
+                break
+        more, rows = len(rows) > self.limit, rows[:self.limit]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, more
+        else:
+            self.has_next, self.has_previous = more, self.position is not None
+        self.page = rows
+        return rows
+
+    def _segments(self, queryset):
+        """
+        Return the querysets of the rows after (or before) the cursor position, in page order.
+
+        :param queryset: The unordered queryset
+        :return: A list of ordered querysets: the rows with a null cursor field, if the field is
+         nullable, and the others
+        """
+        sign, after = ('-', 'lt') if self.reverse else ('', 'gt')
+        if self.field is None:
+            if self.position:
+                queryset = queryset.filter(**{f'pk__{after}': self.position[1]})
+            return [queryset.order_by(f'{sign}pk')]
+
+        field = self.field
+        value, pk = self.position or (None, None)
+        values = queryset.filter(**{f'{field}__isnull': False})
+        values = values.order_by(f'{sign}{field}', f'{sign}pk')
+        if not queryset.model._meta.get_field(field).null:
+            nulls = queryset.none()
+        else:
+            nulls = queryset.filter(**{f'{field}__isnull': True}).order_by(f'{sign}pk')
+        if self.position is None:
+            return [nulls, values]
+        if value is None:  # Within the null segment, which comes first
+            nulls = nulls.filter(**{f'pk__{after}': pk})
+            return [nulls] if self.reverse else [nulls, values]
+        # The range condition on the leading column lets the index bound the scan
+        values = values.filter(
+            Q(**{f'{field}__{after}': value}) | Q(**{field: value, f'pk__{after}': pk}),
+            **{f'{field}__{after}e': value})
+        return [values, nulls] if self.reverse else [values]
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(request.query_params[self.limit_query_param],
+                                 strict=True, cutoff=self.max_limit)
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE or self.max_limit
+
+    def decode_cursor(self, request, model):
+        """
+        Return the position and direction encoded in the cursor query parameter.
+
+        :param request: The request; an empty cursor parameter selects the first page
+        :param model: The model of the paginated queryset, used to parse the position values
+        :return: The (cursor field value, pk) position, or None for the first page, and whether
+         the page precedes the position
+        """
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            value, pk = cursor['p']
+            if value is not None:
+                value = model._meta.get_field(self.field).to_python(value)
+            return (value, model._meta.pk.to_python(pk)), bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, ValidationError, FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse=False):
+        """Return the cursor of the page after (or before) a row."""
+        if row is None:  # An empty page: keep the current position
+            value, pk = self.position
+        else:
+            value = getattr(row, self.field) if self.field else None
+            pk = row.pk
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        position = [value, str(pk)]
+        cursor = {'p': position, 'r': 1} if reverse else {'p': position}
+        token = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, token)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1] if self.page else None)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(self.page[0] if self.page else None, reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
 class LimitedLimitOffsetPagination(LimitOffsetPagination):
     """LimitOffsetPagination with a hard cap on the requested page size.
 
     Prevents a single request (e.g. `?limit=5000`) from materializing an
     unbounded number of rows and their prefetched relations in memory.
+
+    Requests with a `cursor` query parameter (e.g. `?cursor=&limit=1000`) are paginated with
+    KeysetPagination instead, for crawling large tables without OFFSET and count queries.
+
+    The count is exact, as clients such as ONE size their results from it.  With `?count=estimate`
+    the count of large result sets is estimated instead (see count_queryset), in which case the
+    response has `count_estimated` set to true.  As the estimate may be short of the actual
+    count, one extra row is fetched to find out whether there is a next page, and the exact count
+    is returned on the last page.
     """
     max_limit = 1000
+    count_query_param = 'count'
+    keyset = None
+    count_estimated = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if KeysetPagination.cursor_query_param in request.query_params:
+            self.keyset = KeysetPagination()
+            self.keyset.max_limit = self.max_limit
+            return self.keyset.paginate_queryset(queryset, request, view)
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        estimate = request.query_params.get(self.count_query_param) == 'estimate'
+        self.count, self.count_estimated = count_queryset(queryset, None if estimate else 0)
+        self.offset = self.get_offset(request)
+        self.request = request
+        if self.count_estimated:
+            page = list(queryset[self.offset:self.offset + self.limit + 1])
+            if len(page) > self.limit:
+                # Make sure the next link is returned, whatever the estimate
+                self.count = max(self.count, self.offset + len(page))
+            elif page or self.offset == 0:
+                self.count, self.count_estimated = self.offset + len(page), False
+            else:  # Past the last page
+                self.count = min(self.count, self.offset)
+            page = page[:self.limit]
+        elif self.count == 0 or self.offset > self.count:
+            page = []
+        else:
+            page = list(queryset[self.offset:self.offset + self.limit])
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        return page
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        response = super().get_paginated_response(data)
+        if self.count_estimated:
+            response.data['count_estimated'] = True
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count_estimated'] = {
+            'type': 'boolean', 'description': 'Whether the count is an estimate'}
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [{
+            'name': KeysetPagination.cursor_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Keyset pagination cursor; pass an empty value for the first page',
+            'schema': {'type': 'string'},
+        }, {
+            'name': self.count_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Pass "estimate" to estimate the count of large result sets',
+            'schema': {'type': 'string', 'enum': ['estimate']},
+        }]
 
 
 def rest_filters_exception_handler(exc, context):
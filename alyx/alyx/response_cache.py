@@ -0,0 +1,146 @@
+"""Read-through cache of the rendered responses of rarely changing REST API views.
+
+Reference table lists, such as `/dataset-types` or `/labs`, are fetched by every ONE client at
+start-up.  Views with the CachedResponseMixin store their rendered GET responses and ETag in
+Django's cache framework (the default cache), keyed by URL, query and media type.  The cached
+responses of a model are invalidated by its post_save, post_delete and m2m_changed signals, which
+change the model's version in the cache, and expire after RESPONSE_CACHE_TTL seconds.
+
+NB: Bulk operations such as queryset.update don't send signals; their changes are returned once
+the cached responses expire.  The default local memory cache is per process, so that the other
+processes return stale responses until they expire: deployments with several processes should
+configure a shared cache backend, otherwise RESPONSE_CACHE_TTL defaults to a few seconds.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+
+_KEY_PREFIX = 'alyx.response'
+
+
+def _version_key(model):
+    return f'{_KEY_PREFIX}.version:{model._meta.label_lower}'
+
+
+def model_versions(models) -> list:
+    """
+    Return the current cache versions of models, setting the missing ones.
+
+    :param models: An iterable of model classes
+    :return: A list of version strings, in the order of the models
+    """
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    if len(versions) < len(keys):
+        for key in set(keys) - versions.keys():
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+        versions = cache.get_many(keys)
+    return [versions.get(key, '') for key in keys]
+
+
+def invalidate(*models):
+    """
+    Invalidate the cached responses of models by changing their version.
+
+    :param models: The model classes
+    """
+    cache.set_many({_version_key(model): uuid.uuid4().hex for model in models}, timeout=None)
+
+
+def _on_change(sender, instance=None, action=None, model=None, **kwargs):
+    """Invalidate the cached responses of a changed model; a signal receiver."""
+    if action is None:  # post_save or post_delete
+        models = (sender,)
+    elif action.startswith('post_'):
+        models = (type(instance), model)
+    else:
+        return
+    invalidate(*models)
+    # Responses cached by other requests before the change is committed are stale too
+    transaction.on_commit(lambda: invalidate(*models))
+
+
+def connect_invalidation(model):
+    """
+    Invalidate the cached responses of a model when its rows or many-to-many relations change.
+
+    :param model: The model class
+    """
+    post_save.connect(_on_change, sender=model, dispatch_uid=_KEY_PREFIX)
+    post_delete.connect(_on_change, sender=model, dispatch_uid=_KEY_PREFIX)
+    for field in model._meta.many_to_many:
+        m2m_changed.connect(
+            _on_change, sender=field.remote_field.through, dispatch_uid=_KEY_PREFIX)
+
+
+class CachedResponseMixin:
+    """
+    View mixin caching the rendered GET responses in Django's cache framework.
+
+    Responses are keyed by absolute URL, query and accepted media type, and are invalidated by
+    changes to `cache_models` (by default the model of the view's queryset).  The responses have
+    an ETag, and requests with a matching If-None-Match header return 304 Not Modified.  Cached
+    responses, conditional or not, are returned without querying the view's tables.  The
+    browsable API, which renders the user's details and forms, isn't cached.
+    """
+    cache_models = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for model in cls.get_cache_models():
+            connect_invalidation(model)
+
+    @classmethod
+    def get_cache_models(cls) -> tuple:
+        if cls.cache_models is not None:
+            return tuple(cls.cache_models)
+        queryset = getattr(cls, 'queryset', None)
+        return () if queryset is None else (queryset.model,)
+
+    def get_response_cache_key(self, request):
+        versions = model_versions(self.get_cache_models())
+        digest = hashlib.md5('\n'.join(
+            [request.accepted_media_type, request.build_absolute_uri(), *versions]
+        ).encode()).hexdigest()
+        return f'{_KEY_PREFIX}:{digest}'
+
+    def get(self, request, *args, **kwargs):
+        self.response_cache_key = None
+        ttl = getattr(settings, 'RESPONSE_CACHE_TTL', 5)
+        if not ttl or isinstance(request.accepted_renderer, BrowsableAPIRenderer):
+            return super().get(request, *args, **kwargs)
+        key = self.get_response_cache_key(request)
+        if (cached := cache.get(key)) is None:
+            self.response_cache_key = key  # The response is cached in finalize_response
+            return super().get(request, *args, **kwargs)
+        etag, content, content_type = cached
+        if (response := get_conditional_response(request, etag)) is None:
+            response = HttpResponse(content, content_type=content_type)
+        return _set_validators(response, etag)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(self, 'response_cache_key', None)
+        if key is None or not isinstance(response, Response) or response.status_code != 200:
+            return response
+        response.render()
+        etag = quote_etag(hashlib.md5(response.content).hexdigest())
+        cache.set(key, (etag, response.content, response['Content-Type']),
+                  timeout=getattr(settings, 'RESPONSE_CACHE_TTL', 5))
+        _set_validators(response, etag)
+        return get_conditional_response(request, etag, response=response)
+
+
+def _set_validators(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -1,11 +1,28 @@
-from datetime import date
+from datetime import date, datetime
+from decimal import Decimal
+from io import BytesIO
 import json
+import math
+from unittest import mock
+import uuid
 
+import msgpack
+from django.core.cache import cache
+from django.db import connection
 from django.test import Client, RequestFactory, TestCase, override_settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
-
-from alyx.base import _custom_filter_parser
+from django.core.paginator import EmptyPage
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+
+from alyx.base import _custom_filter_parser, count_queryset, EstimatedCountPaginator
+from data.models import DataRepository
+from jobs.admin import TaskAdmin
+from jobs.models import Task
+from misc.models import Lab
+from alyx.renderers import MessagePackRenderer, ORJSONParser, ORJSONRenderer
 from alyx.throttling import AdaptiveScopedRateThrottle, IPRateThrottle
 
 
@@ -134,3 +151,195 @@ class TestThrottling(TestCase):
         key = throttle.get_cache_key(request, view=None)
 
         self.assertEqual(key, 'throttle_docs_198.51.100.20')
+
+
+class TestCountEstimate(TestCase):
+    def setUp(self):
+        cache.clear()  # The lab list responses cached by other tests
+        Lab.objects.bulk_create([Lab(name=f'estimate{i:02}') for i in range(30)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE misc_lab')
+        self.n_labs = Lab.objects.count()
+
+    def test_count_queryset(self):
+        # The statistics of a freshly analyzed table are exact
+        self.assertEqual(count_queryset(Lab.objects.all(), threshold=10), (self.n_labs, True))
+        self.assertEqual(count_queryset(Lab.objects.all(), threshold=0), (self.n_labs, False))
+        # Small filtered result sets are counted exactly
+        labs = Lab.objects.filter(name='estimate01')
+        self.assertEqual(count_queryset(labs, threshold=10), (1, False))
+        self.assertEqual(count_queryset(Lab.objects.filter(pk__in=[]), threshold=10), (0, False))
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=10)
+    def test_pagination(self):
+        user = get_user_model().objects.create_superuser('test', 'test', 'test')
+        self.client.force_login(user)
+        # The count is only estimated on request
+        r = self.client.get(reverse('lab-list') + '?limit=10')
+        self.assertNotIn('count_estimated', r.data)
+        r = self.client.get(reverse('lab-list') + '?limit=10&count=estimate')
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.data['count_estimated'])
+        self.assertEqual(r.data['count'], self.n_labs)
+        self.assertIsNotNone(r.data['next'])
+        # The last page returns the exact count
+        r = self.client.get(
+            reverse('lab-list') + f'?limit=10&count=estimate&offset={self.n_labs - 5}')
+        self.assertNotIn('count_estimated', r.data)
+        self.assertEqual(r.data['count'], self.n_labs)
+        self.assertIsNone(r.data['next'])
+        self.assertEqual(len(r.data['results']), 5)
+
+        paginator = EstimatedCountPaginator(Lab.objects.order_by('name'), 10)
+        self.assertEqual(paginator.count, self.n_labs)
+        self.assertTrue(paginator.count_estimated)
+        # Only the changelists of the large tables estimate their count
+        r = self.client.get(reverse('admin:misc_lab_changelist'))
+        self.assertNotContains(r, f'~{self.n_labs}</span>')
+        Task.objects.bulk_create([Task(name=f'task{i:02}', status=20) for i in range(30)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE jobs_task')
+        r = self.client.get(reverse('admin:jobs_task_changelist'))
+        self.assertContains(r, '~30</span>')
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=10)
+    def test_admin_pagination(self):
+        """The admin pages past a stale estimate of the count are returned."""
+        Lab.objects.bulk_create([Lab(name=f'unanalyzed{i:02}') for i in range(15)])
+        labs = Lab.objects.order_by('name')
+        paginator = EstimatedCountPaginator(labs, 10)
+        self.assertLess(paginator.count, len(labs))
+        self.assertTrue(paginator.count_estimated)
+        page, names = None, []
+        while page is None or page.has_next():
+            page = paginator.page(page.next_page_number() if page else 1)
+            names.extend(lab.name for lab in page)
+        self.assertEqual([lab.name for lab in labs], names)
+        self.assertEqual(len(labs), paginator.count)
+        self.assertRaises(EmptyPage, paginator.page, 0)
+
+        user = get_user_model().objects.create_superuser('test', 'test', 'test')
+        self.client.force_login(user)
+        Task.objects.bulk_create([Task(name=f'task{i:02}', status=20) for i in range(30)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE jobs_task')
+        Task.objects.bulk_create([Task(name=f'unanalyzed{i:02}', status=20) for i in range(15)])
+        with mock.patch.object(TaskAdmin, 'list_per_page', 10):
+            r = self.client.get(reverse('admin:jobs_task_changelist') + '?p=5')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.context['cl'].result_list), 5)
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=10)
+    def test_one_pagination(self):
+        """Paginating as ONE does, from the count of the first page, returns every row."""
+        Lab.objects.bulk_create([Lab(name=f'unanalyzed{i:02}') for i in range(15)])
+        self.assertLess(count_queryset(Lab.objects.all(), threshold=10)[0], Lab.objects.count())
+        user = get_user_model().objects.create_superuser('test', 'test', 'test')
+        self.client.force_login(user)
+        limit = 10
+        r = self.client.get(reverse('lab-list') + f'?limit={limit}')
+        results = [None] * r.data['count']
+        results[:limit] = r.data['results']
+        for offset in range(limit, len(results), limit):
+            r = self.client.get(reverse('lab-list') + f'?limit={limit}&offset={offset}')
+            results[offset:offset + limit] = r.data['results']
+        self.assertEqual(sorted(x['name'] for x in results),
+                         sorted(Lab.objects.values_list('name', flat=True)))
+
+
+class TestRenderers(TestCase):
+    def setUp(self):
+        self.data = {
+            'results': [{'id': uuid.uuid4(), 'date': datetime(2020, 1, 2, 3, 4, 5, 678901),
+                         'n': Decimal('1.5'), 'name': 'line\u2028separator',
+                         'json': {1: [None]}}],
+            'count': 2 ** 70,
+        }
+
+    def test_orjson_renderer(self):
+        # Integers over 64 bits are rendered by the json module
+        self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        data = {**self.data, 'count': 1}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+        # Indented output
+        rendered = ORJSONRenderer().render(data, 'application/json; indent=2')
+        self.assertEqual(rendered, JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_orjson_parser(self):
+        self.assertEqual(ORJSONParser().parse(BytesIO(b'{"a": [1, 2.5]}')), {'a': [1, 2.5]})
+        # NaN values are parsed by the json module
+        self.assertTrue(math.isnan(ORJSONParser().parse(BytesIO(b'{"a": NaN}'))['a']))
+
+    def test_msgpack_renderer(self):
+        # Unlike JSON, MessagePack maps may have integer keys
+        results = [{**self.data['results'][0], 'json': {'a': [None]}}]
+        data = {'results': results, 'count': 1}
+        rendered = msgpack.unpackb(MessagePackRenderer().render(data))
+        self.assertEqual(rendered, json.loads(JSONRenderer().render(data)))
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lab = Lab.objects.create(name='cachelab')
+        self.repository = DataRepository.objects.create(name='cacherepo')
+        user = get_user_model().objects.create_superuser('test', 'test', 'test')
+        self.client.force_login(user)
+
+    def get_labs(self, **kwargs):
+        """Return the response of the lab list and whether it queried the lab table."""
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('lab-list'), **kwargs)
+        return r, any('"misc_lab"' in q['sql'] for q in queries.captured_queries)
+
+    def get_lab(self, name='cachelab'):
+        labs = json.loads(self.get_labs()[0].content)['results']
+        return next(x for x in labs if x['name'] == name)
+
+    def test_cached_response(self):
+        r, queried = self.get_labs()
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(queried)
+        etag = r['ETag']
+        r, queried = self.get_labs()
+        self.assertFalse(queried)
+        self.assertEqual(r['ETag'], etag)
+        self.assertIn('cachelab', [x['name'] for x in json.loads(r.content)['results']])
+        # Conditional requests
+        r, queried = self.get_labs(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        self.assertFalse(queried)
+        # Responses are cached by query
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('lab-list') + '?name=foo')
+        self.assertEqual(json.loads(r.content)['results'], [])
+        self.assertTrue(queries.captured_queries)
+        # The browsable API isn't cached
+        r, queried = self.get_labs(HTTP_ACCEPT='text/html')
+        self.assertTrue(queried)
+        r, queried = self.get_labs(HTTP_ACCEPT='text/html')
+        self.assertTrue(queried)
+
+    def test_invalidation(self):
+        etag = self.get_labs()[0]['ETag']
+        Lab.objects.create(name='cachelab2')
+        r, queried = self.get_labs(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(queried)
+        self.assertTrue(self.get_lab('cachelab2'))
+        # Changes to many-to-many relations and related tables
+        self.lab.repositories.add(self.repository)
+        self.assertEqual(self.get_lab()['repositories'], ['cacherepo'])
+        self.repository.name = 'renamed'
+        self.repository.save()
+        self.assertEqual(self.get_lab()['repositories'], ['renamed'])
+        self.repository.delete()
+        self.assertEqual(self.get_lab()['repositories'], [])
+
+    @override_settings(RESPONSE_CACHE_TTL=0)
+    def test_disabled(self):
+        self.assertTrue(self.get_labs()[1])
+        r, queried = self.get_labs()
+        self.assertTrue(queried)
+        self.assertNotIn('ETag', r)
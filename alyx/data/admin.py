@@ -12,7 +12,8 @@ from actions.models import Session
 from subjects.models import Project
 from .models import (DataRepositoryType, DataRepository, DataFormat, DatasetType,
                      Dataset, FileRecord, Download, Revision, Tag, DataNotice)
-from alyx.base import BaseAdmin, BaseInlineAdmin, DefaultListFilter, get_admin_url
+from alyx.base import (BaseAdmin, BaseInlineAdmin, DefaultListFilter, EstimatedCountPaginator,
+                       get_admin_url)
 
 
 class CreatedByListFilter(DefaultListFilter):
@@ -105,6 +106,7 @@ class DatasetAdmin(BaseExperimentalDataAdmin):
     search_fields = ('session__id', 'name', 'collection', 'dataset_type__name',
                      'dataset_type__filename_pattern', 'version')
     ordering = ('-created_datetime',)
+    paginator = EstimatedCountPaginator
 
     def get_queryset(self, request):
         queryset = super(DatasetAdmin, self).get_queryset(request)
@@ -168,6 +170,7 @@ class FileRecordAdmin(BaseAdmin):
     search_fields = ('dataset__created_by__username', 'dataset__name',
                      'relative_path', 'data_repository__name')
     ordering = ('-dataset__created_datetime',)
+    paginator = EstimatedCountPaginator
 
     def get_queryset(self, request):
         qs = super(FileRecordAdmin, self).get_queryset(request)
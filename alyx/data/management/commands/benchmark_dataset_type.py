@@ -0,0 +1,79 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+from one.registration import get_dataset_type
+
+from data.models import Dataset, DatasetType
+from data.transfers import DatasetTypeMatcher
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py benchmark_dataset_type
+        ./manage.py benchmark_dataset_type --synthetic 1000 --n-files 5000
+    """
+    help = "Compare dataset type lookups per second of the compiled matcher and get_dataset_type."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='Benchmark this many generated dataset types instead of the '
+                                 'ones in the database')
+        parser.add_argument('--n-files', type=int, default=2000,
+                            help='Number of filenames to look up')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        n_files = options['n_files']
+        if options['synthetic']:
+            dtypes, filenames = self._synthetic(options['synthetic'], n_files, rng)
+        else:
+            dtypes = list(DatasetType.objects.all())
+            names = list(Dataset.objects.order_by().values_list('name', flat=True)
+                         .distinct()[:n_files])
+            filenames = [rng.choice(names) for _ in range(n_files)] if names else []
+        if not dtypes or not filenames:
+            self.stdout.write(self.style.WARNING('No dataset types or datasets to benchmark.'))
+            return
+        self.stdout.write(f'{len(dtypes)} dataset types, {len(filenames)} filenames')
+
+        t0 = time.perf_counter()
+        matcher = DatasetTypeMatcher(dtypes)
+        self.stdout.write(f'compiled matcher in {(time.perf_counter() - t0) * 1e3:.1f} ms')
+
+        results = {}
+        for label, func in (('get_dataset_type', lambda f: get_dataset_type(f, dtypes)),
+                            ('DatasetTypeMatcher', matcher.match)):
+            results[label] = []
+            t0 = time.perf_counter()
+            for filename in filenames:
+                try:
+                    results[label].append(func(filename).name)
+                except ValueError:
+                    results[label].append(None)
+            rate = len(filenames) / (time.perf_counter() - t0)
+            self.stdout.write(f'{label:>20}: {rate:12,.0f} lookups/s')
+        assert results['get_dataset_type'] == results['DatasetTypeMatcher'], \
+            'Matcher results differ from get_dataset_type'
+
+    @staticmethod
+    def _synthetic(n, n_files, rng):
+        """Generate dataset types similar to the IBL ones and filenames that match them."""
+        objects = [f'obj{i}' for i in range(max(1, n // 10))]
+        dtypes, filenames = [], []
+        for i in range(n):
+            obj, attr = rng.choice(objects), f'attr{i}'
+            kind = i % 3
+            if kind == 0:  # name only
+                pattern = ''
+            elif kind == 1:  # namespaced
+                pattern = f'_*_{obj}.{attr}.*'
+            else:
+                pattern = f'{obj}.{attr}*.*'
+            dtypes.append({'name': f'{obj}.{attr}', 'filename_pattern': pattern})
+        for _ in range(n_files):
+            dt = rng.choice(dtypes)
+            prefix = '_ibl_' if dt['filename_pattern'].startswith('_') else ''
+            filenames.append(f'{prefix}{dt["name"]}.npy')
+        return dtypes, filenames
@@ -0,0 +1,99 @@
+import json
+import time
+
+import msgpack
+import orjson
+from alyx.renderers import ArrowStreamRenderer, MessagePackRenderer, ORJSONRenderer
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from misc.management.commands.synthetic_db import generate_synthetic_db
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from data.views import DatasetList
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py benchmark_renderers
+        ./manage.py benchmark_renderers --synthetic 10000 --page-size 250 1000 -o renderers.json
+    """
+    help = ("Time the DatasetList query and serialization of a page, and the rendering and "
+            "client parsing of that page with each renderer.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='Benchmark with this many generated datasets added to the '
+                                 'database; they are rolled back afterwards')
+        parser.add_argument('--page-size', type=int, nargs='+', default=[250, 1000])
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of timings of each step, of which the best is kept')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('-o', '--output',
+                            help='Save the results to this JSON file')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['synthetic']:
+                generate_synthetic_db(options['synthetic'], seed=options['seed'])
+            user = get_user_model().objects.filter(is_superuser=True).first()
+            if user is None:
+                user = get_user_model().objects.create_superuser('benchmark', password=None)
+            results = [self._benchmark(page_size, options['repeat'], user)
+                       for page_size in options['page_size']]
+            transaction.set_rollback(True)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                json.dump(results, fp, indent=1)
+
+    def _benchmark(self, page_size, repeat, user) -> dict:
+        """
+        Time the steps of a DatasetList request with each renderer.
+
+        :param page_size: The number of datasets in the page
+        :param repeat: The number of timings of each step, of which the best is kept
+        :param user: The user making the request
+        :return: A dict with keys ('page_size', 'rows', 'query_seconds', 'renderers'), the latter
+         a list of dicts with keys ('renderer', 'bytes', 'render_seconds', 'parse_seconds')
+        """
+        import pyarrow as pa
+        renderers = [('json', JSONRenderer(), json.loads),
+                     ('orjson', ORJSONRenderer(), orjson.loads),
+                     ('arrow', ArrowStreamRenderer(), lambda b: pa.ipc.open_stream(b).read_all()),
+                     ('msgpack', MessagePackRenderer(), msgpack.unpackb)]
+
+        def request():
+            request = APIRequestFactory().get(
+                '/datasets', {'limit': page_size}, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            return DatasetList.as_view()(request)  # NB: the response isn't rendered
+
+        query_seconds, response = _best(request, repeat)
+        if response.status_code != 200:
+            raise CommandError(response.data)
+        result = {'page_size': page_size, 'rows': len(response.data['results']),
+                  'query_seconds': query_seconds, 'renderers': []}
+        self.stdout.write(f'{result["rows"]:,} datasets per page: '
+                          f'query and serialization {query_seconds * 1e3:8.1f} ms')
+        for name, renderer, loads in renderers:
+            render_seconds, content = _best(
+                renderer.render, repeat, response.data, renderer.media_type,
+                response.renderer_context)
+            parse_seconds, _ = _best(loads, repeat, content)
+            result['renderers'].append({'renderer': name, 'bytes': len(content),
+                                        'render_seconds': render_seconds,
+                                        'parse_seconds': parse_seconds})
+            self.stdout.write(f'{name:>10}: render {render_seconds * 1e3:8.1f} ms, '
+                              f'parse {parse_seconds * 1e3:8.1f} ms, {len(content):12,} bytes')
+        return result
+
+
+def _best(func, repeat, *args):
+    """Return the shortest of several timings of a function call, and its last result."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times), out
@@ -1,10 +1,11 @@
 import logging
 
-from one.registration import get_dataset_type, Bunch
+from one.registration import Bunch
 
 from django.core.management import BaseCommand
 
 from data.models import Dataset, DatasetType
+from data.transfers import DatasetTypeMatcher
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
 
@@ -42,10 +43,11 @@ class Command(BaseCommand):
         assert pattern not in [d['filename_pattern'] for d in dtypes], \
             f'Pattern {pattern} already exists.'
         dtypes.append(Bunch({'id': name, 'name': name, 'filename_pattern': pattern}))
+        matcher = DatasetTypeMatcher(dtypes)
         # If example filename provided, check it against all patterns
         if filename:
             self.stdout.write(f'Checking filename "{filename}" against all patterns...')
-            dtype = get_dataset_type(filename, dtypes)
+            dtype = matcher.match(filename)
             assert dtype == dtypes[-1], (
                 f'Filename "{filename}" did not match the expected pattern "{pattern}". '
                 f'Got dataset type: {dtype}'
@@ -54,7 +56,7 @@ class Command(BaseCommand):
         # Check dataset types for existing datasets
         for dset, expected_dtype in dsets:
             try:
-                dtype = get_dataset_type(dset, dtypes)
+                dtype = matcher.match(dset)
             except ValueError as e:
                 if not options.get('strict') and 'No dataset type found' in str(e):
                     dtype = DatasetType.objects.get(id=expected_dtype)
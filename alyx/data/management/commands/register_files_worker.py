@@ -0,0 +1,137 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from data.models import RegistrationJob
+from data.transfers import RegistrationResolver
+from data.views import RegisterFileViewSet
+
+logger = logging.getLogger(__name__)
+
+# Parsed request fields that hold one value per file
+FILE_FIELDS = ('filenames', 'hashes', 'filesizes', 'versions', 'qc')
+
+
+def claim_jobs(limit, timeout=600, max_attempts=3):
+    """Mark up to `limit` waiting jobs as started and return them.
+
+    Rows locked by other workers are skipped so that several workers may drain the same queue.
+    Started jobs that haven't saved progress for `timeout` seconds, e.g. because their worker
+    crashed, are claimed again and resume after their last registered batch, unless they were
+    already claimed `max_attempts` times, in which case they are marked as errored.
+
+    :param limit: the maximum number of jobs to claim
+    :param timeout: the seconds without progress after which a started job is claimed again
+    :param max_attempts: the number of times a job may be claimed
+    :return: a list of RegistrationJob instances
+    """
+    now = timezone.now()
+    stale = Q(status=RegistrationJob.STATUS.STARTED,
+              heartbeat__lt=now - timedelta(seconds=timeout))
+    with transaction.atomic():
+        RegistrationJob.objects.filter(stale, attempts__gte=max_attempts).update(
+            status=RegistrationJob.STATUS.ERRORED, end_time=now, error={
+                'status_code': 500,
+                'detail': f'The job made no progress for {timeout:g}s after {max_attempts} attempts'
+            })
+        jobs = list(
+            RegistrationJob.objects
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('created_by')
+            .filter(Q(status=RegistrationJob.STATUS.WAITING) | stale)
+            .order_by('created_datetime')[:limit])
+        RegistrationJob.objects.filter(pk__in=[j.pk for j in jobs]).update(
+            status=RegistrationJob.STATUS.STARTED, start_time=Coalesce('start_time', Value(now)),
+            heartbeat=now, attempts=F('attempts') + 1)
+    return jobs
+
+
+def run_job(job, batch_size=500):
+    """Register the files of a job in batches, saving the progress after each batch.
+
+    :param job: a RegistrationJob instance
+    :param batch_size: the number of files to register per batch
+    :return: the job status
+    """
+    payload = job.payload
+    view, resolver = RegisterFileViewSet(), RegistrationResolver()
+    job.status = RegistrationJob.STATUS.STARTED
+    try:
+        for i in range(job.n_done, job.n_files, batch_size):
+            batch = {k: v[i:i + batch_size] if k in FILE_FIELDS and isinstance(v, list) else v
+                     for k, v in payload.items()}
+            response = view.register(batch, job.created_by, resolver)
+            if response.status_code != 201:
+                job.status, job.error = RegistrationJob.STATUS.ERRORED, response.data
+                break
+            job.results.extend(response.data)
+            job.n_done = len(job.results)
+            job.heartbeat = timezone.now()
+            job.save(update_fields=['n_done', 'results', 'heartbeat'])
+        else:
+            job.status = RegistrationJob.STATUS.COMPLETE
+    except Exception as ex:
+        logger.exception('Registration job %s failed', job.pk)
+        job.status = RegistrationJob.STATUS.ERRORED
+        job.error = {'status_code': 500, 'detail': str(ex)}
+    job.end_time = timezone.now()
+    job.save(update_fields=['status', 'error', 'end_time'])
+    return job.status
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py register_files_worker --once
+        ./manage.py register_files_worker --workers 4 --batch-size 200 --sleep 2
+        ./manage.py register_files_worker --timeout 1800 --max-attempts 5
+    """
+    help = 'Process register-file requests queued with the async flag.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of jobs to process concurrently')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files to register between progress updates')
+        parser.add_argument('--sleep', type=float, default=5.,
+                            help='Seconds to wait between polls when the queue is empty')
+        parser.add_argument('--timeout', type=float, default=600.,
+                            help='Seconds without progress after which a started job is '
+                                 'requeued; should exceed the time taken by a batch')
+        parser.add_argument('--max-attempts', type=int, default=3,
+                            help='Number of times a job is started before it is marked as '
+                                 'errored')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        batch_size = options['batch_size']
+
+        def _run(job):
+            try:
+                return run_job(job, batch_size=batch_size)
+            finally:
+                if workers > 1:  # each thread opens its own database connection
+                    connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                jobs = claim_jobs(workers, options['timeout'], options['max_attempts'])
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    close_old_connections()
+                    continue
+                run = map(_run, jobs) if workers == 1 else pool.map(_run, jobs)
+                for job, status in zip(jobs, run):
+                    self.stdout.write(
+                        f'{job.pk}: {RegistrationJob.STATUS(status).label} '
+                        f'({job.n_done}/{job.n_files} files)')
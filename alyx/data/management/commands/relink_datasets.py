@@ -0,0 +1,48 @@
+from django.core.management import BaseCommand, CommandError
+
+from data.models import Dataset, link_session_objects
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py relink_datasets --session 4ecb5d24-f5cc-402c-be28-9d0f7cb14b3a
+        ./manage.py relink_datasets --lab cortexlab churchlandlab --batch-size 10000
+    """
+    help = ('Link the datasets of sessions or labs to the probe insertions and fields of view '
+            'named in their collection.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--session', nargs='+', help='Session UUID(s)')
+        parser.add_argument('--lab', nargs='+', help='Lab name(s)')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of datasets to link per batch')
+
+    def handle(self, *args, **options):
+        if not (options['session'] or options['lab']):
+            raise CommandError('At least one session or lab must be specified')
+        # NB: The base manager avoids joining the dataset type and data format tables
+        dsets = (Dataset._base_manager
+                 .filter(collection__contains='/', session__isnull=False)
+                 .only('id', 'session', 'collection'))
+        if options['session']:
+            dsets = dsets.filter(session__in=options['session'])
+        if options['lab']:
+            dsets = dsets.filter(session__lab__name__in=options['lab'])
+
+        batch_size = options['batch_size']
+        n_datasets = n_insertions = n_fovs = 0
+        batch = []
+        for dset in dsets.order_by().iterator(chunk_size=batch_size):
+            batch.append(dset)
+            if len(batch) == batch_size:
+                n_pi, n_fov = link_session_objects(batch)
+                n_datasets, n_insertions, n_fovs = \
+                    n_datasets + len(batch), n_insertions + n_pi, n_fovs + n_fov
+                batch = []
+        if batch:
+            n_pi, n_fov = link_session_objects(batch)
+            n_datasets, n_insertions, n_fovs = \
+                n_datasets + len(batch), n_insertions + n_pi, n_fovs + n_fov
+        self.stdout.write(self.style.SUCCESS(
+            f'{n_datasets} datasets: {n_insertions} probe insertion and '
+            f'{n_fovs} field of view links'))
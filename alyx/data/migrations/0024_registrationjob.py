@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:43
+
+import django.core.serializers.json
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0023_datanotice'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, help_text='Long name', max_length=255)),
+                ('json', models.JSONField(blank=True, help_text='Structured data, formatted in a user-defined way', null=True)),
+                ('created_datetime', models.DateTimeField(auto_now_add=True)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('status', models.IntegerField(choices=[(20, 'Waiting'), (30, 'Started'), (40, 'Errored'), (60, 'Complete')], default=20, help_text='20: WAITING / 30: STARTED / 40: ERRORED / 60: COMPLETE')),
+                ('payload', models.JSONField(help_text='The validated register-file request data')),
+                ('n_files', models.PositiveIntegerField(default=0)),
+                ('n_done', models.PositiveIntegerField(default=0, help_text='Number of files registered')),
+                ('results', models.JSONField(blank=True, default=list, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='The register-file response for each registered file')),
+                ('error', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='The error response that stopped the registration', null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='registration_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('created_datetime',),
+                'indexes': [models.Index(fields=['status', 'created_datetime'], name='data_regist_status_9db4fb_idx')],
+            },
+        ),
+    ]
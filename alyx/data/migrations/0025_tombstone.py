@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('data', '0024_registrationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.UUIDField(help_text='UUID of the deleted object')),
+                ('session_id', models.UUIDField(blank=True, help_text='UUID of the session of a deleted dataset', null=True)),
+                ('deleted_datetime', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'ordering': ('deleted_datetime',),
+            },
+        ),
+    ]
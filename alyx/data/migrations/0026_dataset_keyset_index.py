@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0025_tombstone'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['created_datetime', 'id'], name='data_dataset_created_keyset'),
+        ),
+    ]
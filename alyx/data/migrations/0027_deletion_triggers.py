@@ -0,0 +1,84 @@
+from django.db import migrations
+
+# Statement-level triggers with transition tables record the tombstones of deleted sessions and
+# datasets, and flag the datasets of deleted or updated file records as modified for the ONE
+# cache, in one statement per deletion or update.  Unlike post_delete receivers, they don't stop
+# Django from deleting cascaded rows in bulk, and they also apply to queryset updates.
+TRIGGERS = """
+CREATE FUNCTION data_tombstone_dataset() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO data_tombstone (content_type_id, object_id, session_id, deleted_datetime)
+    SELECT ct.id, old_rows.id, old_rows.session_id, clock_timestamp()::timestamp
+    FROM old_rows CROSS JOIN django_content_type ct
+    WHERE ct.app_label = 'data' AND ct.model = 'dataset';
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER data_dataset_tombstone
+    AFTER DELETE ON data_dataset REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_tombstone_dataset();
+
+CREATE FUNCTION data_tombstone_session() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO data_tombstone (content_type_id, object_id, session_id, deleted_datetime)
+    SELECT ct.id, old_rows.id, NULL, clock_timestamp()::timestamp
+    FROM old_rows CROSS JOIN django_content_type ct
+    WHERE ct.app_label = 'actions' AND ct.model = 'session';
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER actions_session_tombstone
+    AFTER DELETE ON actions_session REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_tombstone_session();
+
+CREATE FUNCTION data_touch_deleted_file_record_datasets() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE data_dataset SET auto_datetime = clock_timestamp()::timestamp
+    WHERE id IN (SELECT dataset_id FROM old_rows);
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER data_filerecord_delete_touch_dataset
+    AFTER DELETE ON data_filerecord REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_deleted_file_record_datasets();
+
+CREATE FUNCTION data_touch_updated_file_record_datasets() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE data_dataset SET auto_datetime = clock_timestamp()::timestamp
+    WHERE id IN (
+        SELECT unnest(ARRAY[old_rows.dataset_id, new_rows.dataset_id])
+        FROM old_rows JOIN new_rows ON new_rows.id = old_rows.id
+        WHERE new_rows.exists IS DISTINCT FROM old_rows.exists
+           OR new_rows.dataset_id IS DISTINCT FROM old_rows.dataset_id
+    );
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER data_filerecord_update_touch_dataset
+    AFTER UPDATE ON data_filerecord REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_updated_file_record_datasets();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS data_filerecord_update_touch_dataset ON data_filerecord;
+DROP FUNCTION IF EXISTS data_touch_updated_file_record_datasets();
+DROP TRIGGER IF EXISTS data_filerecord_delete_touch_dataset ON data_filerecord;
+DROP FUNCTION IF EXISTS data_touch_deleted_file_record_datasets();
+DROP TRIGGER IF EXISTS actions_session_tombstone ON actions_session;
+DROP FUNCTION IF EXISTS data_tombstone_session();
+DROP TRIGGER IF EXISTS data_dataset_tombstone ON data_dataset;
+DROP FUNCTION IF EXISTS data_tombstone_dataset();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0026_alter_surgery_implant_weight'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('data', '0026_dataset_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0027_deletion_triggers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registrationjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Number of times the job was claimed by a worker'),
+        ),
+        migrations.AddField(
+            model_name='registrationjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, help_text='Last time the worker processing the job saved progress', null=True),
+        ),
+        # Jobs started before the heartbeat was recorded may be reclaimed from their start time
+        migrations.RunSQL(
+            'UPDATE data_registrationjob SET heartbeat = start_time, attempts = 1 '
+            'WHERE status = 30',
+            migrations.RunSQL.noop),
+    ]
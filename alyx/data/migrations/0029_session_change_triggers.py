@@ -0,0 +1,100 @@
+from django.db import migrations
+
+# The ONE sessions table includes the session projects and the subject and lab names, which are
+# stored in other tables.  Statement-level triggers flag the sessions as modified when their
+# projects are added or removed, or when a project, subject or lab is renamed, so that the
+# incremental cache updates rebuild their rows.
+TRIGGERS = """
+CREATE FUNCTION data_touch_added_project_sessions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE actions_session SET auto_datetime = clock_timestamp()::timestamp
+    WHERE id IN (SELECT session_id FROM new_rows);
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER actions_session_projects_insert_touch_session
+    AFTER INSERT ON actions_session_projects REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_added_project_sessions();
+
+CREATE FUNCTION data_touch_removed_project_sessions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE actions_session SET auto_datetime = clock_timestamp()::timestamp
+    WHERE id IN (SELECT session_id FROM old_rows);
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER actions_session_projects_delete_touch_session
+    AFTER DELETE ON actions_session_projects REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_removed_project_sessions();
+
+CREATE FUNCTION data_touch_renamed_project_sessions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE actions_session SET auto_datetime = clock_timestamp()::timestamp
+    WHERE id IN (
+        SELECT sp.session_id FROM actions_session_projects sp
+        JOIN old_rows ON old_rows.id = sp.project_id
+        JOIN new_rows ON new_rows.id = old_rows.id
+        WHERE new_rows.name IS DISTINCT FROM old_rows.name
+    );
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER subjects_project_update_touch_session
+    AFTER UPDATE ON subjects_project REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_renamed_project_sessions();
+
+CREATE FUNCTION data_touch_renamed_subject_sessions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE actions_session SET auto_datetime = clock_timestamp()::timestamp
+    WHERE subject_id IN (
+        SELECT new_rows.id FROM old_rows JOIN new_rows ON new_rows.id = old_rows.id
+        WHERE new_rows.nickname IS DISTINCT FROM old_rows.nickname
+    );
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER subjects_subject_update_touch_session
+    AFTER UPDATE ON subjects_subject REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_renamed_subject_sessions();
+
+CREATE FUNCTION data_touch_renamed_lab_sessions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE actions_session SET auto_datetime = clock_timestamp()::timestamp
+    WHERE lab_id IN (
+        SELECT new_rows.id FROM old_rows JOIN new_rows ON new_rows.id = old_rows.id
+        WHERE new_rows.name IS DISTINCT FROM old_rows.name
+    );
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER misc_lab_update_touch_session
+    AFTER UPDATE ON misc_lab REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION data_touch_renamed_lab_sessions();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS misc_lab_update_touch_session ON misc_lab;
+DROP FUNCTION IF EXISTS data_touch_renamed_lab_sessions();
+DROP TRIGGER IF EXISTS subjects_subject_update_touch_session ON subjects_subject;
+DROP FUNCTION IF EXISTS data_touch_renamed_subject_sessions();
+DROP TRIGGER IF EXISTS subjects_project_update_touch_session ON subjects_project;
+DROP FUNCTION IF EXISTS data_touch_renamed_project_sessions();
+DROP TRIGGER IF EXISTS actions_session_projects_delete_touch_session ON actions_session_projects;
+DROP FUNCTION IF EXISTS data_touch_removed_project_sessions();
+DROP TRIGGER IF EXISTS actions_session_projects_insert_touch_session ON actions_session_projects;
+DROP FUNCTION IF EXISTS data_touch_added_project_sessions();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0026_alter_surgery_implant_weight'),
+        ('data', '0028_registrationjob_heartbeat'),
+        ('misc', '0013_alter_lab_reference_weight_pct_and_more'),
+        ('subjects', '0016_remove_subject_cull_method'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -1,9 +1,12 @@
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 import markdown as _markdown
 from one.alf.spec import QC
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -272,6 +275,74 @@ class Revision(BaseModel):
         return super(Revision, self).save(*args, **kwargs)
 
 
+def _session_object_name(collection):
+    """Return the probe insertion or field of view name of a collection, e.g. alf/probe00."""
+    parts = (collection or '').split('/')
+    return parts[1] if len(parts) > 1 else None
+
+
+def link_session_objects(datasets):
+    """
+    Link datasets to the probe insertions and fields of view named in their collection.
+
+    For a collection such as 'alf/probe00/pykilosort', the datasets are linked to the probe
+    insertion and/or field of view called 'probe00' in the same session, replacing any existing
+    links. Datasets without a matching object are left untouched. All datasets are resolved with
+    one query per model, followed by one delete and one insert per model.
+
+    :param datasets: an iterable of Dataset objects
+    :return: the number of probe insertion links and of field of view links
+    """
+    from experiments.models import ProbeInsertion, FOV
+    datasets = [d for d in datasets if _session_object_name(d.collection) and d.session_id]
+    if not datasets:
+        return 0, 0
+    sessions = {d.session_id for d in datasets}
+    names = {_session_object_name(d.collection) for d in datasets}
+    n_links = []
+    for model in (ProbeInsertion, FOV):
+        objects = {}
+        for pk, session_id, name in (model.objects
+                                     .filter(session__in=sessions, name__in=names)
+                                     .values_list('pk', 'session_id', 'name')):
+            objects.setdefault((session_id, name), []).append(pk)
+        through = model.datasets.through
+        links = [through(**{'dataset_id': d.pk, f'{model._meta.model_name}_id': pk})
+                 for d in datasets
+                 for pk in objects.get((d.session_id, _session_object_name(d.collection)), ())]
+        linked = {link.dataset_id for link in links}
+        if linked:
+            with transaction.atomic():
+                through.objects.filter(dataset__in=linked).delete()
+                through.objects.bulk_create(links, ignore_conflicts=True)
+        n_links.append(len(links))
+    return tuple(n_links)
+
+
+_pending_session_links = ContextVar('pending_session_links', default=None)
+
+
+@contextmanager
+def defer_session_links():
+    """
+    Defer the probe insertion and field of view linking of saved datasets.
+
+    Within this context, Dataset.save records the dataset instead of linking it. All recorded
+    datasets are linked in one pass when leaving the context, so a dataset saved several times
+    is linked once. Nested contexts are linked by the outermost one.
+    """
+    if _pending_session_links.get() is not None:
+        yield
+        return
+    pending = {}
+    token = _pending_session_links.set(pending)
+    try:
+        yield
+    finally:
+        _pending_session_links.reset(token)
+    link_session_objects(pending.values())
+
+
 class DatasetQuerySet(BaseQuerySet):
     """A Queryset that checks for protected datasets before deletion"""
 
@@ -361,6 +432,11 @@ class Dataset(BaseExperimentalData):
     qc = models.IntegerField(default=QC.NOT_SET, choices=QC_CHOICES,
                              help_text=' / '.join([str(q[0]) + ': ' + q[1] for q in QC_CHOICES]))
 
+    class Meta:
+        # The key of the keyset pagination of the datasets list, see alyx.base.KeysetPagination
+        indexes = [models.Index(fields=['created_datetime', 'id'],
+                                name='data_dataset_created_keyset')]
+
     @property
     def is_online(self):
         fr = self.file_records.filter(data_repository__globus_is_personal=False)
@@ -394,16 +470,14 @@ class Dataset(BaseExperimentalData):
         if not self.collection:
             return
         self.clean_fields()  # Validate collection field
-        from experiments.models import ProbeInsertion, FOV
-        parts = self.collection.rsplit('/')
-        if len(parts) > 1:
-            name = parts[1]
-            pis = ProbeInsertion.objects.filter(session=self.session, name=name)
-            if len(pis):
-                self.probe_insertion.set(pis.values_list('pk', flat=True))
-            fovs = FOV.objects.filter(session=self.session, name=name)
-            if len(fovs):
-                self.field_of_view.set(fovs.values_list('pk', flat=True))
+        if (pending := _pending_session_links.get()) is not None:
+            pending[self.pk] = self  # linked when leaving defer_session_links
+        else:
+            self.link_session_objects()
+
+    def link_session_objects(self):
+        """Link the probe insertion and field of view whose name matches the collection."""
+        link_session_objects([self])
 
     def delete(self, *args, force=False, **kwargs):
         # If a dataset is protected and force=False, raise an exception
@@ -558,3 +632,68 @@ class DataNotice(BaseModel):
 
     def __str__(self):
         return self.name or str(self.id)
+
+
+class RegistrationJob(BaseModel):
+    """A register-file request queued to be processed by the register_files_worker command."""
+
+    class STATUS(models.IntegerChoices):
+        WAITING = 20
+        STARTED = 30
+        ERRORED = 40
+        COMPLETE = 60
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+        related_name='registration_jobs')
+    created_datetime = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(null=True, blank=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(
+        null=True, blank=True, help_text='Last time the worker processing the job saved progress')
+    attempts = models.PositiveSmallIntegerField(
+        default=0, help_text='Number of times the job was claimed by a worker')
+    status = models.IntegerField(
+        default=STATUS.WAITING, choices=STATUS,
+        help_text=' / '.join([f'{s.value}: {s.name}' for s in STATUS]))
+    payload = models.JSONField(help_text='The validated register-file request data')
+    n_files = models.PositiveIntegerField(default=0)
+    n_done = models.PositiveIntegerField(default=0, help_text='Number of files registered')
+    results = models.JSONField(
+        default=list, blank=True, encoder=DjangoJSONEncoder,
+        help_text='The register-file response for each registered file')
+    error = models.JSONField(
+        null=True, blank=True, encoder=DjangoJSONEncoder,
+        help_text='The error response that stopped the registration')
+
+    class Meta:
+        ordering = ('created_datetime',)
+        indexes = [models.Index(fields=['status', 'created_datetime'])]
+
+    def __str__(self):
+        return f'<RegistrationJob {self.pk} ({self.get_status_display()})>'
+
+
+# Deletion log
+# ------------------------------------------------------------------------------------------------
+
+class Tombstone(models.Model):
+    """
+    A record of a deleted dataset or session, used by one_cache to remove deleted rows when
+    updating the cache tables incrementally.
+
+    Tombstones are inserted by database triggers on deletion (see migration
+    0027_deletion_triggers), which also flag the datasets of deleted or updated file records as
+    modified, so that bulk deletions and queryset updates are recorded too.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField(help_text='UUID of the deleted object')
+    session_id = models.UUIDField(null=True, blank=True,
+                                  help_text='UUID of the session of a deleted dataset')
+    deleted_datetime = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ('deleted_datetime',)
+
+    def __str__(self):
+        return f'<Tombstone {self.content_type.model} {self.object_id}>'
@@ -1,14 +1,14 @@
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Q, BooleanField, Prefetch
+from django.db.models import Exists, OuterRef, Prefetch
 from rest_framework import serializers
 import markdown
 
 from one.alf.spec import QC
 
 from .models import (DataRepositoryType, DataRepository, DataFormat, DatasetType,
-                     Dataset, Download, FileRecord, Revision, Tag, DataNotice)
+                     Dataset, Download, FileRecord, Revision, Tag, DataNotice, RegistrationJob)
 from .transfers import _get_session, _change_default_dataset
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsetMixin
 from actions.models import Session
 from subjects.models import Subject
 from misc.models import LabMember
@@ -110,7 +110,7 @@ class TagSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class DatasetSerializer(serializers.HyperlinkedModelSerializer):
+class DatasetSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     created_by = serializers.SlugRelatedField(
         read_only=False, slug_field='username',
         queryset=get_user_model().objects.all(),
@@ -160,18 +160,21 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
 
     number = serializers.IntegerField(required=False)
 
-    @staticmethod
-    def setup_eager_loading(queryset):
-        """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related(
-            'created_by', 'dataset_type', 'data_format', 'session',
-            'session__subject', 'revision')
-        queryset = queryset.prefetch_related(
-            'file_records', 'file_records__data_repository', 'tags')
-        public = Count('tags', filter=Q(tags__public=True), output_field=BooleanField())
-        protected = Count('tags', filter=Q(tags__protected=True), output_field=BooleanField())
-        queryset = queryset.annotate(public=public, protected=protected)
-        return queryset
+    field_loading = {
+        'created_by': {'select_related': ('created_by',)},
+        'dataset_type': {'select_related': ('dataset_type',)},
+        'data_format': {'select_related': ('data_format',)},
+        'revision': {'select_related': ('revision',)},
+        'session': {'select_related': ('session', 'session__subject')},
+        'experiment_number': {'select_related': ('session',)},
+        'file_records': {'prefetch_related': ('file_records', 'file_records__data_repository')},
+        'tags': {'prefetch_related': ('tags',)},
+        'public': {'annotate': {'public': Exists(
+            Tag.objects.filter(datasets=OuterRef('pk'), public=True))}},
+        'protected': {'annotate': {'protected': Exists(
+            Tag.objects.filter(datasets=OuterRef('pk'), protected=True))}},
+        'json': {'columns': ('json',)},
+    }
 
     def get_experiment_number(self, obj):
         return obj.session.number if obj and obj.session else None
@@ -217,7 +220,7 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
     def to_representation(self, instance):
         """Override the default to_representation method to null the revision field."""
         representation = super().to_representation(instance)
-        if representation.get('revision') is None:
+        if representation.get('revision', '') is None:
             representation['revision'] = ''
         return representation
 
@@ -303,3 +306,12 @@ class DataNoticeSerializer(serializers.ModelSerializer):
                 {'affected_date_end': 'affected_date_end must be on or after affected_date_start.'}
             )
         return attrs
+
+
+class RegistrationJobSerializer(serializers.ModelSerializer):
+    created_by = serializers.SlugRelatedField(read_only=True, slug_field='username')
+    status = BaseSerializerEnumField(read_only=True)
+
+    class Meta:
+        model = RegistrationJob
+        exclude = ('payload',)
@@ -1,18 +1,25 @@
+import json
+import tempfile
 from unittest import mock
-from pathlib import PurePosixPath
+from pathlib import Path, PurePosixPath
 from uuid import uuid4
 from datetime import datetime, timedelta
 
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.utils import IntegrityError
 from django.db.models import ProtectedError
 from rest_framework.response import Response
 from one.alf.path import add_uuid_string
 
+from alyx import response_cache
 from data.management.commands import files
-from data.models import Dataset, DatasetType, Tag, Revision, DataRepository, FileRecord, DataNotice
+from data.models import (Dataset, DatasetType, Tag, Revision, DataRepository, FileRecord,
+                         DataNotice, DataFormat, Tombstone)
 from subjects.models import Subject
 from actions.models import Session
 from misc.models import Lab
@@ -58,6 +65,45 @@ class TestModel(TestCase):
         with self.assertLogs('data.models', 'WARNING'):
             qs.delete(force=True)
 
+    def test_deletion_triggers(self):
+        """Test the database triggers record tombstones and modified datasets and sessions."""
+        lab = Lab.objects.create(name='test_lab')
+        session = Session.objects.create(
+            subject=Subject.objects.create(nickname='foo', lab=lab), number=1, lab=lab)
+        repo = DataRepository.objects.create(name='repo')
+        dsets = [Dataset.objects.create(name=f'obj.attr{i}.npy', session=session)
+                 for i in range(3)]
+        for dset in dsets:
+            FileRecord.objects.bulk_create(
+                FileRecord(dataset=dset, data_repository=repo, relative_path=f'{dset.name}{i}')
+                for i in range(3))
+        Dataset.objects.filter(pk__in=[d.pk for d in dsets]).update(auto_datetime=None)
+        # Queryset updates of file records flag their datasets as modified
+        FileRecord.objects.filter(dataset=dsets[0]).update(exists=True)
+        FileRecord.objects.filter(dataset=dsets[1]).update(json={'foo': 'bar'})
+        modified = Dataset.objects.filter(auto_datetime__isnull=False).values_list('pk', flat=True)
+        self.assertEqual([dsets[0].pk], list(modified))
+        # File records are deleted in bulk, and their datasets flagged as modified
+        with CaptureQueriesContext(connection) as queries:
+            FileRecord.objects.filter(dataset=dsets[1]).delete()
+        self.assertEqual(1, len(queries.captured_queries))
+        self.assertIsNotNone(Dataset.objects.get(pk=dsets[1].pk).auto_datetime)
+        # Renaming the lab of a session flags the session as modified
+        Session.objects.filter(pk=session.pk).update(auto_datetime=None)
+        lab.name = 'renamed_lab'
+        lab.save()
+        self.assertIsNotNone(Session.objects.get(pk=session.pk).auto_datetime)
+        # Deleting a session records the tombstones of the session and its datasets
+        eid = session.pk
+        with CaptureQueriesContext(connection) as queries:
+            session.delete()
+        self.assertFalse(any('data_filerecord' in q['sql'] and q['sql'].startswith('SELECT')
+                             for q in queries.captured_queries))
+        tombstones = Tombstone.objects.values_list(
+            'content_type__model', 'object_id', 'session_id')
+        expected = {('dataset', d.pk, eid) for d in dsets} | {('session', eid, None)}
+        self.assertEqual(expected, set(tombstones))
+
 
 class TestDatasetTypeModel(TestCase):
     def test_model_methods(self):
@@ -86,6 +132,56 @@ class TestDatasetTypeModel(TestCase):
             with self.subTest(filename=filename):
                 self.assertEqual(get_dataset_type(filename, dtypes).name, dataname)
 
+    def test_matcher(self):
+        """Test DatasetTypeMatcher gives the same results as get_dataset_type."""
+        dtypes = [
+            {'name': 'obj.attr', 'filename_pattern': ''},
+            {'name': 'foo.bar', 'filename_pattern': '*foo.b?r*'},
+            {'name': 'spikes.times', 'filename_pattern': 'spikes.times*.*'},
+            {'name': 'times', 'filename_pattern': '*.times.*'},
+            {'name': 'trials', 'filename_pattern': '_*_trials.[!x]*.*'},
+            {'name': 'bracket', 'filename_pattern': 'x[.npy'},
+        ]
+        matcher = transfers.DatasetTypeMatcher(dtypes)
+        filenames = ('foo.bar.npy', '_ns_obj.attr_clock.extra.npy', 'spikes.times.npy',
+                     'spikes.amps.npy', 'SPIKES.timesXX.npy', '_ibl_trials.table.pqt',
+                     '_ibl_trials.xtable.pqt', 'x[.npy', 'alf/probe00/obj.attr.npy')
+        for filename in filenames:
+            with self.subTest(filename=filename):
+                try:
+                    expected = get_dataset_type(filename, dtypes)
+                except ValueError as ex:
+                    with self.assertRaises(ValueError) as cm:
+                        matcher.match(filename)
+                    self.assertEqual(str(ex), str(cm.exception))
+                else:
+                    self.assertEqual(matcher.match(filename), expected)
+
+    def test_get_dataset_type_matcher(self):
+        """Test the database matcher is cached and rebuilt when dataset types change."""
+        dtype, _ = DatasetType.objects.get_or_create(name='obj.attr')
+        matcher = transfers.get_dataset_type_matcher()
+        self.assertIs(matcher, transfers.get_dataset_type_matcher())
+        self.assertEqual(matcher.match('obj.attr.npy'), dtype)
+        # Saving a dataset type should rebuild the matcher
+        dtype.filename_pattern = 'obj.*.npy'
+        dtype.save()
+        matcher = transfers.get_dataset_type_matcher()
+        self.assertEqual(matcher.match('obj.foo.npy'), dtype)
+        with self.assertNumQueries(0):
+            self.assertIs(matcher, transfers.get_dataset_type_matcher())
+        # Changes in other processes sharing the cache change the dataset types version
+        response_cache.invalidate(DatasetType)
+        self.assertIsNot(matcher, matcher := transfers.get_dataset_type_matcher())
+        # Updates that don't send signals are loaded once the matcher expires
+        DatasetType.objects.filter(pk=dtype.pk).update(filename_pattern='obj.*.bin')
+        self.assertIs(matcher, transfers.get_dataset_type_matcher())
+        with self.settings(REGISTRATION_CACHE_TTL=0):
+            self.assertIsNot(matcher, matcher := transfers.get_dataset_type_matcher())
+        self.assertRaises(ValueError, matcher.match, 'obj.foo.npy')
+        dtype.delete()
+        self.assertEqual(transfers.get_dataset_type_matcher().matches('obj.foo.bin'), [])
+
 
 class TestRevisionModel(TestCase):
     def test_validation(self):
@@ -224,6 +320,21 @@ class TestManagementFiles(TestCase):
         return add_uuid_string(dataset.name, dataset.pk).as_posix()
 
 
+class TestBenchmarkRenderers(TestCase):
+    def test_benchmark_renderers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / 'renderers.json'
+            call_command('benchmark_renderers', synthetic=200, page_size=[10, 50], repeat=1,
+                         output=str(output), stdout=mock.MagicMock())
+            results = json.loads(output.read_text())
+        self.assertEqual([r['rows'] for r in results], [10, 50])
+        renderers = {r['renderer']: r for r in results[1]['renderers']}
+        self.assertGreaterEqual(renderers.keys(), {'json', 'orjson', 'arrow'})
+        self.assertEqual(renderers['json']['bytes'], renderers['orjson']['bytes'])
+        # The generated datasets are rolled back
+        self.assertFalse(Dataset.objects.exists())
+
+
 class TestTransfers(TestCase):
     """Tests for the data.transfers module."""
 
@@ -289,6 +400,75 @@ class TestTransfers(TestCase):
         expected = '/mnt/foo/subject/2020-01-01/001/ephysData.raw.ap.bin'
         self.assertEqual(expected, transfers._get_absolute_path(self.records[1]))
 
+    def test_check_datasets_protected(self):
+        """Test the protected status of several datasets is fetched in a single query."""
+        session = self.dsets[0].session
+        rev = Revision.objects.create(name='v1')
+        tag = Tag.objects.create(name='tag', protected=True)
+        Dataset.objects.create(name='foo.bar.baz', session=session, revision=rev,
+                               dataset_type=self.dtypes[2]).tags.add(tag)
+        files = [(None, 'foo.bar.baz'), ('', 'imaging.frames.tar.bz2'), ('alf', 'foo.bar.baz')]
+        with self.assertNumQueries(1):
+            results = transfers._check_datasets_protected(session, files)
+        expected = [(True, [{'v1': True}, {'': False}]),
+                    (False, [{'': False}]),
+                    (False, [])]
+        self.assertEqual(expected, results)
+        # Check the single-file function returns the same
+        for (collection, name), result in zip(files, results):
+            self.assertEqual(
+                result, transfers._check_dataset_protected(session, collection, name))
+
+    def test_registration_resolver(self):
+        """Test RegistrationResolver looks up each object once."""
+        session = self.dsets[0].session
+        session.start_time = datetime(2020, 1, 1)
+        session.save()
+        user = get_user_model().objects.create(username='foo')
+        resolver = transfers.RegistrationResolver()
+        path = f'{self.subjects[0].nickname}/2020-01-01/001'
+        with self.assertNumQueries(1):
+            self.assertEqual(self.subjects[0], resolver.parse_path(path)[0])
+        self.assertEqual(session, resolver.session(self.subjects[0], '2020-01-01', 1, user))
+        self.assertTrue(session.users.filter(pk=user.pk).exists())
+        with self.assertNumQueries(0):
+            resolver.parse_path(path + '/alf')
+            resolver.session(self.subjects[0], '2020-01-01', 1, user)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.labs[::-1], resolver.labs(['lab1', '', 'lab0', 'lab1']))
+            resolver.labs(['lab1', 'lab0'])
+        self.assertRaises(Lab.DoesNotExist, resolver.labs, ['lab0', 'foo'])
+        with self.assertNumQueries(4):  # get_or_create
+            rev = resolver.revision('v1')
+            self.assertIs(rev, resolver.revision('v1'))
+            self.assertIsNone(resolver.revision(''))
+        # A new resolver does not add the user to the session again
+        user.refresh_from_db()
+        with self.assertNumQueries(4):  # 2 session queries and 2 membership checks, no writes
+            transfers.RegistrationResolver().session(self.subjects[0], '2020-01-01', 1, user)
+
+    def test_table_cache(self):
+        """Test data repository and data format lookups are cached and invalidated."""
+        self.labs[0].repositories.set(DataRepository.objects.filter(name__startswith='lab0'))
+        repos = transfers._get_repositories_for_labs(self.labs[:1])
+        self.assertCountEqual(['lab0_local0', 'lab0_local1'], [dr.name for dr in repos])
+        with self.assertNumQueries(0):
+            self.assertEqual([], transfers._get_repositories_for_labs(self.labs[:1], True))
+            self.assertEqual('flatiron', transfers.get_data_repository(name='flatiron').name)
+        self.labs[0].repositories.add(DataRepository.objects.get(name='flatiron'))
+        repos = transfers._get_repositories_for_labs(self.labs[:1], server_only=True)
+        self.assertEqual(['flatiron'], [dr.name for dr in repos])
+        self.assertRaises(DataRepository.DoesNotExist, transfers.get_data_repository, 'foo')
+        # Data formats
+        DataFormat.objects.create(name='bar', file_extension='.bar')
+        self.assertEqual('bar', transfers.get_data_format('obj.attr.bar').name)
+        with self.assertNumQueries(0):
+            transfers.get_data_format('obj.attr.bar')
+        # Expired entries are reloaded
+        DataFormat.objects.filter(name='bar').update(name='baz')
+        with self.settings(REGISTRATION_CACHE_TTL=0):
+            self.assertEqual('baz', transfers.get_data_format('obj.attr.bar').name)
+
     def test_get_name_collection_revision(self):
         relative_path = PurePosixPath(self.records[0].relative_path)
         info, resp = transfers._get_name_collection_revision(
@@ -1,15 +1,27 @@
 import datetime
+import json
+from io import BytesIO, StringIO
 from pathlib import PurePosixPath
 from unittest import mock
 import uuid
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+import msgpack
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from alyx.base import BaseTests
-from data.models import Dataset, FileRecord, Download, Tag, DatasetType, DataFormat, DataNotice
-from data.views import DatasetList
+from data.management.commands.register_files_worker import claim_jobs
+from data.models import (Dataset, FileRecord, Download, Tag, DatasetType, DataFormat, DataNotice,
+                         DataRepository, RegistrationJob)
+from data.views import DatasetList, _make_dataset_responses
+from misc.management.commands.one_cache import DATASETS_SCHEMA
 from misc.models import Lab
 from subjects.models import Subject
 
@@ -214,6 +226,162 @@ class APIDataTests(BaseTests):
         response = self.ar(r, 403)
         self.assertRegex(response.get('detail') or '', 'protected')
 
+    def test_dataset_export(self):
+        data = {'dataset_type': 'dst', 'created_by': 'test', 'subject': self.subject,
+                'data_format': 'df', 'date': '2018-01-01', 'number': 2}
+        for name, collection in (('a.times.npy', 'alf'), ('b.times.npy', 'raw')):
+            self.ar(self.post(reverse('dataset-list'),
+                              {**data, 'name': name, 'collection': collection}), 201)
+        dset = Dataset.objects.get(name='a.times.npy')
+        # Only files on server repositories count towards the exists column
+        repo = DataRepository.objects.get(name='dr')
+        repo.globus_is_personal = False
+        repo.save()
+        FileRecord.objects.create(dataset=dset, exists=True, relative_path='alf/a.times.npy',
+                                  data_repository=repo)
+
+        url = reverse('dataset-list') + '?collection=alf'
+        r = self.client.get(url + '&format=parquet')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'application/vnd.apache.parquet')
+        self.assertIn('datasets.parquet', r['Content-Disposition'])
+        table = pq.read_table(BytesIO(b''.join(r.streaming_content)))
+        self.assertEqual(table.schema.names, DATASETS_SCHEMA.names)
+        self.assertEqual(table['rel_path'].to_pylist(), ['alf/a.times.npy'])
+        self.assertEqual(table['id'].to_pylist(), [str(dset.pk)])
+
+        # Arrow IPC stream selected by Accept header, with all datasets
+        r = self.client.get(reverse('dataset-list'),
+                            HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+        self.assertEqual(r.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            table = pa.ipc.open_stream(b''.join(r.streaming_content)).read_all()
+        self.assertEqual(table.num_rows, 2)
+        # The datasets are streamed without aggregating the table first
+        sql = next(q['sql'] for q in queries.captured_queries if 'data_dataset' in q['sql'])
+        self.assertNotIn('GROUP BY', sql)
+        self.assertNotIn('data_tag', sql)
+        exists = dict(zip(table['rel_path'].to_pylist(), table['exists'].to_pylist()))
+        self.assertEqual(exists, {'alf/a.times.npy': True, 'raw/b.times.npy': False})
+
+        # Tag filters
+        Tag.objects.create(name='pub', public=True).datasets.add(dset)
+        r = self.client.get(reverse('dataset-list') + '?public=True&format=arrow')
+        table = pa.ipc.open_stream(b''.join(r.streaming_content)).read_all()
+        self.assertEqual(table['id'].to_pylist(), [str(dset.pk)])
+
+        # JSON responses are unaffected
+        d = self.ar(self.client.get(url))
+        self.assertEqual([x['name'] for x in d], ['a.times.npy'])
+        self.assertIs(d[0]['public'], True)
+        self.assertIs(d[0]['protected'], False)
+
+    def test_arrow_renderer(self):
+        dset = Dataset.objects.create(name='a.times.npy')
+        repo = DataRepository.objects.get(name='dr')
+        for i, exists in enumerate((True, False)):
+            FileRecord.objects.create(dataset=dset, data_repository=repo, exists=exists,
+                                      relative_path=f'{i}/a.times.npy', json={'i': i})
+        r = self.client.get(reverse('filerecord-list') + '?format=arrow&limit=1')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'application/vnd.apache.arrow.stream')
+        table = pa.ipc.open_stream(r.content).read_all()
+        # The columns are typed from the serializer fields, with the pagination in the metadata
+        self.assertEqual(table.num_rows, 1)
+        self.assertEqual(table.schema.field('exists').type, pa.bool_())
+        self.assertEqual(table.schema.field('data_repository').type, pa.string())
+        self.assertEqual(table['data_repository'].to_pylist(), ['dr'])
+        self.assertEqual(table.schema.field('json').metadata, {b'encoding': b'json'})
+        self.assertIn(json.loads(table['json'][0].as_py()), ({'i': 0}, {'i': 1}))
+        self.assertEqual(json.loads(table.schema.metadata[b'count']), 2)
+        self.assertIsNotNone(json.loads(table.schema.metadata[b'next']))
+
+        # Detail views render a single row
+        r = self.client.get(reverse('datarepository-detail', args=['dr']) + '?format=arrow')
+        table = pa.ipc.open_stream(r.content).read_all()
+        self.assertEqual(table['name'].to_pylist(), ['dr'])
+
+    def test_msgpack_renderer(self):
+        r = self.client.get(reverse('datarepository-list'), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(r.content),
+                         self.client.get(reverse('datarepository-list')).json())
+
+    def test_sparse_fieldsets(self):
+        data = {'dataset_type': 'dst', 'created_by': 'test', 'subject': self.subject,
+                'data_format': 'df', 'date': '2018-01-01', 'number': 2, 'name': 'a.times.npy'}
+        self.ar(self.post(reverse('dataset-list'), data), 201)
+        dset = Dataset.objects.get(name='a.times.npy')
+        FileRecord.objects.create(dataset=dset, data_repository=DataRepository.objects.first(),
+                                  relative_path='alf/a.times.npy')
+        dset.tags.add(Tag.objects.create(name='tag'))
+        full = self.ar(self.client.get(reverse('dataset-list')))[0]
+
+        with CaptureQueriesContext(connection) as queries:
+            d = self.ar(self.client.get(reverse('dataset-list') + '?fields=url,name,hash'))
+        self.assertEqual(d, [{k: full[k] for k in ('url', 'name', 'hash')}])
+        # Neither the related tables nor the annotations of the other fields are queried
+        sql = queries.captured_queries[-1]['sql']
+        self.assertEqual(sql.count('JOIN'), 0, sql)
+        self.assertFalse(any('data_filerecord' in q['sql'] for q in queries.captured_queries))
+
+        with CaptureQueriesContext(connection) as queries:
+            d = self.ar(self.client.get(reverse('dataset-list') + '?omit=file_records,tags'))
+        self.assertEqual(d, [{k: v for k, v in full.items() if k not in ('file_records', 'tags')}])
+        self.assertFalse(any('data_filerecord' in q['sql'] for q in queries.captured_queries))
+        self.assertEqual(full['tags'], ['tag'])
+
+        r = self.client.get(reverse('dataset-list') + '?fields=name,foo')
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('foo', str(r.data))
+
+    def test_cursor_pagination(self):
+        t0 = datetime.datetime(2020, 1, 1)
+        # Ties on the creation time and datasets without one are paginated by primary key
+        created = [t0, t0, t0 + datetime.timedelta(days=1), t0 + datetime.timedelta(days=2),
+                   t0 + datetime.timedelta(days=2), None, None]
+        dsets = [Dataset.objects.create(name=f'cursor{i}.npy', created_datetime=t)
+                 for i, t in enumerate(created)]
+        Dataset.objects.filter(created_datetime__isnull=True).update(created_datetime=None)
+        repo = DataRepository.objects.get(name='dr')
+        for i, dset in enumerate(dsets):
+            FileRecord.objects.create(dataset=dset, data_repository=repo,
+                                      relative_path=f'cursor{i}.npy')
+
+        def crawl(url):
+            pages = []
+            while url:
+                r = self.client.get(url)
+                self.assertEqual(r.status_code, 200)
+                self.assertNotIn('count', r.data)
+                pages.append(r.data)
+                url = r.data['next']
+            return pages
+
+        pages = crawl(reverse('dataset-list') + '?cursor=&limit=3')
+        self.assertEqual([len(p['results']) for p in pages], [3, 3, 1])
+        self.assertIsNone(pages[0]['previous'])
+        names = [d['name'] for p in pages for d in p['results']]
+        self.assertCountEqual(names, [d.name for d in dsets])
+        # Datasets without a creation time first, then in creation order
+        dates = [d['created_datetime'] for p in pages for d in p['results']]
+        self.assertEqual(dates[:2], [None, None])
+        self.assertEqual(dates[2:], sorted(dates[2:]))
+        # The previous links return the same pages
+        for page, previous in zip(pages[1:], pages):
+            self.assertEqual(self.ar(self.client.get(page['previous'])), previous['results'])
+        self.assertEqual(self.client.get(pages[1]['previous']).data['previous'], None)
+
+        # Models without a cursor field are paginated by primary key
+        pages = crawl(reverse('filerecord-list') + '?cursor=&limit=2')
+        paths = [f['relative_path'] for p in pages for f in p['results']]
+        expected = FileRecord.objects.order_by('pk').values_list('relative_path', flat=True)
+        self.assertEqual(paths, list(expected))
+
+        r = self.client.get(reverse('dataset-list') + '?cursor=foo')
+        self.assertEqual(r.status_code, 404)
+
     def test_dataset_date_filter(self):
         # create 2 datasets with different dates
         data = {
@@ -482,6 +650,206 @@ class APIDataTests(BaseTests):
         expected = {'dra2', 'dra1', 'drb2', 'drb1'}
         self.assertEqual(expected, set(x['data_repository'] for x in r.data[0]['file_records']))
 
+    def test_register_files_bulk(self):
+        """Test the set-based registration gives the same results as the default one."""
+        self.post(reverse('datarepository-list'), {'name': 'dra1', 'hostname': 'hosta1'})
+        self.post(reverse('datarepository-list'), {'name': 'dra2', 'hostname': 'hosta2'})
+        self.post(reverse('lab-list'), {'name': 'laba', 'repositories': ['dra1', 'dra2']})
+        data = {'path': f'{self.subject}/2018-01-01/2/dir',
+                'filenames': 'a.a.e1,#v1#/a.b.e1,a.c.e2',
+                'name': 'dr',
+                'labs': 'laba',
+                'hashes': 'aa,bb,cc',
+                'filesizes': '1,2,3',
+                'qc': 'PASS'}
+        default = self.ar(self.post(reverse('register-file'), data), 201)
+        Dataset.objects.all().delete()
+        data['bulk'] = True
+        bulk = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertEqual(len(default), len(bulk))
+        ignore = ('id', 'created_datetime', 'file_records')
+        for d0, d1 in zip(default, bulk):
+            self.assertEqual({k: v for k, v in d0.items() if k not in ignore},
+                             {k: v for k, v in d1.items() if k not in ignore})
+            self.assertCountEqual([(fr['data_repository'], fr['relative_path'], fr['exists'])
+                                   for fr in d0['file_records']],
+                                  [(fr['data_repository'], fr['relative_path'], fr['exists'])
+                                   for fr in d1['file_records']])
+        self.assertEqual(3, Dataset.objects.count())
+        self.assertEqual(9, FileRecord.objects.count())
+
+        # Re-registering with a different hash patches the file records
+        FileRecord.objects.update(exists=True)
+        data.update(filenames='a.a.e1', hashes='dd', filesizes='4', exists=False)
+        d, = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertEqual(d['id'], bulk[0]['id'])
+        self.assertEqual(4, d['file_size'])
+        self.assertFalse(any(fr['exists'] for fr in d['file_records']))
+        # The same hash does not
+        FileRecord.objects.update(exists=True)
+        d, = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertTrue(all(fr['exists'] for fr in d['file_records']))
+
+        # A new revision becomes the default
+        data.update(filenames='#v1#/a.a.e1', hashes='ee', default=True)
+        d, = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertTrue(d['default'])
+        self.assertFalse(Dataset.objects.get(pk=bulk[0]['id']).default_dataset)
+
+        # An invalid file fails the whole batch without writing anything
+        n = Dataset.objects.count()
+        data.update(filenames='a.d.e1,a.c.x:y.e1', hashes='ff,gg', filesizes='1,2')
+        r = self.post(reverse('register-file'), data)
+        self.assertEqual(400, r.status_code, r.data)
+        self.assertRegex(r.data['detail'], 'Invalid file record')
+        self.assertEqual(n, Dataset.objects.count())
+        data.update(filenames='a.d.e1,a.c.e1', qc='foo')
+        r = self.post(reverse('register-file'), data)
+        self.assertEqual(400, r.status_code, r.data)
+        self.assertEqual(n, Dataset.objects.count())
+
+        # Protected datasets cannot be patched
+        tag = Tag.objects.create(name='protected_tag', protected=True)
+        Dataset.objects.get(pk=bulk[2]['id']).tags.add(tag)
+        data.update(filenames='a.d.e1,a.c.e2', qc='PASS')
+        r = self.post(reverse('register-file'), data)
+        self.assertEqual(403, r.status_code, r.data)
+        self.assertEqual(r.data['detail'], f'Dataset {bulk[2]["id"]} is protected, cannot patch')
+        self.assertEqual(n, Dataset.objects.count())
+
+        # A file record created concurrently for another dataset fails the batch, rather than
+        # being taken over
+        record = FileRecord.objects.filter(dataset=bulk[0]['id']).first()
+        relative_path = record.relative_path.replace('a.a.e1', 'a.d.e1')
+        FileRecord.objects.create(dataset_id=bulk[1]['id'], data_repository=record.data_repository,
+                                  relative_path=relative_path)
+        data.update(filenames='a.d.e1', hashes='hh', filesizes='1')
+        # Not found when validating, as if created afterwards
+        with mock.patch.object(FileRecord.objects, 'select_for_update',
+                               return_value=FileRecord.objects.none()):
+            r = self.post(reverse('register-file'), data)
+        self.assertEqual(400, r.status_code, r.data)
+        self.assertRegex(r.data['detail'], f'"{relative_path}" already exists')
+        self.assertEqual(n, Dataset.objects.count())
+        self.assertEqual(FileRecord.objects.get(relative_path=relative_path).dataset_id,
+                         bulk[1]['id'])
+
+    def test_make_dataset_responses(self):
+        """Test the registration response is built with a fixed number of queries."""
+        self.post(reverse('datarepository-list'), {'name': 'drb1', 'hostname': 'hostb1'})
+        self.post(reverse('lab-list'), {'name': 'labb', 'repositories': ['drb1']})
+        data = {'path': f'{self.subject}/2018-01-01/2/dir',
+                'filenames': 'a.a.e1,#v1#/a.b.e1,a.c.e2',
+                'name': 'drb1',
+                'labs': 'labb'}
+        r = self.ar(self.post(reverse('register-file'), data), 201)
+        pks = [d['id'] for d in r]
+        with self.assertNumQueries(3) as ctx:
+            out = _make_dataset_responses(pks)
+        self.assertEqual(r, out)
+        with self.assertNumQueries(len(ctx.captured_queries)):
+            out = _make_dataset_responses(pks[:1])
+        self.assertEqual(r[:1], out)
+
+    def test_register_files_async(self):
+        """Test registration requests queued with the async flag."""
+        self.post(reverse('datarepository-list'), {'name': 'drc1', 'hostname': 'hostc1'})
+        self.post(reverse('lab-list'), {'name': 'labc', 'repositories': ['drc1']})
+        data = {'path': f'{self.subject}/2018-01-01/2/dir',
+                'filenames': 'a.a.e1,#v1#/a.b.e1,a.c.e2',
+                'name': 'drc1',
+                'labs': 'labc',
+                'hashes': 'aa,bb,cc',
+                'async': True}
+        r = self.ar(self.post(reverse('register-file'), data), 202)
+        self.assertEqual('Waiting', r['status'])
+        self.assertFalse(Dataset.objects.filter(name='a.a.e1').exists())
+        # Request level errors are returned immediately
+        r_err = self.post(reverse('register-file'), {**data, 'labs': 'foo'})
+        self.assertEqual(400, r_err.status_code)
+
+        call_command('register_files_worker', once=True, batch_size=2, stdout=StringIO())
+        job = self.ar(self.client.get(r['url']))
+        self.assertEqual('Complete', job['status'])
+        self.assertEqual(3, job['n_files'])
+        self.assertEqual(3, job['n_done'])
+        self.assertIsNone(job['error'])
+        self.assertEqual(['a.a.e1', 'a.b.e1', 'a.c.e2'], [d['name'] for d in job['results']])
+        self.assertEqual(['aa', 'bb', 'cc'],
+                         list(Dataset.objects.filter(pk__in=[d['id'] for d in job['results']])
+                              .order_by('name').values_list('hash', flat=True)))
+
+        # Errors while registering are reported in the job
+        data['filenames'] = 'a.a.e1,a.d.nope'
+        r = self.ar(self.post(reverse('register-file'), data), 202)
+        call_command('register_files_worker', once=True, batch_size=1, stdout=StringIO())
+        job = self.ar(self.client.get(r['url']))
+        self.assertEqual('Errored', job['status'])
+        self.assertEqual(1, job['n_done'])
+        self.assertEqual(500, job['error']['status_code'])
+
+        # Jobs left started by a crashed worker are claimed again once they make no progress
+        data['filenames'] = 'a.a.e1,a.b.e1'
+        r = self.ar(self.post(reverse('register-file'), data), 202)
+        stalled = timezone.now() - datetime.timedelta(hours=1)
+        jobs = RegistrationJob.objects.filter(pk=r['id'])
+        jobs.update(status=RegistrationJob.STATUS.STARTED, start_time=stalled, heartbeat=stalled,
+                    attempts=1)
+        self.assertEqual([], claim_jobs(1, timeout=7200))
+        call_command('register_files_worker', once=True, timeout=60, stdout=StringIO())
+        job = jobs.get()
+        self.assertEqual(RegistrationJob.STATUS.COMPLETE, job.status)
+        self.assertEqual((2, 2, stalled), (job.n_done, job.attempts, job.start_time))
+        # Jobs that stall too many times are marked as errored
+        jobs.update(status=RegistrationJob.STATUS.STARTED, heartbeat=stalled, attempts=3)
+        self.assertEqual([], claim_jobs(1, timeout=60, max_attempts=3))
+        job = jobs.get()
+        self.assertEqual(RegistrationJob.STATUS.ERRORED, job.status)
+        self.assertIn('no progress', job.error['detail'])
+
+    def test_register_files_stream(self):
+        """Test registering files from an NDJSON manifest."""
+        self.post(reverse('datarepository-list'), {'name': 'drd1', 'hostname': 'hostd1'})
+        self.post(reverse('lab-list'), {'name': 'labd', 'repositories': ['drd1']})
+        header = {'path': f'{self.subject}/2018-01-01/2/dir', 'name': 'drd1', 'labs': 'labd',
+                  'batch_size': 2}
+        files = [{'filename': 'a.a.e1', 'hash': 'aa', 'filesize': 1},
+                 {'filename': '#v1#/a.b.e1', 'qc': 'PASS'},
+                 {'filename': 'a.c.e2', 'version': '1.0.0'}]
+
+        def ndjson(*lines):
+            return ''.join(json.dumps(line) + '\n' for line in lines)
+
+        r = self.client.post(reverse('register-file-stream'), data=ndjson(header, *files),
+                             content_type='application/x-ndjson')
+        self.assertEqual(200, r.status_code)
+        out = [json.loads(line) for line in b''.join(r.streaming_content).splitlines()]
+        self.assertEqual(['a.a.e1', 'a.b.e1', 'a.c.e2'], [d['name'] for d in out])
+        self.assertEqual(['v1'], [d['revision'] for d in out if d['revision']])
+        dsets = Dataset.objects.filter(pk__in=[d['id'] for d in out]).order_by('name')
+        self.assertEqual([('aa', 1, 0), ('', None, 10), ('', None, 0)],
+                         list(dsets.values_list('hash', 'file_size', 'qc')))
+        self.assertEqual('1.0.0', dsets.last().version)
+
+        # Invalid request fields are returned before streaming
+        r = self.client.post(reverse('register-file-stream'),
+                             data=ndjson({**header, 'labs': 'foo'}, *files),
+                             content_type='application/x-ndjson')
+        self.assertEqual(400, r.status_code)
+        r = self.client.post(reverse('register-file-stream'), data='foo\n',
+                             content_type='application/x-ndjson')
+        self.assertEqual(400, r.status_code)
+
+        # Registration stops at the first invalid line
+        r = self.client.post(reverse('register-file-stream'),
+                             data=ndjson(header, files[0], {'hash': 'bb'}, files[2]),
+                             content_type='application/x-ndjson')
+        out = [json.loads(line) for line in b''.join(r.streaming_content).splitlines()]
+        self.assertEqual(2, len(out))
+        self.assertEqual('a.a.e1', out[0]['name'])
+        self.assertEqual(400, out[1]['status_code'])
+        self.assertIn('Line 3', out[1]['detail'])
+
     def test_register_files_hostname(self):
         # this is old use case where we register one dataset according to the hostname, no need
         # for a lab in this case. NB the reverse doesn't work with lists while the true endpoint
@@ -4,22 +4,30 @@ import os
 import os.path as op
 import re
 import time
+from fnmatch import fnmatch
 from pathlib import Path, PurePosixPath, PurePath
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import Case, When, Count, Q, F
+from django.db import IntegrityError, transaction
+from django.db.models import Case, When, Count, Exists, OuterRef, Q, F
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils import timezone
 import globus_sdk
 import numpy as np
-from one.alf.path import add_uuid_string, folder_parts
-from one.registration import get_dataset_type
-from one.alf.spec import QC, regex, COLLECTION_SPEC
+from iblutil.util import Bunch
+from one.alf.path import add_uuid_string, folder_parts, ensure_alf_path
+from one.registration import get_dataset_type  # noqa: F401
+from one.alf.spec import QC, regex, COLLECTION_SPEC, is_valid
 from one.remote.globus import Globus, DEFAULT_PAR
 
-from data.models import FileRecord, Dataset, DatasetType, DataFormat, DataRepository
+from alyx.response_cache import connect_invalidation, model_versions
+from data.models import (FileRecord, Dataset, DatasetType, DataFormat, DataRepository, Revision,
+                         link_session_objects)
 from rest_framework.response import Response
 from actions.models import Session
+from misc.models import Lab
 from subjects.models import Subject
 
 logger = logging.getLogger(__name__)
@@ -139,25 +147,296 @@ def globus_file_exists(file_record):
     return False
 
 
+class _TableCache:
+    """
+    A process-level cache of a small, near-static table.
+
+    The table is reloaded at most every `ttl` seconds (see the REGISTRATION_CACHE_TTL setting),
+    and as soon as a row is saved or deleted in this process.
+
+    :param load: a function returning the cached value
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._value, self._time = None, 0.
+
+    def get(self):
+        ttl = getattr(settings, 'REGISTRATION_CACHE_TTL', 60)
+        if self._value is None or time.monotonic() - self._time > ttl:
+            self._value, self._time = self._load(), time.monotonic()
+        return self._value
+
+    def invalidate(self, *args, **kwargs):
+        self._value = None
+
+
+def _load_data_formats():
+    data_formats = {}
+    for df in DataFormat.objects.all():
+        data_formats.setdefault(df.file_extension, []).append(df)
+    return data_formats
+
+
+def _load_data_repositories():
+    repos = list(DataRepository.objects.all())
+    by_id = {dr.pk: dr for dr in repos}
+    by_lab = {}
+    for lab_id, repo_id in Lab.repositories.through.objects.values_list(
+            'lab_id', 'datarepository_id'):
+        by_lab.setdefault(lab_id, []).append(by_id[repo_id])
+    return repos, by_lab
+
+
+_data_formats = _TableCache(_load_data_formats)
+_data_repositories = _TableCache(_load_data_repositories)
+post_save.connect(_data_formats.invalidate, sender=DataFormat)
+post_delete.connect(_data_formats.invalidate, sender=DataFormat)
+post_save.connect(_data_repositories.invalidate, sender=DataRepository)
+post_delete.connect(_data_repositories.invalidate, sender=DataRepository)
+m2m_changed.connect(_data_repositories.invalidate, sender=Lab.repositories.through)
+
+
 def get_data_format(filename):
     file_extension = op.splitext(filename)[-1]
+    data_formats = _data_formats.get().get(file_extension, ())
+    if len(data_formats) == 1:
+        return data_formats[0]
     # This raises an error if there is 0 or 2+ matching data formats.
     return DataFormat.objects.get(file_extension=file_extension)
 
 
+def get_data_repository(name=None, hostname=None):
+    """Return a data repository by name or by hostname, using the cached repository table.
+
+    :param name: the repository name
+    :param hostname: the repository hostname, used if name is None
+    :return: a DataRepository
+    :raises DataRepository.DoesNotExist: if no repository matches
+    """
+    field, value = ('name', name) if name else ('hostname', hostname)
+    repos = [dr for dr in _data_repositories.get()[0] if getattr(dr, field) == value]
+    if len(repos) == 1:
+        return repos[0]
+    # This raises an error if there is 0 or 2+ matching repositories.
+    return DataRepository.objects.get(**{field: value})
+
+
+class DatasetTypeMatcher:
+    """
+    Match filenames to dataset types using a compiled index of all filename patterns.
+
+    This gives the same result as `one.registration.get_dataset_type` but each file is matched
+    with a dictionary lookup (for dataset types without a filename pattern) and a couple of regex
+    calls per bucket of patterns sharing the same first character, instead of testing every
+    dataset type in turn. Each bucket is compiled into a single alternation in both orders: the
+    forward match returns the first matching pattern and the reverse match the last one, so a
+    filename matches several patterns if and only if they differ.
+
+    :param dtypes: an iterable of dataset types (or dicts) with 'name' and 'filename_pattern'
+    """
+
+    def __init__(self, dtypes):
+        self.dtypes = [Bunch(x) if isinstance(x, dict) else x for x in dtypes]
+        self._by_name = {}
+        buckets = {}
+        for dt in self.dtypes:
+            pattern = (dt.filename_pattern or '').strip().casefold()
+            if not pattern:
+                self._by_name.setdefault(dt.name, []).append(dt)
+            else:
+                key = '' if pattern[0] in '*?[' else pattern[0]
+                buckets.setdefault(key, []).append((_translate_glob(pattern), dt))
+        self._buckets = {}
+        for key, items in buckets.items():
+            regexes = [r for r, _ in items]
+            self._buckets[key] = (
+                [dt for _, dt in items],
+                re.compile('|'.join(f'({r})' for r in regexes), re.DOTALL),
+                re.compile('|'.join(f'({r})' for r in reversed(regexes)), re.DOTALL),
+            )
+
+    def matches(self, filename):
+        """Return all dataset types matching filename, in the order they were passed in.
+
+        :param filename: a filename or file path
+        :return: a list of matching dataset types
+        """
+        filename = ensure_alf_path(filename)
+        if is_valid(filename.name):
+            obj_attr = '.'.join(filename.dataset_name_parts[1:3])
+        else:  # will match name against filename sans extension
+            obj_attr = filename.stem
+        found = list(self._by_name.get(obj_attr, []))
+        name = filename.name.casefold()
+        for key in {name[:1], ''}:
+            if key not in self._buckets:
+                continue
+            dtypes, forward, backward = self._buckets[key]
+            if not (m := forward.fullmatch(name)):
+                continue
+            first, last = m.lastindex - 1, len(dtypes) - backward.fullmatch(name).lastindex
+            if first == last:
+                found.append(dtypes[first])
+            else:  # rare: scan the bucket to report every match
+                found.extend(dt for dt in dtypes[first:last + 1]
+                             if fnmatch(name, dt.filename_pattern.casefold()))
+        if len(found) > 1:
+            order = {id(dt): i for i, dt in enumerate(self.dtypes)}
+            found.sort(key=lambda dt: order[id(dt)])
+        return found
+
+    def match(self, filename):
+        """Return the dataset type matching filename.
+
+        :param filename: a filename or file path
+        :return: the matching dataset type
+        :raises ValueError: if filename matches no dataset types or matches several
+        """
+        dataset_types = self.matches(filename)
+        if len(dataset_types) == 0:
+            raise ValueError(f'No dataset type found for filename "{PurePath(filename).name}"')
+        elif len(dataset_types) >= 2:
+            raise ValueError('Multiple matching dataset types found for filename '
+                             f'"{PurePath(filename).name}": \n'
+                             f'{", ".join(map(str, dataset_types))}')
+        return dataset_types[0]
+
+
+def _translate_glob(pattern):
+    """Translate a glob pattern to a regular expression without capturing groups.
+
+    Unlike `fnmatch.translate`, the result can be wrapped in a group and combined with others.
+    """
+    i, n, out = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:  # unterminated set is a literal bracket
+                out.append('\\[')
+                continue
+            stuff = pattern[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if stuff[0] == '!':
+                stuff = '^' + stuff[1:]
+            elif stuff[0] in ('^', '['):
+                stuff = '\\' + stuff
+            out.append(f'[{stuff}]')
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+_dataset_type_matcher = None
+
+
+def get_dataset_type_matcher():
+    """Return a DatasetTypeMatcher for all dataset types in the database.
+
+    The matcher is built once per process and rebuilt when the dataset types version in the
+    cache changes, i.e. when a dataset type is saved or deleted by any process sharing the cache
+    (see alyx.response_cache), and at most every REGISTRATION_CACHE_TTL seconds otherwise.
+    Lookups don't query the database.
+
+    :return: a DatasetTypeMatcher instance
+    """
+    global _dataset_type_matcher
+    version, = model_versions([DatasetType])
+    ttl = getattr(settings, 'REGISTRATION_CACHE_TTL', 60)
+    if (_dataset_type_matcher is None or _dataset_type_matcher[0] != version
+            or time.monotonic() - _dataset_type_matcher[1] > ttl):
+        matcher = DatasetTypeMatcher(DatasetType.objects.all())
+        _dataset_type_matcher = (version, time.monotonic(), matcher)
+    return _dataset_type_matcher[2]
+
+
+connect_invalidation(DatasetType)
+
+
 def _get_repositories_for_labs(labs, server_only=False):
     # List of data repositories associated to the subject's labs.
+    by_lab = _data_repositories.get()[1]
     repositories = set()
     for lab in labs:
+        repos = by_lab.get(lab.pk, ())
         if server_only:
-            repos = lab.repositories.filter(globus_is_personal=False)
-        else:
-            repos = lab.repositories.all()
+            repos = [dr for dr in repos if dr.globus_is_personal is False]
         repositories.update(repos)
     return list(repositories)
 
 
-def _parse_path(path):
+class RegistrationResolver:
+    """
+    Look up the objects of a registration request once per request.
+
+    Each distinct subject, session, lab set, repository set and revision is fetched on first use
+    and reused for the following files (or batches of files for the streaming and asynchronous
+    registrations).
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def _get(self, key, func, *args, **kwargs):
+        if key not in self._cache:
+            self._cache[key] = func(*args, **kwargs)
+        return self._cache[key]
+
+    def user(self, username):
+        """Return the user with the given username."""
+        return self._get(('user', username), get_user_model().objects.get, username=username)
+
+    def parse_path(self, path):
+        """Return the subject, date and number of a session path, see `_parse_path`."""
+        nickname, date, number = _parse_path(path, subject=False)
+        subject = self._get(('subject', nickname), Subject.objects.get, nickname=nickname)
+        return subject, date, number
+
+    def session(self, subject=None, date=None, number=None, user=None):
+        """Return the session, adding the user to it, see `_get_session`."""
+        key = ('session', getattr(subject, 'pk', None), date, number, getattr(user, 'pk', None))
+        return self._get(key, _get_session, subject=subject, date=date, number=number, user=user)
+
+    def labs(self, names):
+        """Return the labs with the given names.
+
+        :raises Lab.DoesNotExist: if any of the labs does not exist
+        """
+        names = tuple(dict.fromkeys(filter(None, names)))
+        return self._get(('labs', names), self._get_labs, names)
+
+    @staticmethod
+    def _get_labs(names):
+        labs = {lab.name: lab for lab in Lab.objects.filter(name__in=names)}
+        if len(labs) != len(names):
+            raise Lab.DoesNotExist('One or more of the specified labs do not exist.')
+        return [labs[name] for name in names]
+
+    def repositories(self, labs, server_only=False):
+        """Return the repositories of the labs, see `_get_repositories_for_labs`."""
+        key = ('repositories', tuple(lab.pk for lab in labs), server_only)
+        return list(self._get(key, _get_repositories_for_labs, labs, server_only=server_only))
+
+    def revision(self, name):
+        """Return the revision with the given name, creating it if it doesn't exist."""
+        if not name:
+            return None
+        return self._get(('revision', name), lambda: Revision.objects.get_or_create(name=name)[0])
+
+
+def _parse_path(path, subject=True):
     pattern = regex(spec='{subject}/{date}/{number}').pattern + '.*'
     m = re.match(pattern, path)
     if not m:
@@ -166,8 +445,9 @@ def _parse_path(path):
     nickname = m.group('subject')
     session_number = int(m.group('number'))
     # An error is raised if the subject or data repository do not exist.
-    subject = Subject.objects.get(nickname=nickname)
-    return subject, date, session_number
+    if subject:
+        nickname = Subject.objects.get(nickname=nickname)
+    return nickname, date, session_number
 
 
 def _get_name_collection_revision(file, rel_dir_path):
@@ -253,26 +533,42 @@ def _change_default_dataset(session, collection, filename, **kwargs):
         session=session, collection=collection or '',
         name=filename, default_dataset=True, **kwargs)
     if dataset.count() > 0:
-        dataset.update(default_dataset=False)
+        dataset.update(default_dataset=False, auto_datetime=timezone.now())
 
 
 def _check_dataset_protected(session, collection, filename, **kwargs):
+    return _check_datasets_protected(session, [(collection, filename)], **kwargs)[0]
+
+
+def _check_datasets_protected(session, files, **kwargs):
+    """Check whether any revisions of a list of datasets are protected.
+
+    The protected status of all files is fetched with a single query.
+
+    :param session: the session of the datasets (None for aggregate datasets)
+    :param files: a list of (collection, filename) tuples
+    :param kwargs: extra dataset filters, e.g. content_type and object_id
+    :return: a list of (protected, protected_info) tuples, one per file, where protected is True
+     if any revision is protected and protected_info is a list of {revision name: protected}
+     dicts ordered by the latest revision with the original one last
+    """
+    files = [(collection or '', filename) for collection, filename in files]
+    protected_tags = Dataset.tags.through.objects.filter(
+        dataset=OuterRef('pk'), tag__protected=True)
     # Order datasets by the latest revision with the original one last
-    dataset = (
+    datasets = (
         Dataset
         .objects
-        .filter(
-            session=session, collection=collection or '', name=filename, **kwargs)
-        .order_by(
-            F('revision__created_datetime')
-        .desc(nulls_last=True)))
-    if dataset.count() == 0:
-        return False, []
-    else:
-        protected = any(d.is_protected for d in dataset)
-        protected_info = [{d.revision.name if d.revision else '': d.is_protected}
-                          for d in dataset]
-        return protected, protected_info
+        .filter(session=session, collection__in={c for c, _ in files},
+                name__in={f for _, f in files}, **kwargs)
+        .annotate(protected=Exists(protected_tags))
+        .order_by(F('revision__created_datetime').desc(nulls_last=True))
+        .values_list('collection', 'name', 'revision__name', 'protected'))
+    info = {}
+    for collection, name, revision, protected in datasets:
+        info.setdefault((collection, name), []).append({revision or '': protected})
+    return [(any(v for d in info.get(key, []) for v in d.values()), info.get(key, []))
+            for key in files]
 
 
 def _create_dataset_file_records(
@@ -284,7 +580,7 @@ def _create_dataset_file_records(
     collection = collection or ''
     revision_name = f'#{revision.name}#' if revision else ''
     relative_path = PurePosixPath(rel_dir_path, collection, revision_name, filename)
-    dataset_type = get_dataset_type(filename, DatasetType.objects.all())
+    dataset_type = get_dataset_type_matcher().match(filename)
     data_format = get_data_format(filename)
     assert dataset_type
     assert data_format
@@ -376,6 +672,187 @@ def _create_dataset_file_records(
     return dataset, None
 
 
+def _bulk_create_dataset_file_records(
+        files, session=None, user=None, repositories=None, exists_in=None, default=None,
+        content_type=None, object_id=None):
+    """
+    Set-based equivalent of `_create_dataset_file_records` for a batch of files.
+
+    The whole batch is validated in memory against the existing datasets, and against the existing
+    file records, which are locked, then written in the same transaction with a handful of bulk
+    statements.  File records created concurrently for other datasets are reported as for
+    `_create_dataset_file_records`, with nothing written.  The files are processed
+    in order so that default flags, patching and error responses are the same as when calling
+    `_create_dataset_file_records` in a loop, except that nothing is written if any file fails.
+
+    :param files: a list of dicts with keys ('rel_dir_path', 'collection', 'filename',
+     'revision', 'hash', 'file_size', 'version', 'qc'), where revision is a Revision or None
+    :param session: the Session the datasets belong to (None for aggregate datasets)
+    :param user: the user to set as the datasets' creator
+    :param repositories: the data repositories in which to create file records
+    :param exists_in: the repositories in which the files exist
+    :param default: if True the datasets are set as the default revision
+    :param content_type: the ContentType of the object of an aggregate dataset
+    :param object_id: the UUID of the object of an aggregate dataset
+    :return: a tuple of the list of datasets, one per file, and None; or None and a REST
+     Response object if the registration is invalid
+    """
+    assert session or all([content_type, object_id])
+    repositories = list(repositories or ())
+    exists_in = exists_in or ()
+    now = timezone.now()
+    dataset_types = get_dataset_type_matcher()
+    owner = {'session': session, 'content_type': content_type, 'object_id': object_id}
+
+    def _key(collection, name, revision, dataset_type, data_format):
+        return collection, name, getattr(revision, 'pk', None), dataset_type.pk, data_format.pk
+
+    # Fetch all candidate datasets and their protected status in two queries
+    names = {f['filename'] for f in files}
+    existing = {}
+    for d in Dataset.objects.filter(name__in=names, **owner):
+        existing.setdefault(
+            (d.collection, d.name, d.revision_id, d.dataset_type_id, d.data_format_id), d)
+    protected = set(
+        Dataset.tags.through.objects
+        .filter(dataset__in=[d.pk for d in existing.values()], tag__protected=True)
+        .values_list('dataset_id', flat=True))
+
+    # Validate each file in the order of the loop implementation, keeping track of each
+    # dataset's patched state
+    fk_fields = [f.name for f in Dataset._meta.fields if f.is_relation]
+    datasets, patched = [], []
+    for f in files:
+        collection = f['collection'] or ''
+        revision = f['revision']
+        revision_name = f'#{revision.name}#' if revision else ''
+        relative_path = PurePosixPath(f['rel_dir_path'], collection, revision_name, f['filename'])
+        dataset_type = dataset_types.match(f['filename'])
+        data_format = get_data_format(f['filename'])
+        assert dataset_type
+        assert data_format
+
+        key = _key(collection, f['filename'], revision, dataset_type, data_format)
+        if is_new := key not in existing:
+            existing[key] = Dataset(
+                collection=collection, name=f['filename'], dataset_type=dataset_type,
+                data_format=data_format, revision=revision, **owner)
+        dataset = existing[key]
+        try:
+            qc = int(QC.validate(f['qc'] or 'NOT_SET'))
+        except ValueError:
+            data = {'status_code': 400,
+                    'detail': f'Invalid QC value "{f["qc"]}" for dataset "{relative_path}"'}
+            return None, Response(data=data, status=400)
+        if not is_new and dataset.pk in protected:
+            data = {'status_code': 403,
+                    'detail': 'Dataset ' + str(dataset.pk) + ' is protected, cannot patch'}
+            return None, Response(data=data, status=403)
+        dataset.default_dataset = default is True
+        dataset.qc = qc
+        dataset.created_by = user
+        if f['version']:
+            dataset.version = f['version']
+        is_patched = True
+        if f['hash']:
+            if dataset.hash:
+                is_patched = dataset.hash != f['hash']
+            dataset.hash = f['hash']
+        if f['file_size'] is not None:
+            dataset.file_size = f['file_size']
+        # Related fields were resolved above so only the field values need validating
+        try:
+            dataset.full_clean(exclude=fk_fields, validate_unique=False,
+                               validate_constraints=False)
+        except ValidationError as e:
+            data = {'status_code': 400,
+                    'detail': f'Invalid dataset "{relative_path}": {e}'}
+            return None, Response(data=data, status=400)
+        datasets.append(dataset)
+        patched.append((dataset, relative_path.as_posix(), is_new or is_patched))
+
+    # Only the last of the batch datasets with a given collection and name may be the default
+    unique_datasets = list({d.pk: d for d in datasets}.values())
+    if default:
+        last = {(d.collection, d.name): d for d in datasets}
+        for d in unique_datasets:
+            d.default_dataset = last[(d.collection, d.name)] is d
+
+    def _conflict(relative_path, repo):
+        data = {'status_code': 400,
+                'detail': (f'A file record for "{relative_path}" already exists on '
+                           f'repository "{repo.name}" for a different dataset.')}
+        return None, Response(data=data, status=400)
+
+    paths = {p for _, p, _ in patched}
+    fr_fk_fields = [f.name for f in FileRecord._meta.fields if f.is_relation]
+    try:
+        with transaction.atomic():
+            # Validate the file records against those already in the selected repositories,
+            # locking them until the batch is written
+            file_records = {
+                (fr.data_repository_id, fr.relative_path): fr for fr in
+                FileRecord.objects.select_for_update().filter(
+                    data_repository__in=repositories, relative_path__in=paths)}
+            to_create, to_update = {}, {}
+            for dataset, relative_path, is_patched in patched:
+                for repo in repositories:
+                    fr = file_records.get((repo.pk, relative_path))
+                    if fr is not None and fr.dataset_id != dataset.pk:
+                        return _conflict(relative_path, repo)
+                    if is_new := fr is None:
+                        fr = file_records[(repo.pk, relative_path)] = FileRecord(
+                            dataset=dataset, data_repository=repo, relative_path=relative_path)
+                        to_create[(repo.pk, relative_path)] = fr
+                    if is_new or is_patched:
+                        fr.exists = repo in exists_in
+                        # this is important if a dataset is patched during an ongoing transfer
+                        fr.json = None
+                        if not is_new:
+                            to_update[(repo.pk, relative_path)] = fr
+                    try:
+                        fr.full_clean(exclude=fr_fk_fields, validate_unique=False,
+                                      validate_constraints=False)
+                    except ValidationError as e:
+                        data = {'status_code': 400,
+                                'detail': f'Invalid file record "{relative_path}": {e}'}
+                        return None, Response(data=data, status=400)
+
+            if default:
+                # Unset the default flag of other revisions of these datasets
+                pairs = {(d.collection, d.name) for d in unique_datasets}
+                others = (Dataset.objects
+                          .filter(name__in=names, default_dataset=True, **owner)
+                          .exclude(pk__in=[d.pk for d in unique_datasets])
+                          .values_list('pk', 'collection', 'name'))
+                others = [pk for pk, *pair in others if tuple(pair) in pairs]
+                if others:
+                    Dataset.objects.filter(pk__in=others).update(
+                        default_dataset=False, auto_datetime=now)
+            for d in unique_datasets:
+                d.auto_datetime = now
+            Dataset.objects.bulk_create(
+                unique_datasets, update_conflicts=True, unique_fields=['id'],
+                update_fields=['default_dataset', 'qc', 'created_by', 'version', 'hash',
+                               'file_size', 'auto_datetime'])
+            # NB: Records inserted concurrently since the validation raise an IntegrityError
+            # rather than being taken over
+            FileRecord.objects.bulk_create(to_create.values())
+            FileRecord.objects.bulk_update(to_update.values(), ['exists', 'json'])
+            link_session_objects(unique_datasets)
+    except IntegrityError:
+        # Nothing was written; report the first record created concurrently for another dataset
+        for fr in FileRecord.objects.filter(
+                data_repository__in=repositories, relative_path__in=paths).select_related(
+                'data_repository'):
+            new = to_create.get((fr.data_repository_id, fr.relative_path))
+            if new is not None and fr.dataset_id != new.dataset_id:
+                return _conflict(fr.relative_path, fr.data_repository)
+        raise
+
+    return datasets, None
+
+
 def iter_registered_directories(data_repository=None, tc=None, path=None):
     """Iterater over pairs (globus dir path, [list of files]) in any directory that
     contains session.metadat.json."""
@@ -685,7 +1162,7 @@ def _get_session(subject=None, date=None, number=None, user=None):
     # Ensure a base session for that subject and date exists.
     if not base:
         raise ValueError("A base session for %s on %s does not exist" % (subject, date))
-    if user and user not in base.users.all():
+    if user and not base.users.filter(pk=user.pk).exists():
         base.users.add(user.pk)
         base.save()
     # If a subsession for that subject, date, and expNum already exists, use it;
@@ -694,7 +1171,7 @@ def _get_session(subject=None, date=None, number=None, user=None):
     # Ensure the subsession exists.
     if not session:
         raise ValueError("A session for %s/%d on %s does not exist" % (subject, number, date))
-    if user and user not in session.users.all():
+    if user and not session.users.filter(pk=user.pk).exists():
         session.users.add(user.pk)
         session.save()
     # Attach the subsession to the base session if not already attached.
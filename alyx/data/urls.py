@@ -6,6 +6,10 @@ register_file = dv.RegisterFileViewSet.as_view({
     'post': 'create'
 })
 
+register_file_stream = dv.RegisterFileViewSet.as_view({
+    'post': 'stream'
+})
+
 sync_file_status = dv.SyncViewSet.as_view({
     'post': 'sync',
     'get': 'sync_status'
@@ -84,6 +88,12 @@ urlpatterns = [
     path('register-file', register_file,
          name="register-file"),
 
+    path('register-file/stream', register_file_stream,
+         name="register-file-stream"),
+
+    path('register-file/jobs/<uuid:pk>', dv.RegistrationJobDetail.as_view(),
+         name="registrationjob-detail"),
+
     path('sync-file-status', sync_file_status,
          name="sync-file-status"),
 
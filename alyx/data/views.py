@@ -1,3 +1,4 @@
+import json
 import logging
 
 from django.contrib.auth import get_user_model
@@ -5,14 +6,19 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import Exists, OuterRef
+from django.http import StreamingHttpResponse
 from rest_framework import generics, viewsets, mixins, serializers
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder as DRFJSONEncoder
 import django_filters
 from django_filters import rest_framework as filters
 
 from iblutil.util import ensure_list
 
 from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.renderers import TableExportMixin
+from alyx.response_cache import CachedResponseMixin
 from experiments.models import ProbeInsertion
 from subjects.models import Subject, Project
 from misc.models import Lab
@@ -26,7 +32,9 @@ from .models import (DataRepositoryType,
                      new_download,
                      Revision,
                      Tag,
-                     DataNotice
+                     DataNotice,
+                     RegistrationJob,
+                     defer_session_links
                      )
 from .serializers import (DataRepositoryTypeSerializer,
                           DataRepositorySerializer,
@@ -37,14 +45,20 @@ from .serializers import (DataRepositoryTypeSerializer,
                           FileRecordSerializer,
                           RevisionSerializer,
                           TagSerializer,
-                          DataNoticeSerializer
+                          DataNoticeSerializer,
+                          RegistrationJobSerializer
                           )
-from .transfers import (_get_session, _parse_path, _get_repositories_for_labs, bulk_sync,
-                        _check_dataset_protected, _get_name_collection_revision,
-                        get_aggregate_collection_revision, _create_dataset_file_records)
+from .transfers import (_get_session, _parse_path, RegistrationResolver, get_data_repository,
+                        bulk_sync,
+                        _check_datasets_protected, _get_name_collection_revision,
+                        get_aggregate_collection_revision, _create_dataset_file_records,
+                        _bulk_create_dataset_file_records)
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of files registered per batch by the streaming register-file endpoint
+STREAM_BATCH_SIZE = 500
+
 # DataRepositoryType
 # ------------------------------------------------------------------------------------------------
 
@@ -65,7 +79,8 @@ class DataRepositoryTypeDetail(generics.RetrieveUpdateDestroyAPIView):
 
 # DataRepository
 # ------------------------------------------------------------------------------------------------
-class DataRepositoryList(generics.ListCreateAPIView):
+class DataRepositoryList(CachedResponseMixin, generics.ListCreateAPIView):
+    cache_models = (DataRepository, DataRepositoryType)
     queryset = DataRepository.objects.all()
     serializer_class = DataRepositorySerializer
     permission_classes = rest_permission_classes()
@@ -83,7 +98,7 @@ class DataRepositoryDetail(generics.RetrieveUpdateDestroyAPIView):
 # DataFormat
 # ------------------------------------------------------------------------------------------------
 
-class DataFormatList(generics.ListCreateAPIView):
+class DataFormatList(CachedResponseMixin, generics.ListCreateAPIView):
     queryset = DataFormat.objects.all()
     serializer_class = DataFormatSerializer
     permission_classes = rest_permission_classes()
@@ -100,7 +115,7 @@ class DataFormatDetail(generics.RetrieveUpdateDestroyAPIView):
 # DatasetType
 # ------------------------------------------------------------------------------------------------
 
-class DatasetTypeList(generics.ListCreateAPIView):
+class DatasetTypeList(CachedResponseMixin, generics.ListCreateAPIView):
     queryset = DatasetType.objects.all()
     serializer_class = DatasetTypeSerializer
     permission_classes = rest_permission_classes()
@@ -131,7 +146,7 @@ class RevisionDetail(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'name'
 
 
-class TagList(generics.ListCreateAPIView):
+class TagList(CachedResponseMixin, generics.ListCreateAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = rest_permission_classes()
@@ -252,19 +267,15 @@ class DatasetFilter(BaseFilterSet):
         return dsets
 
     def filter_public(self, dsets, name, value):
-        if value:
-            return dsets.filter(tags__public=True).distinct()
-        else:
-            return dsets.exclude(tags__public=True)
+        public = Exists(Tag.objects.filter(datasets=OuterRef('pk'), public=True))
+        return dsets.filter(public) if value else dsets.exclude(public)
 
     def filter_protected(self, dsets, name, value):
-        if value:
-            return dsets.filter(tags__protected=True).distinct()
-        else:
-            return dsets.exclude(tags__protected=True)
+        protected = Exists(Tag.objects.filter(datasets=OuterRef('pk'), protected=True))
+        return dsets.filter(protected) if value else dsets.exclude(protected)
 
 
-class DatasetList(generics.ListCreateAPIView):
+class DatasetList(TableExportMixin, generics.ListCreateAPIView):
     """
     get: **FILTERS**
     -   **subject**: subject nickname: `/datasets?subject=Algernon`
@@ -283,13 +294,43 @@ class DatasetList(generics.ListCreateAPIView):
     -   **protected**: only returns datasets that are protected or not protected
     -   **qc**: only returns datasets with this QC value `/datasets?qc=PASS`
 
+    **EXPORT**: `/datasets?format=parquet` or `/datasets?format=arrow` (or an Accept header of
+    `application/vnd.apache.parquet` or `application/vnd.apache.arrow.stream`) returns all
+    filtered datasets with a session as a ONE cache datasets table, without pagination
+
+    **CURSOR**: `/datasets?cursor=&limit=1000` pages through the datasets in creation order with
+    keyset pagination, following the `next` links, without a count
+
+    **FIELDS**: `/datasets?fields=url,name,hash` returns only these fields and
+    `/datasets?omit=file_records,tags` all fields but these; the related tables of the other
+    fields aren't queried
+
     [===> dataset model reference](/admin/doc/models/data.dataset)
     """
     queryset = Dataset.objects.all()
-    queryset = DatasetSerializer.setup_eager_loading(queryset)
     serializer_class = DatasetSerializer
     permission_classes = rest_permission_classes()
     filterset_class = DatasetFilter
+    export_name = 'datasets'
+    cursor_field = 'created_datetime'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return self.serializer_class.setup_eager_loading(queryset, self.request)
+
+    def get_export_queryset(self):
+        # Without the serializer's joins and annotations, which would have the whole table
+        # aggregated and sorted before the first batch is streamed
+        return Dataset.objects.select_related(None)
+
+    def table_batches(self, queryset, batch_size):
+        from misc.management.commands.one_cache import DATASETS_SCHEMA, iter_dataset_batches
+        # As for the exists filter, a dataset exists if a file exists on a server repository
+        on_server = FileRecord.objects.filter(
+            dataset=OuterRef('pk'), exists=True, data_repository__globus_is_personal=False)
+        queryset = queryset.filter(session__isnull=False).annotate(file_exists=Exists(on_server))
+        batches = iter_dataset_batches(queryset, batch_size, exists_field='file_exists')
+        return DATASETS_SCHEMA, batches
 
 
 class DatasetDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -346,10 +387,27 @@ class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
 # Register file
 # ------------------------------------------------------------------------------------------------
 
-def _make_dataset_response(dataset):
-    if not dataset:
-        return None
+def _make_dataset_responses(datasets):
+    """Build the register-file response for a list of datasets.
 
+    All related objects are fetched with a single query and a handful of prefetches, regardless
+    of the number of datasets.
+
+    :param datasets: a list of Dataset objects or primary keys
+    :return: a list of response dicts, in the same order as datasets
+    """
+    pks = [getattr(d, 'pk', d) for d in datasets]
+    queryset = (
+        Dataset.objects
+        .filter(pk__in=pks)
+        .select_related('session__subject', 'created_by', 'dataset_type', 'data_format',
+                        'revision', 'content_type')
+        .prefetch_related('file_records__data_repository', 'session__users', 'content_object'))
+    by_pk = {d.pk: d for d in queryset}
+    return [_dataset_response(by_pk[pk]) for pk in pks]
+
+
+def _dataset_response(dataset):
     # Return the file records.
     file_records = [
         {
@@ -358,7 +416,7 @@ def _make_dataset_response(dataset):
             'relative_path': fr.relative_path,
             'exists': fr.exists,
         }
-        for fr in FileRecord.objects.filter(dataset=dataset)]
+        for fr in dataset.file_records.all()]
 
     subject = None
     if dataset.session:
@@ -487,13 +545,13 @@ class ProtectedFileViewSet(mixins.ListModelMixin,
             dataset_path_parsed, resp = _get_name_collection_revision(filenames, rel_dir_path)
             if resp:
                 return resp
-        # Loop through the files to see if any are protected
+        # Check whether any of the files are protected
         prot_response = []
         protected = []
-        for file, info in zip(filenames, dataset_path_parsed):
-            prot, prot_info = _check_dataset_protected(
-                session, info['collection'], info['filename'],
-                content_type=content_type, object_id=object_id)
+        results = _check_datasets_protected(
+            session, [(info['collection'], info['filename']) for info in dataset_path_parsed],
+            content_type=content_type, object_id=object_id)
+        for file, (prot, prot_info) in zip(filenames, results):
             protected.append(prot)
             prot_response.append({file: prot_info})
         if any(protected):
@@ -545,6 +603,10 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
               whether to set current one as the default
               'check_protected: False # optional, defaults to False, before attempting to register
               datasets checks if any are protected
+              'bulk': False  # optional, defaults to False, validate all files before writing them
+              # in a single transaction; nothing is registered if any of the files is invalid
+              'async': False  # optional, defaults to False, queue the registration and return
+              # 202 with a job id; the job status is at /register-file/jobs/<id>
               }
         ```
 
@@ -567,82 +629,95 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
         If the dataset already exists, it will use the file hash to deduce if the file has been
         patched or not (i.e. the filerecords will be created as not existing)
         """
-        user = request.data.get('created_by', None)
-        if user:
-            user = get_user_model().objects.get(username=user)
-        else:
-            user = request.user
+        return self.register(request.data, request.user)
+
+    def register(self, data, user, resolver=None):
+        """
+        Register the datasets and file records of a register-file request.
+
+        :param data: the request data, see `create`
+        :param user: the requesting user, used if 'created_by' is not in data
+        :param resolver: a RegistrationResolver to reuse between requests for the same session
+        :return: a REST Response object
+        """
+        resolver = resolver or RegistrationResolver()
+        username = data.get('created_by', None)
+        if username:
+            user = resolver.user(username)
 
         # get the concerned repository using the name/hostname combination
-        name = request.data.get('name', None)
-        hostname = request.data.get('hostname', None)
+        name = data.get('name', None)
+        hostname = data.get('hostname', None)
         repo = None
         try:
-            if name:
-                repo = DataRepository.objects.get(name=name)
-            elif hostname:
-                repo = DataRepository.objects.get(hostname=hostname)
+            if name or hostname:
+                repo = get_data_repository(name=name, hostname=hostname)
         except DataRepository.DoesNotExist:
             data = {'status_code': 400, 'detail': 'The specified repository does not exist.'}
             return Response(data=data, status=400)
 
         exists_in = (repo,)
 
-        rel_dir_path = request.data.get('path', '')
+        rel_dir_path = data.get('path', '')
         if not rel_dir_path:
             raise ValueError("The path argument is required.")
         rel_dir_path = rel_dir_path.replace('\\', '/')
         rel_dir_path = rel_dir_path.replace('//', '/').strip('/')
 
-        filenames = request.data.get('filenames', ())
+        filenames = data.get('filenames', ())
         if isinstance(filenames, str):
             filenames = filenames.split(',')
         filenames = list(filter(None, filenames))  # Remove empty strings
 
         # versions if provided
-        versions = request.data.get('versions', [None] * len(filenames))
+        versions = data.get('versions', [None] * len(filenames))
         if isinstance(versions, str):
             versions = versions.split(',')
             if len(versions) == 1:
                 versions = versions * len(filenames)
 
         # file hashes if provided
-        hashes = request.data.get('hashes', [None] * len(filenames))
+        hashes = data.get('hashes', [None] * len(filenames))
         if isinstance(hashes, str):
             hashes = hashes.split(',')
 
         # file sizes if provided
-        filesizes = request.data.get('filesizes', [None] * len(filenames))
+        filesizes = data.get('filesizes', [None] * len(filenames))
         if isinstance(filesizes, str):
             filesizes = filesizes.split(',')
         filesizes = [int(f) if f is not None else None for f in ensure_list(filesizes)]
 
         # qc if provided
-        qcs = request.data.get('qc', [None] * len(filenames)) or 'NOT_SET'
+        qcs = data.get('qc', [None] * len(filenames)) or 'NOT_SET'
         if isinstance(qcs, str):
             qcs = qcs.split(',')
             if len(qcs) == 1:
                 qcs = qcs * len(filenames)
 
         # flag to discard file records creation on local repositories, defaults to False
-        server_only = request.data.get('server_only', False)
+        server_only = data.get('server_only', False)
         if isinstance(server_only, str):
             server_only = server_only == 'True'
 
-        default = request.data.get('default', True)
+        default = data.get('default', True)
         # Need to explicitly cast string to a bool
         if isinstance(default, str):
             default = default == 'True'
 
-        check_protected = request.data.get('check_protected', False)
+        check_protected = data.get('check_protected', False)
         # Need to explicitly cast string to a bool
         if isinstance(check_protected, str):
             check_protected = check_protected == 'True'
 
+        bulk = data.get('bulk', False)
+        # Need to explicitly cast string to a bool
+        if isinstance(bulk, str):
+            bulk = bulk == 'True'
+
         # If the content type and object id are provided, we skip the session retrieval;
         # The dataset is associated to a different model than actions.Session
-        content_type = request.data.get('content_type', None)
-        object_id = request.data.get('object_id', None)
+        content_type = data.get('content_type', None)
+        object_id = data.get('object_id', None)
         if content_type and object_id:
             # Aggregate dataset
             try:
@@ -675,7 +750,7 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
         else:
             # Extract the session from the directory path.
             try:
-                subject, date, session_number = _parse_path(rel_dir_path)
+                subject, date, session_number = resolver.parse_path(rel_dir_path)
             except ValueError as e:
                 data = {'status_code': 400, 'error': str(e)}
                 return Response(data=data, status=400)
@@ -684,7 +759,7 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
                 data = {'status_code': 400, 'error': err}
                 return Response(data=data, status=400)
             try:
-                session = _get_session(
+                session = resolver.session(
                     subject=subject, date=date, number=session_number, user=user)
             except ValueError as e:
                 data = {'status_code': 400, 'error': str(e)}
@@ -695,19 +770,19 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
                 return resp
 
             # Multiple labs (NB: projects is an alias of labs)
-            labs = request.data.get('labs', [])
+            labs = data.get('labs', [])
             if isinstance(labs, str):
                 labs = labs.split(',')
-            projects = request.data.get('projects', [])
+            projects = data.get('projects', [])
             if isinstance(projects, str):
                 projects = projects.split(',')
             try:
-                labs = [Lab.objects.get(name=lab) for lab in labs + projects if lab]
+                labs = resolver.labs(labs + projects)
             except Lab.DoesNotExist:
                 data = {'status_code': 400, 'detail': 'One or more of the specified labs do not exist.'}
                 return Response(data=data, status=400)
 
-            repositories = _get_repositories_for_labs(labs or [subject.lab], server_only=server_only)
+            repositories = resolver.repositories(labs or [subject.lab], server_only=server_only)
 
         if repo and repo not in repositories:
             repositories += [repo]
@@ -715,21 +790,21 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
             exists_in = repositories
 
         # # If exists is specified to be false then we set the exists_in back to None
-        exists = request.data.get('exists', True)
+        exists = data.get('exists', True)
         # Need to explicitly cast string to a bool
         if isinstance(exists, str):
             exists = exists == 'True'
         if not exists:
             exists_in = (None,)
 
-        # If the check protected flag is True, loop through the files to see if any are protected
+        # If the check protected flag is True, check whether any of the files are protected
         if check_protected:
             prot_response = []
             protected = []
-            for file, info in zip(filenames, dataset_path_parsed):
-                prot, prot_info = _check_dataset_protected(
-                    session, info['collection'], info['filename'],
-                    content_type=content_type, object_id=object_id)
+            results = _check_datasets_protected(
+                session, [(info['collection'], info['filename']) for info in dataset_path_parsed],
+                content_type=content_type, object_id=object_id)
+            for file, (prot, prot_info) in zip(filenames, results):
                 protected.append(prot)
                 prot_response.append({file: prot_info})
 
@@ -739,25 +814,149 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
                         'details': prot_response}
                 return Response(data=data, status=403)
 
-        response = []
-        all_info = zip(dataset_path_parsed, hashes, filesizes, versions, qcs)
-        for info, hash, fsize, version, qc in all_info:
-            if info['revision']:
-                revision, _ = Revision.objects.get_or_create(name=info['revision'])
-            else:
-                revision = None
-
-            dataset, resp = _create_dataset_file_records(
-                collection=info['collection'], rel_dir_path=info['rel_dir_path'],
-                filename=info['filename'], session=session, user=user, repositories=repositories,
-                exists_in=exists_in, hash=hash or '', file_size=fsize, version=version or '',
-                revision=revision, default=default, qc=qc, content_type=content_type, object_id=object_id)
+        run_async = data.get('async', False)
+        # Need to explicitly cast string to a bool
+        if isinstance(run_async, str):
+            run_async = run_async == 'True'
+        if run_async:
+            # Store the parsed request to be registered by the register_files_worker command
+            payload = {k: data.get(k) for k in data if k != 'async'}
+            payload.update({
+                'created_by': user.username, 'filenames': filenames, 'hashes': hashes,
+                'filesizes': filesizes, 'versions': versions, 'qc': qcs})
+            job = RegistrationJob.objects.create(
+                created_by=user, payload=payload, n_files=len(filenames))
+            data = {'status_code': 202, 'id': job.pk, 'status': job.get_status_display(),
+                    'url': reverse('registrationjob-detail', kwargs={'pk': job.pk},
+                                   request=self.request)}
+            return Response(data=data, status=202)
+
+        if bulk:
+            revisions = {info['revision']: resolver.revision(info['revision'])
+                         for info in dataset_path_parsed}
+            files = [
+                {'rel_dir_path': info['rel_dir_path'], 'collection': info['collection'],
+                 'filename': info['filename'], 'revision': revisions.get(info['revision']),
+                 'hash': hash or '', 'file_size': fsize, 'version': version or '', 'qc': qc}
+                for info, hash, fsize, version, qc in
+                zip(dataset_path_parsed, hashes, filesizes, versions, qcs)]
+            datasets, resp = _bulk_create_dataset_file_records(
+                files, session=session, user=user, repositories=repositories,
+                exists_in=exists_in, default=default, content_type=content_type,
+                object_id=object_id)
             if resp:
                 return resp
-            out = _make_dataset_response(dataset)
-            response.append(out)
+            return Response(_make_dataset_responses(datasets), status=201)
+
+        datasets = []
+        all_info = zip(dataset_path_parsed, hashes, filesizes, versions, qcs)
+        # Link the datasets to probe insertions and fields of view once all are saved
+        with defer_session_links():
+            for info, hash, fsize, version, qc in all_info:
+                revision = resolver.revision(info['revision'])
+                dataset, resp = _create_dataset_file_records(
+                    collection=info['collection'], rel_dir_path=info['rel_dir_path'],
+                    filename=info['filename'], session=session, user=user,
+                    repositories=repositories, exists_in=exists_in, hash=hash or '',
+                    file_size=fsize, version=version or '', revision=revision, default=default,
+                    qc=qc, content_type=content_type, object_id=object_id)
+                if resp:
+                    return resp
+                datasets.append(dataset)
+
+        return Response(_make_dataset_responses(datasets), status=201)
+
+    def stream(self, request):
+        """
+        Endpoint to register files from a newline-delimited JSON (NDJSON) manifest.
+
+        The first line holds the fields of the register-file request except for the per-file
+        lists, plus an optional batch size. Each following line describes one file:
 
-        return Response(response, status=201)
+        ```
+        {"path": "ZM_1085/2019-02-12/002", "name": "repository_name_alyx", "batch_size": 500}
+        {"filename": "alf/obj.attr.ext", "hash": "f9c26e42", "filesize": 145684}
+        {"filename": "alf/#2024-01-01#/obj.attr.ext", "version": "1.4.4", "qc": "PASS"}
+        ```
+
+        The request fields are validated before the files are read. Files are then read and
+        registered in batches and the response streams back one line per file as each batch is
+        registered. If a line is invalid or a batch fails, an error line with a 'status_code' key
+        is returned and the remaining lines are not registered.
+        """
+        lines = iter(request.stream or ())
+        try:
+            header = json.loads(next(lines, b'') or '{}')
+        except ValueError:
+            header = None
+        if not isinstance(header, dict):
+            data = {'status_code': 400, 'detail': 'The first line must be a JSON object.'}
+            return Response(data=data, status=400)
+        header.pop('async', None)
+        batch_size = min(int(header.pop('batch_size', None) or STREAM_BATCH_SIZE),
+                         STREAM_BATCH_SIZE)
+        for key in ('filenames', 'hashes', 'filesizes', 'versions', 'qc'):
+            header.pop(key, None)
+        # Validate the request fields (repository, session, labs, etc.) before streaming
+        resolver = RegistrationResolver()
+        resp = self.register({**header, 'filenames': []}, request.user, resolver)
+        if resp.status_code != 201:
+            return resp
+        user = request.user
+
+        def _register(batch):
+            data = {**header,
+                    'filenames': [f['filename'] for f in batch],
+                    'hashes': [f.get('hash') for f in batch],
+                    'filesizes': [f.get('filesize') for f in batch],
+                    'versions': [f.get('version') for f in batch],
+                    'qc': [f.get('qc') for f in batch]}
+            try:
+                resp = self.register(data, user, resolver)
+            except Exception as ex:
+                logger.exception('Streaming registration failed')
+                resp = Response({'status_code': 500, 'detail': str(ex)}, status=500)
+            if resp.status_code != 201:
+                return [resp.data], False
+            return resp.data, True
+
+        def _dump(out):
+            return (json.dumps(d, cls=DRFJSONEncoder) + '\n' for d in out)
+
+        def _results():
+            batch = []
+            for i, line in enumerate(lines, start=2):
+                if not line.strip():
+                    continue
+                try:
+                    file = json.loads(line)
+                except ValueError:
+                    file = None
+                if not (isinstance(file, dict) and file.get('filename')):
+                    # Register the previous lines before returning the error
+                    out, ok = _register(batch) if batch else ([], True)
+                    if ok:
+                        detail = f'Line {i} must be a JSON object with a "filename" field.'
+                        out.append({'status_code': 400, 'detail': detail})
+                    yield from _dump(out)
+                    return
+                batch.append(file)
+                if len(batch) == batch_size:
+                    (out, ok), batch = _register(batch), []
+                    yield from _dump(out)
+                    if not ok:
+                        return
+            if batch:
+                yield from _dump(_register(batch)[0])
+
+        return StreamingHttpResponse(_results(), content_type='application/x-ndjson')
+
+
+class RegistrationJobDetail(generics.RetrieveAPIView):
+    """Progress and per-file results of a register-file request queued with 'async'."""
+    queryset = RegistrationJob.objects.select_related('created_by').defer('payload')
+    serializer_class = RegistrationJobSerializer
+    permission_classes = rest_permission_classes()
 
 
 class SyncViewSet(viewsets.GenericViewSet):
@@ -9,7 +9,7 @@ from mptt.admin import MPTTModelAdmin
 from experiments.models import (TrajectoryEstimate, ProbeInsertion, ProbeModel, CoordinateSystem,
                                 BrainRegion, Channel, ChronicInsertion, FOV, FOVLocation)
 from misc.admin import NoteInline
-from alyx.base import BaseAdmin
+from alyx.base import BaseAdmin, EstimatedCountPaginator
 
 
 class TrajectoryEstimateInline(TabularInline):
@@ -82,6 +82,7 @@ class ChannelAdmin(BaseAdmin):
     list_display = ['trajectory_estimate', 'x', 'y', 'z', 'brain_region', 'axial', 'lateral']
     search_fields = ('trajectory_estimate__pk',)
     readonly_fields = ['trajectory_estimate', 'brain_region']
+    paginator = EstimatedCountPaginator
 
 
 class TrajectoryEstimateAdmin(BaseAdmin):
@@ -1,6 +1,6 @@
 from django.db.models import Prefetch
 from rest_framework import serializers
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsetMixin
 from actions.models import Session
 from experiments.models import (ProbeInsertion, TrajectoryEstimate, ProbeModel, CoordinateSystem,
                                 Channel, BrainRegion, ChronicInsertion, FOV, FOVLocation,
@@ -119,13 +119,21 @@ class ChronicProbeInsertionListSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'model', 'serial', 'session_info')
 
 
-class ProbeInsertionListSerializer(serializers.ModelSerializer):
+class ProbeInsertionListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
-    @staticmethod
-    def setup_eager_loading(queryset):
-        """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related('model', 'session', 'session__subject', 'session__lab')
-        queryset = queryset.prefetch_related('session__projects', 'datasets')
+    field_loading = {
+        'model': {'select_related': ('model',)},
+        'session': {'select_related': ('session',)},
+        # SessionListSerializer uses these related tables
+        'session_info': {'select_related': ('session', 'session__subject', 'session__lab'),
+                         'prefetch_related': ('session__projects',)},
+        'datasets': {'prefetch_related': ('datasets',)},
+        'json': {'columns': ('json',)},
+    }
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, request=None):
+        queryset = super().setup_eager_loading(queryset, request)
         return queryset.order_by('-session__start_time', 'name')
 
     session = serializers.SlugRelatedField(
@@ -1,12 +1,14 @@
+from io import StringIO
 from random import choice, randint, random
 
 from django.db import transaction
 from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
 
 from alyx.base import BaseTests
 from actions.models import Session
 from experiments.models import ProbeInsertion, ImagingType, FOV, FOVLocation, ImagingStack
-from data.models import Dataset
+from data.models import Dataset, defer_session_links
 
 
 class EphysModels(BaseTests):
@@ -23,6 +25,31 @@ class EphysModels(BaseTests):
         assert pi.datasets.all().count() == 1
 
 
+    def test_link_session_objects(self):
+        """Test datasets are linked to probe insertions and FOVs in bulk."""
+        ses = Session.objects.first()
+        pi = ProbeInsertion.objects.create(session=ses, name='probe01')
+        typ, _ = ImagingType.objects.get_or_create(name='two-photon')
+        fov = FOV.objects.create(session=ses, imaging_type=typ, name='probe01')
+        # Datasets saved within the context are linked once on exit
+        with defer_session_links():
+            dsets = [Dataset.objects.create(session=ses, name=f'{x}.npy', collection=collection)
+                     for x, collection in (('a', 'alf/probe01'), ('b', 'alf/probe01/ks2'),
+                                           ('c', 'alf'), ('d', 'alf/probe02'))]
+            self.assertEqual(0, pi.datasets.count())
+        self.assertCountEqual(dsets[:2], pi.datasets.all())
+        self.assertCountEqual(dsets[:2], fov.datasets.all())
+        # Relinking replaces the links of datasets with a matching object
+        pi.datasets.add(dsets[3])
+        pi.datasets.through.objects.filter(dataset=dsets[0]).delete()
+        out = StringIO()
+        call_command('relink_datasets', session=[str(ses.pk)], stdout=out)
+        self.assertIn('2 probe insertion', out.getvalue())
+        self.assertCountEqual([dsets[0], dsets[1], dsets[3]], pi.datasets.all())
+        with self.assertRaises(CommandError):
+            call_command('relink_datasets')
+
+
 class ImagingModels(BaseTests):
     def test_create_fov(self):
         ses = Session.objects.first()
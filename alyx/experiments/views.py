@@ -7,6 +7,7 @@ from django.db.models import Count, Q
 
 
 from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.response_cache import CachedResponseMixin
 from experiments.models import (ProbeInsertion, TrajectoryEstimate, Channel, BrainRegion,
                                 ChronicInsertion, FOV, FOVLocation, ImagingStack)
 from experiments.serializers import (ProbeInsertionListSerializer, ProbeInsertionDetailSerializer,
@@ -157,14 +158,20 @@ class ProbeInsertionList(generics.ListCreateAPIView):
     -   **atlas_id**: returns a session if any of its channels id matches the
      provided value: `/insertions?atlas_id=950`, cf Allen CCFv2017
 
+    **FIELDS**: `/insertions?fields=id,name,session` returns only these fields and
+    `/insertions?omit=session_info,json` all fields but these
+
     [===> probe insertion model reference](/admin/doc/models/experiments.probeinsertion)
     """
     queryset = ProbeInsertion.objects.all()
-    queryset = ProbeInsertionListSerializer.setup_eager_loading(queryset)
     serializer_class = ProbeInsertionListSerializer
     permission_classes = rest_permission_classes()
     filterset_class = ProbeInsertionFilter
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return self.serializer_class.setup_eager_loading(queryset, self.request)
+
 
 class ProbeInsertionDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = ProbeInsertion.objects.all()
@@ -341,7 +348,7 @@ class BrainRegionFilter(BaseFilterSet):
         return r.get_ancestors(include_self=True).exclude(pk=0)
 
 
-class BrainRegionList(generics.ListAPIView):
+class BrainRegionList(CachedResponseMixin, generics.ListAPIView):
     """
     get: **FILTERS**
 
@@ -4,7 +4,7 @@ from django_admin_listfilter_dropdown.filters import (
     DropdownFilter, ChoiceDropdownFilter, RelatedDropdownFilter)
 
 from jobs.models import Task
-from alyx.base import BaseAdmin, get_admin_url
+from alyx.base import BaseAdmin, EstimatedCountPaginator, get_admin_url
 
 
 class TaskAdmin(BaseAdmin):
@@ -22,6 +22,7 @@ class TaskAdmin(BaseAdmin):
                    ('session__lab', RelatedDropdownFilter),
                    ('session__users', RelatedDropdownFilter),
                    ]
+    paginator = EstimatedCountPaginator
 
     def has_change_permission(self, request, obj=None):
         if request.user.is_superuser:
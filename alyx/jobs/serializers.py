@@ -2,10 +2,10 @@ from rest_framework import serializers
 from actions.models import Session
 from jobs.models import Task
 from data.models import DataRepository
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsetMixin
 
 
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     parents = serializers.SlugRelatedField(
         read_only=False, required=False, slug_field='id', many=True,
         queryset=Task.objects.all(),
@@ -20,6 +20,13 @@ class TaskSerializer(serializers.ModelSerializer):
     )
     status = BaseSerializerEnumField(required=False)
 
+    field_loading = {
+        'parents': {'prefetch_related': ('parents',)},
+        'session': {'select_related': ('session',)},
+        'data_repository': {'select_related': ('data_repository',)},
+        'log': {'columns': ('log',)},
+    }
+
     class Meta:
         model = Task
         fields = '__all__'
@@ -95,6 +95,9 @@ class TaskList(generics.ListCreateAPIView):
     -   **lab**: lab name from session table `/jobs?lab=churchlandlab`
     -   **pipeline**: pipeline field from task `/jobs?pipeline=ephys`
 
+    **FIELDS**: `/tasks?fields=id,name,status` returns only these fields and `/tasks?omit=log`
+    all fields but these
+
     [===> task model reference](/admin/doc/models/jobs.task)
     """
     queryset = Task.objects.all().order_by('level', '-priority', '-session__start_time')
@@ -102,6 +105,10 @@ class TaskList(generics.ListCreateAPIView):
     permission_classes = rest_permission_classes()
     filterset_class = TaskFilter
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return self.serializer_class.setup_eager_loading(queryset, self.request)
+
 
 class TaskDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = Task.objects.all()
@@ -0,0 +1,161 @@
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from misc.management.commands import one_cache
+from misc.management.commands.synthetic_db import generate_synthetic_db
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py benchmark_one_cache
+        ./manage.py benchmark_one_cache --synthetic 100000 1000000 10000000 -o benchmark.json
+    """
+    help = ("Time the ONE cache table generation, QC export and compression of both extraction "
+            "backends, optionally on generated archives of several sizes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, nargs='*', default=[],
+                            help='Benchmark with generated archives of these numbers of '
+                                 'datasets added to the database; they are rolled back '
+                                 'afterwards')
+        parser.add_argument('--datasets-per-session', type=int, default=100,
+                            help='Mean number of generated datasets per session')
+        parser.add_argument('--batch-size', type=int, default=100_000)
+        parser.add_argument('--backend', nargs='*', default=one_cache.BACKENDS,
+                            choices=one_cache.BACKENDS)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('-o', '--output',
+                            help='Save the results to this JSON file')
+
+    def handle(self, *args, **options):
+        results = {
+            'date': timezone.now().isoformat(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'batch_size': options['batch_size'], 'runs': []
+        }
+        for n_datasets in options['synthetic'] or [None]:
+            run = {'synthetic_datasets': n_datasets}
+            with transaction.atomic():
+                if n_datasets:
+                    t0 = time.perf_counter()
+                    run['generated'] = generate_synthetic_db(
+                        n_datasets, datasets_per_session=options['datasets_per_session'],
+                        seed=options['seed'])
+                    run['generate_seconds'] = time.perf_counter() - t0
+                    self.stdout.write(f'generated {n_datasets:,} datasets in '
+                                      f'{run["generate_seconds"]:.1f} s')
+                run['steps'] = self._benchmark(options['batch_size'], options['backend'])
+                transaction.set_rollback(True)
+            results['runs'].append(run)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                json.dump(results, fp, indent=1)
+
+    def _benchmark(self, batch_size, backends) -> list:
+        """
+        Time each step of the cache generation with each backend.
+
+        :param batch_size: The number of datasets to fetch at a time
+        :param backends: The extraction backends to compare
+        :return: A list of dicts with keys ('step', 'backend', 'rows', 'seconds',
+         'rows_per_second', 'peak_memory_mb')
+        """
+        steps, frames = [], {}
+        for backend in backends:
+            for name, func, kwargs in (
+                    ('generate_sessions_frame', one_cache.generate_sessions_frame, {}),
+                    ('generate_datasets_frame', one_cache.generate_datasets_frame,
+                     {'batch_size': batch_size})):
+                with self._measure(name, backend, steps) as step:
+                    frames[(name, backend)] = df = func(backend=backend, **kwargs)
+                    step['rows'] = len(df)
+        for name in ('generate_sessions_frame', 'generate_datasets_frame'):
+            expected = frames[(name, backends[0])]
+            for backend in backends[1:]:
+                pd.testing.assert_frame_equal(expected, frames[(name, backend)])
+
+        command = one_cache.Command()
+        command.metadata = one_cache.create_metadata()
+        with tempfile.TemporaryDirectory() as tmp:
+            command.dst_dir, command.compress = tmp, True
+            with command._staging():
+                to_compress = {}
+                for table in ('sessions', 'datasets'):
+                    df = frames[(f'generate_{table}_frame', backends[0])]
+                    info, filename = command._save_table(df, table)
+                    to_compress[filename] = info
+                with self._measure('_save_qc', None, steps) as step:
+                    step['rows'], filename = command._save_qc()
+                if filename is not None:
+                    to_compress[filename] = None
+                with self._measure('_compress_tables', None, steps) as step:
+                    zip_file, _ = command._compress_tables(to_compress)
+                    step['rows'] = sum(x['nrecs'] for x in to_compress.values() if x)
+                    step['bytes'] = os.path.getsize(zip_file)
+        return steps
+
+    @contextmanager
+    def _measure(self, name, backend, steps):
+        """Time a step and sample its peak memory, appending the results to the steps list."""
+        step = {'step': name, 'backend': backend}
+        with peak_memory() as memory:
+            t0 = time.perf_counter()
+            yield step
+            step['seconds'] = time.perf_counter() - t0
+        rows = step.get('rows') or 0
+        step['rows_per_second'] = rows / step['seconds'] if step['seconds'] else None
+        step['peak_memory_mb'] = memory['peak'] / 1024 ** 2
+        steps.append(step)
+        label = f'{name} ({backend})' if backend else name
+        self.stdout.write(f'{label:>31}: {rows:12,} rows in {step["seconds"]:8.2f} s '
+                          f'({step["rows_per_second"] or 0:12,.0f} rows/s, '
+                          f'peak +{step["peak_memory_mb"]:,.0f} MiB)')
+
+
+def _rss() -> int:
+    """Return the resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * _PAGE_SIZE
+    except OSError:  # Not Linux: the peak RSS of the process, which can't be reset
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def peak_memory(interval=.01):
+    """
+    Sample the resident set size of the process in a thread to record its peak increase.
+
+    Unlike tracemalloc, this includes the memory allocated by pyarrow and the database driver.
+
+    :param interval: The sampling interval in seconds
+    :return: A dict whose 'peak' value is set to the peak increase in bytes on exit
+    """
+    result, done = {'peak': 0}, threading.Event()
+    baseline = _rss()
+
+    def sample():
+        while not done.wait(interval):
+            result['peak'] = max(result['peak'], _rss() - baseline)
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        thread.join()
+        result['peak'] = max(result['peak'], _rss() - baseline)
@@ -1,38 +1,53 @@
 from time import time
-import io
+from datetime import datetime, timedelta
 import socket
 import json
 import logging
 from pathlib import Path
 import urllib.parse
-from functools import wraps
+from contextlib import contextmanager
+from functools import wraps, partial
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 from sys import getsizeof
 import zipfile
 import tempfile
 import os
 
 import numpy as np
+import django
 import pandas as pd
 import pyarrow.parquet as pq
 import pyarrow as pa
-from tqdm import tqdm
-from one.alf.cache import _metadata, SESSIONS_COLUMNS, DATASETS_COLUMNS, QC_TYPE
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from one.alf.cache import _metadata, SESSIONS_COLUMNS, QC_TYPE
 from one.alf.spec import QC
 from one.remote.aws import get_s3_virtual_host
 
 from django.db import connection
-from django.db.models import Q, Exists, OuterRef, QuerySet
-from django.core.management.base import BaseCommand
-from django.contrib.postgres.aggregates import ArrayAgg
-from django.core.paginator import Paginator
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q, F, Exists, OuterRef, QuerySet, Func, Value, TextField, Subquery
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast, Coalesce, ExtractMonth, ExtractYear, NullIf
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.postgres.aggregates import StringAgg
 
 from alyx.settings import TABLES_ROOT
 from actions.models import Session
-from data.models import Dataset, FileRecord
-from experiments.models import ProbeInsertion
+from data.models import Dataset, FileRecord, Tombstone
+from experiments.models import Channel, ProbeInsertion, TrajectoryEstimate
+from jobs.models import Task
+from subjects.models import Subject
 
 logger = logging.getLogger(__name__)
 ONE_API_VERSION = '2.10'  # Minimum compatible ONE api version
+# Changes committed up to this long after their auto_datetime was set are picked up by the
+# next incremental update
+INCREMENTAL_OVERLAP = timedelta(minutes=10)
+# Table extraction backends: Django ORM rows or PostgreSQL COPY parsed by pyarrow
+BACKENDS = ('orm', 'copy')
 
 
 def measure_time(func):
@@ -89,39 +104,130 @@ def _save(filename: str, df: pd.DataFrame, metadata: dict = None, dry=False) ->
     })
 
     if not dry:
-        parsed = urllib.parse.urlparse(filename)
-        if parsed.scheme == 's3':
-            # Filename mustn't include scheme
-            path = parsed.path[int(parsed.path.startswith('/')):]
-            pq.write_table(table, path, filesystem=_s3_filesystem())
-        elif parsed.scheme == '':
-            pq.write_table(table, filename)
-        else:
-            raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+        path, filesystem = _output_path(filename)
+        pq.write_table(table, path, filesystem=filesystem)
     return table
 
 
+def _output_path(filename: str) -> tuple:
+    """
+    Return the path and pyarrow filesystem to write a file to.
+
+    :param filename: Save location, may be local file path or S3 location (starting s3://)
+    :return: The file path without URI scheme and a FileSystem object (None for local paths)
+    """
+    parsed = urllib.parse.urlparse(filename)
+    if parsed.scheme == 's3':
+        # Filename mustn't include scheme
+        return parsed.path[int(parsed.path.startswith('/')):], _s3_filesystem()
+    elif parsed.scheme == '':
+        return filename, None
+    else:
+        raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+
+
+def _open_input_file(dst_dir: str, filename: str):
+    """
+    Open a file in the cache destination directory for reading.
+
+    :param dst_dir: The cache directory, may be local path or s3 URI starting s3://
+    :param filename: The name of the file to open
+    :return: A pyarrow input file, or None if the file does not exist
+    """
+    parsed = urllib.parse.urlparse(dst_dir)
+    if parsed.scheme == 's3':
+        fs, path = _s3_filesystem(), f'{parsed.netloc}/{parsed.path.strip("/")}/{filename}'
+    elif parsed.scheme == '':
+        fs, path = pa.fs.LocalFileSystem(), str(Path(dst_dir).absolute() / filename)
+    else:
+        raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+    if fs.get_file_info(path).type != pa.fs.FileType.File:
+        return None
+    return fs.open_input_file(path)
+
+
+def load_table(dst_dir: str, name: str) -> pa.Table:
+    """
+    Load a previously generated table from <dst_dir>/<name>.pqt or <dst_dir>/cache.zip.
+
+    :param dst_dir: The cache directory, may be local path or s3 URI starting s3://
+    :param name: The table name
+    :return: A pyarrow table, or None if the table does not exist
+    """
+    if (file := _open_input_file(dst_dir, f'{name}.pqt')) is not None:
+        with file:
+            return pq.read_table(file)
+    if (file := _open_input_file(dst_dir, 'cache.zip')) is not None:
+        with file, zipfile.ZipFile(file) as zip:
+            if f'{name}.pqt' in zip.namelist():
+                return pq.read_table(pa.BufferReader(zip.read(f'{name}.pqt')))
+    return None
+
+
+def schema_metadata(schema: pa.Schema) -> dict:
+    """Return the ONE metadata of a parquet table schema."""
+    return json.loads((schema.metadata or {}).get(b'one_metadata', b'{}'))
+
+
+def load_metadata(dst_dir: str, tables=('sessions', 'datasets')) -> dict:
+    """
+    Load the ONE metadata of the previously generated cache.
+
+    The parquet tables and the cache info file of a compressed cache may have been generated
+    separately, so the metadata with the highest cache version is returned.
+
+    :param dst_dir: The cache directory, may be local path or s3 URI starting s3://
+    :param tables: The table names whose parquet files to check for metadata
+    :return: The metadata dict, empty if no previous cache was found
+    """
+    found = [{}]
+    for name in tables:
+        if (file := _open_input_file(dst_dir, f'{name}.pqt')) is not None:
+            with file:
+                found.append(schema_metadata(pq.read_schema(file)))
+    if (file := _open_input_file(dst_dir, 'cache_info.json')) is not None:
+        with file:
+            found.append(json.loads(file.read()))
+    return max(found, key=lambda x: int(x.get('cache_version', 0)))
+
+
 class Command(BaseCommand):
     """
-    NB: When compress flag is passed, all tables are expected to fit into memory together.
+    NB: When compress flag is passed, the tables are saved to a local temporary directory before
+    being compressed to the destination.
     """
     help = "Generate ONE cache tables"
     dst_dir = None
     tables = None
     metadata = None
     compress = None
+    _staging_dir = None
 
     def add_arguments(self, parser):
         parser.add_argument('-D', '--destination', default=TABLES_ROOT,
                             help='File(s) destination, may be local path or s3 URI starting s3://')
         parser.add_argument('-t', '--tables', nargs='*', default=('sessions', 'datasets'),
-                            help="List of tables to generate")
+                            help="List of tables to generate: sessions, datasets or any of "
+                                 f"{', '.join(TABLES)}")
         parser.add_argument('--compress', action='store_true',
                             help="Save files into compressed folder")
         parser.add_argument('--tag', nargs='*',
                             help="List of tag names to filter datasets by")
         parser.add_argument('--qc', action='store_true',
                             help="Save QC fields to a JSON file")
+        parser.add_argument('--incremental', action='store_true',
+                            help="Update the previous tables with the sessions and datasets "
+                                 "modified or deleted since they were generated")
+        parser.add_argument('--partitioned', action='store_true',
+                            help="Save each table as a parquet dataset in <destination>/<table>/, "
+                                 "partitioned by lab and session year and month")
+        parser.add_argument('--all-tags', action='store_true',
+                            help="Generate the tables of every dataset tag in "
+                                 "<destination>/<tag>/")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Number of processes writing the tag tables with --all-tags")
+        parser.add_argument('--backend', choices=BACKENDS, default='orm',
+                            help="Fetch the tables through the Django ORM or PostgreSQL COPY")
 
     def handle(self, *_, **options):
         if options['verbosity'] < 1:
@@ -131,46 +237,215 @@ class Command(BaseCommand):
         self.dst_dir = options.get('destination')
         self.compress = options.get('compress')
         tables, qc = options.get('tables'), options.get('qc')
-        self.generate_tables(tables, export_qc=qc, tags=options.get('tag'))
+        partitioned = options.get('partitioned', False)
+        if partitioned and (self.compress or options.get('incremental') or
+                            options.get('all_tags')):
+            raise CommandError(
+                '--partitioned is incompatible with --compress, --incremental and --all-tags')
+        if options.get('all_tags'):
+            if options.get('tag') or options.get('incremental'):
+                raise CommandError('--all-tags is incompatible with --tag and --incremental')
+            report = self.generate_all_tag_tables(
+                tables, export_qc=qc, workers=options.get('workers', 4),
+                backend=options.get('backend', 'orm'))
+            self.stdout.write(format_timing_report(report))
+            return
+        self.generate_tables(tables, export_qc=qc, tags=options.get('tag'),
+                             incremental=options.get('incremental', False),
+                             partitioned=partitioned, backend=options.get('backend', 'orm'))
 
-    def generate_tables(self, tables, export_qc=False, **kwargs) -> list:
+    def generate_tables(self, tables, export_qc=False, incremental=False, partitioned=False,
+                        **kwargs) -> list:
         """
-        Generate and save a list of tables.  Supported tables include 'sessions' and 'datasets'.
+        Generate and save a list of tables.  Supported tables include 'sessions', 'datasets' and
+        the additional tables registered in TABLES, e.g. 'insertions', 'subjects' and 'tasks'.
+
+        Each table generation increments the 'cache_version' metadata field.  In incremental
+        mode, the previous tables are loaded from the destination and only the sessions and
+        datasets modified (or deleted) since the previous tables' 'database_timestamp' are
+        queried and merged in.  If no previous tables are found, all tables are generated.  The
+        additional tables are always generated in full.
+
         :param tables: A tuple of table names.
         :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param incremental: If true, update the previous tables instead of regenerating them.
+        :param partitioned: If true, save each table as a parquet dataset partitioned by lab and
+         session year and month, and write a manifest of the partitions to cache_info.json.
         :param kwargs: Arguments to pass to cache generation functions.
         :return: A list of paths to the saved files.
         """
+        for table in tables:
+            if table.lower() not in ('sessions', 'datasets', *TABLES):
+                raise ValueError(f'Unknown table "{table}"')
+        if incremental and kwargs.get('tags'):
+            raise ValueError('Incremental updates are not supported for tag caches')
+        # Tables modified after this time will be queried by the next incremental update
+        timestamp = timezone.now()
+        updated = [table for table in tables if table.lower() not in TABLES]
+        previous, since = self._load_previous(updated) if incremental and updated else ({}, None)
+        if since is None:
+            previous_metadata = load_metadata(self.dst_dir, tables)
+        else:
+            previous_metadata = schema_metadata(next(iter(previous.values())).schema)
+            deleted = get_deleted(since)
         self.metadata = create_metadata()
+        self.metadata['cache_version'] = int(previous_metadata.get('cache_version', 0)) + 1
+        self.metadata['database_timestamp'] = timestamp.isoformat()
         if kwargs.get('tags'):
             self.metadata['database_tags'] = kwargs.get('tags')
-        to_compress = {}
-        dry = self.compress
-        for table in tables:
-            if table.lower() == 'sessions':
-                logger.debug('Generating sessions DataFrame')
-                tbl, filename = self._save_table(generate_sessions_frame(**kwargs), table, dry=dry)
+        if partitioned:
+            return self._write_partitioned_tables(tables, export_qc=export_qc, **kwargs)
+        with self._staging():
+            to_compress = {}
+            for table in tables:
+                if table.lower() in TABLES:
+                    info, filename = self._write_registered_table(table.lower(), **kwargs)
+                    to_compress[filename] = info
+                    continue
+                if table.lower() == 'sessions':
+                    if since is None:
+                        logger.debug('Generating sessions DataFrame')
+                        df = generate_sessions_frame(**kwargs)
+                    else:
+                        logger.debug('Updating sessions DataFrame')
+                        df = update_sessions_frame(
+                            previous['sessions'].to_pandas(), since, deleted_sessions=deleted[0])
+                else:
+                    if since is None:
+                        logger.debug('Generating datasets table')
+                        info, filename = self._write_datasets_table(table, **kwargs)
+                        to_compress[filename] = info
+                        continue
+                    logger.debug('Updating datasets DataFrame')
+                    df = update_datasets_frame(previous['datasets'].to_pandas(), since, *deleted)
+                info, filename = self._save_table(df, table)
                 if filename is not None:
-                    to_compress[filename] = tbl
-            elif table.lower() == 'datasets':
-                logger.debug('Generating datasets DataFrame')
-                tbl, filename = self._save_table(generate_datasets_frame(**kwargs), table, dry=dry)
+                    to_compress[filename] = info
+
+            if export_qc:
+                _, filename = self._save_qc(tags=kwargs.get('tags'))
                 if filename is not None:
-                    to_compress[filename] = tbl
+                    to_compress[filename] = None
+
+            if self.compress and len(to_compress) > 0:
+                return list(self._compress_tables(to_compress))
             else:
-                raise ValueError(f'Unknown table "{table}"')
+                return list(to_compress.keys())
+
+    def _write_partitioned_tables(self, tables, export_qc=False, **kwargs) -> list:
+        """
+        Save tables as parquet datasets in <dst_dir>/<table>/, partitioned by lab and year/month.
 
+        The additional tables registered in TABLES are saved unpartitioned to <dst_dir>/<table>.pqt.
+
+        :param tables: A tuple of table names.
+        :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param kwargs: Arguments to pass to cache generation functions.
+        :return: A list of paths to the saved table directories and files.
+        """
+        jsonmeta, files = {}, []
+        for table in tables:
+            if table.lower() in TABLES:  # Not partitioned
+                info, filename = self._write_registered_table(table.lower(), **kwargs)
+                jsonmeta[table.lower()] = info
+                files.append(filename)
+                continue
+            base_dir = self._filename(table.lower())
+            logger.info(f'Saving partitioned table "{table}" to {base_dir}...')
+            if table.lower() == 'sessions':
+                data = sessions_partitioned_table(generate_sessions_frame(**kwargs))
+                data, schema = data.to_batches(), data.schema
+            else:
+                ds = datasets_queryset(tags=kwargs.get('tags'))
+                data = dataset_batches(kwargs.get('backend', 'orm'))(
+                    ds, kwargs.get('batch_size', 100_000), partitioned=True)
+                schema = DATASETS_PARTITIONED_SCHEMA
+            jsonmeta[table.lower()] = write_partitioned(base_dir, data, schema, self.metadata)
+            files.append(base_dir)
         if export_qc:
-            tbl, filename = self._save_qc(dry=dry, tags=kwargs.get('tags'))
+            _, filename = self._save_qc(tags=kwargs.get('tags'))
             if filename is not None:
-                to_compress[filename] = tbl
+                files.append(filename)
+        files.append(self._write_cache_info({**self.metadata, 'tables': jsonmeta}))
+        return files
 
-        if self.compress and len(to_compress) > 0:
-            return list(self._compress_tables(to_compress))
-        else:
-            return list(to_compress.keys())
+    def generate_all_tag_tables(self, tables, export_qc=False, workers=4, backend='orm') -> dict:
+        """
+        Generate and save the tables of every dataset tag into <dst_dir>/<tag>/.
+
+        The tag membership, the datasets and sessions of all tagged datasets and their QC are
+        queried once and saved to a temporary directory.  The tables of each tag are then
+        filtered from these and saved by a pool of worker processes, which do not query the
+        database.
+
+        :param tables: A tuple of table names.
+        :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param workers: The number of worker processes; if 1 the tables are saved serially.
+        :param backend: The extraction backend, one of BACKENDS.
+        :return: A dict with the timing report: 'query_time' and 'total_time' in seconds,
+         'workers' and 'tags', a list of dicts with keys ('tag', 'sessions', 'datasets',
+         'files', 'time')
+        """
+        tables = [table.lower() for table in tables]
+        for table in tables:
+            if table not in ('sessions', 'datasets', *TABLES):
+                raise ValueError(f'Unknown table "{table}"')
+            if table in TABLES and TABLES[table][2] is None:
+                raise ValueError(f'The {table} table is not supported with --all-tags')
+        t0 = time()
+        timestamp = timezone.now()
+        metadata = create_metadata()
+        metadata['database_timestamp'] = timestamp.isoformat()
+        with tempfile.TemporaryDirectory() as tmp:
+            tags = save_tag_membership(Path(tmp) / 'membership.pqt')
+            if 'datasets' in tables:
+                ds = datasets_queryset(tags=tags)
+                write_batches(str(Path(tmp) / 'datasets.pqt'), dataset_batches(backend)(ds),
+                              DATASETS_SCHEMA)
+            if 'sessions' in tables:
+                sessions = Session.objects.filter(data_dataset_session_related__tags__isnull=False)
+                df = generate_sessions_frame(session_ids=sessions.values('pk'), backend=backend)
+                _save(str(Path(tmp) / 'sessions.pqt'), df)
+            for table in set(tables).intersection(TABLES):
+                schema, batches, _ = TABLES[table]
+                write_batches(str(Path(tmp) / f'{table}.pqt'),
+                              batches(tagged_sessions(tags)), schema)
+            if export_qc:  # One record per line so that each tag can filter it as a stream
+                with open(Path(tmp) / 'QC.jsonl', 'w') as fp:
+                    fp.writelines(json.dumps(d) + '\n' for d in iter_qc_records(tags=tags))
+            query_time = time() - t0
+            logger.info('Queried %i tags in %.2f seconds', len(tags), query_time)
 
-    def _save_table(self, table, name, **kwargs):
+            build = partial(build_tag_tables, tmp=tmp, dst_dir=self.dst_dir, tables=tables,
+                            metadata=metadata, compress=self.compress, export_qc=export_qc)
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+                    report = list(pool.map(build, tags))
+            else:
+                report = list(map(build, tags))
+        return {'tags': report, 'query_time': query_time, 'total_time': time() - t0,
+                'workers': workers}
+
+    def _load_previous(self, tables) -> tuple:
+        """
+        Load the previous tables for an incremental update.
+
+        :param tables: A tuple of table names.
+        :return: A dict of table names and pyarrow tables, and the time from which to query
+         modified rows, or None if the tables must be regenerated
+        """
+        previous = {table.lower(): load_table(self.dst_dir, table.lower()) for table in tables}
+        timestamps = {schema_metadata(tbl.schema).get('database_timestamp')
+                      for tbl in previous.values() if tbl is not None}
+        if None in previous.values() or len(timestamps) != 1 or None in timestamps:
+            logger.warning('No previous tables with a common database timestamp found in %s; '
+                           'generating all tables', self.dst_dir)
+            return {}, None
+        since = datetime.fromisoformat(timestamps.pop()) - INCREMENTAL_OVERLAP
+        logger.info('Updating tables with changes since %s', since)
+        return previous, since
+
+    def _save_table(self, table, name):
         """Save a given table to <dst_dir>/<name>.pqt.
 
         Given a table name and a pandas DataFrame, save as parquet table to disk.  If dst_dir
@@ -178,160 +453,242 @@ class Command(BaseCommand):
 
         :param table: the pandas DataFrame to save
         :param name: table name
-        :param dry: If True, does not actually write to disk
-        :return: A PyArrow table and the full path to the saved file
+        :return: A dict of the table's number of records and size in bytes, and the full path
+         to the saved file
         """
 
         if table is None:
             logger.warning(f'Table {name} is empty, not saving')
             return None, None
 
-        if not kwargs.get('dry'):
-            logger.info(f'Saving table "{name}" to {self.dst_dir}...')
-        scheme = urllib.parse.urlparse(self.dst_dir).scheme or 'file'
+        logger.info(f'Saving table "{name}" to {self.dst_dir}...')
+        filename = self._filename(f'{name}.pqt')  # Save to parquet
+        table = pa.Table.from_pandas(table)
+        info = write_batches(filename, table.to_batches(), table.schema, self.metadata)
+        return info, filename
+
+    def _filename(self, filename) -> str:
+        """Return the full path of file <dst_dir>/<filename>, creating local directories.
+
+        When compressing, files are saved to a local staging directory instead.
+        """
+        dst_dir = self._staging_dir or self.dst_dir
+        scheme = urllib.parse.urlparse(dst_dir).scheme or 'file'
         if scheme == 'file':
-            Path(self.dst_dir).mkdir(exist_ok=True)
-            filename = Path(self.dst_dir) / f'{name}.pqt'  # Save to parquet
-        else:
-            filename = self.dst_dir.strip('/') + f'/{name}.pqt'  # Save to parquet
-        pa_table = _save(str(filename), table, self.metadata, **kwargs)
-        return pa_table, str(filename)
+            Path(dst_dir).mkdir(exist_ok=True)
+            return str(Path(dst_dir) / filename)
+        return dst_dir.strip('/') + f'/{filename}'
+
+    @contextmanager
+    def _staging(self):
+        """Within this context, files are saved to a temporary directory when compressing."""
+        if not self.compress:
+            yield
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            self._staging_dir = tmp
+            try:
+                yield
+            finally:
+                self._staging_dir = None
 
     @measure_time
-    def _save_qc(self, dry=False, tags=None):
-        sessions = Session.objects.all()
-        if tags:
-            if not isinstance(tags, str):
-                sessions = sessions.filter(data_dataset_session_related__tags__name__in=tags)
-            else:
-                sessions = sessions.filter(data_dataset_session_related__tags__name=tags)
+    def _write_datasets_table(self, name, tags=None, batch_size=100_000, backend='orm'):
+        """Stream the datasets table to <dst_dir>/<name>.pqt.
 
-        if sessions.count() == 0:
-            logger.warning(f'No datasets associated with sessions found for {tags}, '
-                           f'returning empty dataframe')
-            return
+        Datasets are fetched in batches from a server-side cursor and appended to the parquet
+        file as row groups, so that only one batch is held in memory at a time.
 
-        qc = list(sessions.values('pk', 'qc', 'extended_qc').distinct())
-        outcome_map = dict(Session.QC_CHOICES)
-        for d in qc:  # replace enumeration int with string
-            d['eid'] = str(d.pop('pk'))  # rename field
-            d['qc_outcome'] = outcome_map[d.pop('qc')]
-            d['extended_qc'] = d.pop('extended_qc')  # pop to preserve order
-        logger.debug('Fetched %i QC records', len(qc))
-
-        # Fetch insertion QC
-        insertions = ProbeInsertion.objects.all()
-        if tags:
-            if not isinstance(tags, str):
-                insertions = insertions.filter(
-                    session__data_dataset_session_related__tags__name__in=tags)
-            else:
-                insertions = insertions.filter(
-                    session__data_dataset_session_related__tags__name=tags)
-        qc_ins = list(insertions.values('pk', 'name', 'json', 'session__pk').distinct())
+        :param name: table name
+        :param tags: List of tag names to filter datasets by
+        :param batch_size: The number of datasets to fetch and write at a time
+        :param backend: The extraction backend, one of BACKENDS
+        :return: A dict of the table's number of records and size in bytes, and the full path
+         to the saved file
+        """
+        filename = self._filename(f'{name}.pqt')
+        batches = dataset_batches(backend)(datasets_queryset(tags=tags), batch_size)
+        logger.info(f'Saving table "{name}" to {self.dst_dir}...')
+        info = write_batches(filename, batches, DATASETS_SCHEMA, self.metadata)
+        if info['nrecs'] == 0:
+            logger.warning(f'No datasets associated with sessions found for {tags}')
+        return info, filename
 
-        # Collate with session QC list
-        for ins in qc_ins:
-            if 'extended_qc' not in ins['json']:
-                continue
-            d = next(x for x in qc if x['eid'] == str(ins['session__pk']))
-            d.setdefault('probe_insertions', []).append({
-                'pid': str(ins.pop('pk')),
-                'probe_name': ins.pop('name'),
-                'qc_outcome': ins['json'].pop('qc', 'NOT_SET'),
-                'extended_qc': ins['json'].pop('extended_qc')
-            })
+    @measure_time
+    def _write_registered_table(self, name, tags=None, batch_size=100_000, **_):
+        """Stream an additional table registered in TABLES to <dst_dir>/<name>.pqt.
+
+        :param name: table name
+        :param tags: List of tag names; if given, only rows of the sessions with datasets that
+         have these tags are saved
+        :param batch_size: The number of rows to fetch and write at a time
+        :return: A dict of the table's number of records and size in bytes, and the full path
+         to the saved file
+        """
+        schema, batches, _ = TABLES[name]
+        filename = self._filename(f'{name}.pqt')
+        logger.info(f'Saving table "{name}" to {self.dst_dir}...')
+        sessions = tagged_sessions(tags) if tags else None
+        info = write_batches(filename, batches(sessions, batch_size), schema, self.metadata)
+        return info, filename
+
+    def _save_qc(self, tags=None, qc=None):
+        """Save the session and insertion QC to <dst_dir>/QC.json.
 
-        filename = self.dst_dir.strip('/') + '/QC.json'  # Save to JSON
-        if not dry:
-            with open(filename, 'w') as fp:
-                json.dump(qc, fp)
-        return qc, str(filename)
+        The records are streamed to the file (or S3 object) one session at a time.
+
+        :param tags: List of tag names to filter sessions by
+        :param qc: An iterable of QC records to save; if None, they are fetched using the tags
+        :return: The number of QC records and the full path to the saved file
+        """
+        records = iter(iter_qc_records(tags=tags) if qc is None else qc)
+        first = next(records, None)
+        if first is None:
+            logger.warning(f'No datasets associated with sessions found for {tags}, '
+                           f'not saving QC')
+            return None, None
+
+        filename = self._filename('QC.json')  # Save to JSON
+        n_records = write_qc(str(filename), chain([first], records))
+        return n_records, str(filename)
 
     def _compress_tables(self, table_map) -> tuple:
         """
         Write cache_info JSON and create zip file comprising parquet tables + JSON
 
-        :param table_map: a dict of filenames and corresponding
-        :return:
+        The zip file is streamed to the destination file, or to an S3 multipart upload, so
+        that the tables are never held in memory.
+
+        :param table_map: a dict of local filenames and for parquet tables, a dict of the
+         table's number of records ('nrecs') and size in bytes ('size')
+        :return: The zip file and cache info file paths
         """
         ZIP_NAME = 'cache.zip'
         META_NAME = 'cache_info.json'
 
-        logger.info('Compressing tables...')  # Write zip in memory
-        zip_buffer = io.BytesIO()  # Mem buffer to store compressed table data
-        with tempfile.TemporaryDirectory() as tmp, \
-                zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip:
-            jsonmeta = {}
-            for filename, table in table_map.items():
-                tmp_filename = Path(tmp) / Path(filename).name  # Table filename in temp dir
-                ext = Path(filename).suffix
-                if ext == '.pqt':
-                    pq.write_table(table, tmp_filename)  # Write table to tempdir
-                    zip.write(tmp_filename, Path(filename).name)  # Load and compress
-                    pqtinfo = pq.read_metadata(tmp_filename)  # Load metadata for cache_info file
-                    jsonmeta[Path(filename).stem] = {
-                        'nrecs': pqtinfo.num_rows,
-                        'size': pqtinfo.serialized_size
-                    }
-                elif ext == '.json':
-                    with open(tmp_filename, 'w') as fp:
-                        json.dump(table, fp)
-                    zip.write(tmp_filename, Path(filename).name)
-                else:
-                    raise NotImplementedError(f'Unable to save table with extension "{ext}"')
-            metadata = {**self.metadata, 'tables': jsonmeta}
-            zip.writestr(META_NAME, json.dumps(metadata, indent=1))  # Compress cache info
+        jsonmeta = {}
+        for filename, info in table_map.items():
+            ext = Path(filename).suffix
+            if ext == '.pqt':
+                jsonmeta[Path(filename).stem] = info
+            elif ext != '.json':
+                raise NotImplementedError(f'Unable to save table with extension "{ext}"')
+        metadata = {**self.metadata, 'tables': jsonmeta}
 
-        logger.info('Writing to file...')
+        def write_zip(stream):
+            with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, False) as zip:
+                for filename in table_map:
+                    zip.write(filename, Path(filename).name)  # Compress in chunks
+                zip.writestr(META_NAME, json.dumps(metadata, indent=1))  # Compress cache info
+
+        logger.info('Compressing tables...')
         parsed = urllib.parse.urlparse(self.dst_dir)
         scheme = parsed.scheme or 'file'
-        try:
-            if scheme == 's3':
-                zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{ZIP_NAME}'
-                tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{META_NAME}'
-                s3 = _s3_filesystem()
-                metadata['location'] = get_s3_virtual_host(zip_file, s3.region)  # Add URL
-                # Write cache info json to s3
-                logger.debug(f'Opening output stream to {tag_file}')
-                with s3.open_output_stream(tag_file) as stream:
-                    stream.write(json.dumps(metadata, indent=1).encode())
-                # Write zip file to s3
-                logger.debug(f'Opening output stream to {zip_file}')
-                with s3.open_output_stream(zip_file) as stream:
-                    stream.write(zip_buffer.getbuffer())
-            elif scheme == 'file' or os.name == 'nt':
-                # creates a json file containing metadata and add it to the zip file
-                Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
-                tag_file = Path(self.dst_dir) / META_NAME
-                zip_file = Path(self.dst_dir) / ZIP_NAME
-                with open(tag_file, 'w') as fid:
-                    json.dump(metadata, fid, indent=1)
-                with open(zip_file, 'wb') as fid:
-                    fid.write(zip_buffer.getbuffer())
-            else:
-                raise ValueError(f'Unsupported URI scheme "{scheme}"')
-        finally:
-            zip_buffer.close()
-        return zip_file, tag_file
+        if scheme == 's3':
+            zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{ZIP_NAME}'
+            s3 = _s3_filesystem()
+            # Write zip file to s3; the output stream uploads it in parts as it is written
+            logger.debug(f'Opening output stream to {zip_file}')
+            with s3.open_output_stream(zip_file) as stream:
+                write_zip(stream)
+            metadata['location'] = get_s3_virtual_host(zip_file, s3.region)  # Add URL
+        elif scheme == 'file' or os.name == 'nt':
+            # creates a json file containing metadata and add it to the zip file
+            Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
+            zip_file = Path(self.dst_dir) / ZIP_NAME
+            # Write to a partial file so that the previous zip file is served until complete
+            partial_file = zip_file.with_suffix('.zip.part')
+            try:
+                with open(partial_file, 'wb') as fid:
+                    write_zip(fid)
+                os.replace(partial_file, zip_file)
+            finally:
+                partial_file.unlink(missing_ok=True)
+        else:
+            raise ValueError(f'Unsupported URI scheme "{scheme}"')
+        return zip_file, self._write_cache_info(metadata)
+
+    def _write_cache_info(self, metadata) -> str:
+        """
+        Write the cache info JSON file to <dst_dir>/cache_info.json.
+
+        :param metadata: The cache metadata, including table information
+        :return: The cache info file path
+        """
+        META_NAME = 'cache_info.json'
+        parsed = urllib.parse.urlparse(self.dst_dir)
+        scheme = parsed.scheme or 'file'
+        if scheme == 's3':
+            # Write cache info json to s3
+            tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{META_NAME}'
+            logger.debug(f'Opening output stream to {tag_file}')
+            with _s3_filesystem().open_output_stream(tag_file) as stream:
+                stream.write(json.dumps(metadata, indent=1).encode())
+        elif scheme == 'file' or os.name == 'nt':
+            Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
+            tag_file = Path(self.dst_dir) / META_NAME
+            with open(tag_file, 'w') as fid:
+                json.dump(metadata, fid, indent=1)
+        else:
+            raise ValueError(f'Unsupported URI scheme "{scheme}"')
+        return tag_file
+
+
+def sort_sessions_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Sort a sessions frame by date, subject and number, most recent first."""
+    return df.sort_values(['date', 'subject', 'number'], ascending=False)
+
+
+SESSION_FIELDS = ('id', 'lab__name', 'subject__nickname', 'start_time__date',
+                  'number', 'task_protocol', 'projects_csv')
+
+
+def _annotate_projects(query: QuerySet) -> QuerySet:
+    """Annotate sessions with their sorted, comma separated project names ('projects_csv')."""
+    return query.annotate(projects_csv=StringAgg(
+        'projects__name', ',', distinct=True, order_by='projects__name', default=''))
 
 
 def session_queryset_to_dataframe(query: QuerySet) -> pd.DataFrame:
-    fields = ('id', 'lab__name', 'subject__nickname', 'start_time__date',
-              'number', 'task_protocol', 'all_projects')
-    df = pd.DataFrame.from_records(query.values(*fields).distinct())
+    rows = _annotate_projects(query).values_list(*SESSION_FIELDS).distinct()
+    df = pd.DataFrame.from_records(rows, columns=SESSION_FIELDS)
     logger.debug(f'Raw session frame = {getsizeof(df) / 1024**2} MiB')
-    # Rename, sort fields
-    df['all_projects'] = df['all_projects'].map(lambda x: ','.join(filter(None, set(x))))
-    # task_protocol & projects columns may be empty; ensure None -> ''
     # id UUID objects -> str; not supported by parquet
+    df['id'] = uuid_strings(df['id']).to_numpy(zero_copy_only=False)
+    return _format_sessions_frame(df)
+
+
+def session_queryset_to_dataframe_copy(query: QuerySet) -> pd.DataFrame:
+    """
+    Fetch a sessions frame through PostgreSQL COPY.
+
+    Equivalent to session_queryset_to_dataframe except that the rows are parsed by pyarrow,
+    without building a Python object per session.
+
+    :param query: A Session queryset
+    :return: The sessions frame
+    """
+    query = _annotate_projects(query).values(*SESSION_FIELDS).distinct()
+    column_types = {
+        'id': pa.string(), 'lab__name': pa.string(), 'subject__nickname': pa.string(),
+        'start_time__date': pa.date32(), 'number': pa.int64(), 'task_protocol': pa.string(),
+        'projects_csv': pa.string()
+    }
+    df = pa.Table.from_batches(copy_query(query, column_types)).to_pandas()
+    logger.debug(f'Raw session frame = {getsizeof(df) / 1024**2} MiB')
+    return _format_sessions_frame(df)
+
+
+def _format_sessions_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Rename, filter, sort and cast the raw session fields to the sessions table."""
+    # task_protocol & projects columns may be empty; ensure None -> ''
     df = (
         (df
             .rename(lambda x: x.split('__')[0], axis=1)
-            .rename({'start_time': 'date', 'all_projects': 'projects'}, axis=1)
+            .rename({'start_time': 'date', 'projects_csv': 'projects'}, axis=1)
             .dropna(subset=['number', 'date', 'subject', 'lab'])  # Remove dud or base sessions
-            .sort_values(['date', 'subject', 'number'], ascending=False)
-            .astype({'number': np.uint16, 'task_protocol': str, 'projects': str, 'id': str}))
+            .pipe(sort_sessions_frame)
+            .astype({'number': np.uint16, 'task_protocol': str, 'projects': str}))
     )
     df.set_index('id', inplace=True)
 
@@ -339,44 +696,505 @@ def session_queryset_to_dataframe(query: QuerySet) -> pd.DataFrame:
     return df
 
 
-def dataset_queryset_to_dataframe(ds: QuerySet, batch_size: int = 100_000) -> pd.DataFrame:
-    # fields to keep from Dataset table
-    fields = (
-        'id', 'name', 'file_size', 'hash', 'collection', 'revision__name', 'default_dataset',
-        'session__id', 'qc'
-    )
-    fields_map = {'session__id': 'eid', 'default_dataset': 'default_revision'}
+def iter_session_batches(query: QuerySet, batch_size: int = 10_000):
+    """
+    Iterate over a session queryset as record batches of the sessions table.
 
-    paginator = Paginator(ds.order_by('pk'), batch_size)
-    all_df = pd.DataFrame([])
-    for i in tqdm(paginator.page_range):
-        data = paginator.get_page(i)
-        current_qs = data.object_list
-        df = (pd.DataFrame
-              .from_records(current_qs.values(*fields))
-              .rename(fields_map, axis=1)
-              .astype({'id': str, 'eid': str, 'file_size': 'UInt64'}))
-        df['exists'] = True
+    The sessions are fetched from a server-side cursor in the queryset's order, so that only one
+    batch is held in memory at a time.  Unlike generate_sessions_frame, the sessions are not
+    sorted.
+
+    :param query: A Session queryset
+    :param batch_size: The number of sessions per batch
+    :return: A generator of pyarrow RecordBatch objects with the SESSIONS_SCHEMA schema
+    """
+    query = (_annotate_projects(query.prefetch_related(None))
+             .filter(number__isnull=False, start_time__isnull=False,  # Remove dud or base sessions
+                     subject__isnull=False, lab__isnull=False))
+    rows = query.values_list(*SESSION_FIELDS).iterator(chunk_size=batch_size)
+    while batch := list(islice(rows, batch_size)):
+        pk, lab, subject, date, number, task_protocol, projects = zip(*batch)
+        arrays = [
+            pa.array(lab, type=pa.string()),
+            pa.array(subject, type=pa.string()),
+            pa.array(date, type=pa.date32()),
+            pa.array(number, type=pa.uint16()),
+            pa.array(task_protocol, type=pa.string()),
+            pa.array(projects, type=pa.string()),
+            uuid_strings(pk),
+        ]
+        yield pa.RecordBatch.from_arrays(arrays, schema=SESSIONS_SCHEMA)
 
-        # relative_path
-        revision = map(lambda x: None if not x else f'#{x}#', df.pop('revision__name'))
-        zipped = zip(df.pop('collection'), revision, df.pop('name'))
-        df['rel_path'] = ['/'.join(filter(None, x)) for x in zipped]
 
-        # UUIDs converted to str: not supported by parquet
-        df = df.set_index(['eid', 'id'])
+def _datasets_schema() -> pa.Schema:
+    """Return the schema of the datasets table, including the pandas (eid, id) index."""
+    # NB: The column types of an empty frame can't be inferred, so a one row frame is used
+    df = (pd.DataFrame({'eid': [''], 'id': [''], 'file_size': pd.array([0], dtype='UInt64'),
+                        'hash': [''], 'default_revision': [True],
+                        'qc': pd.Categorical([QC.NOT_SET.name], dtype=QC_TYPE),
+                        'exists': [True], 'rel_path': ['']})
+          .set_index(['eid', 'id']))
+    return pa.Schema.from_pandas(df)
 
-        # Convert QC enum int to pandas category
-        df['qc'] = pd.Categorical([QC(i).name for i in df['qc']], dtype=QC_TYPE)
 
-        all_df = pd.concat([all_df, df], ignore_index=False, copy=False)
+DATASETS_SCHEMA = _datasets_schema()
+SESSIONS_SCHEMA = pa.Schema.from_pandas(_format_sessions_frame(pd.DataFrame(
+    [('', '', '', datetime.now().date(), 1, '', '')], columns=SESSION_FIELDS)))
+# Hive-style partitioning of the tables by session lab and start year and month
+PARTITIONING = pa.schema([('lab', pa.string()), ('year', pa.int16()), ('month', pa.int8())])
+DATASETS_PARTITIONED_SCHEMA = pa.unify_schemas([DATASETS_SCHEMA, PARTITIONING])
+# Map of QC enumeration value to QC_TYPE category code
+_QC_CODES = {QC[name].value: code for code, name in enumerate(QC_TYPE.categories)}
+_QC_VALUES = pa.array(_QC_CODES.keys(), type=pa.int8())
+_QC_CODE_LOOKUP = pa.array(_QC_CODES.values(), type=pa.int8())
+_QC_DICTIONARY = pa.array(QC_TYPE.categories, type=pa.string())
+# Lookup table of hex digits and the positions of the hex digits in a hyphenated UUID string
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', np.uint8)
+_UUID_HEX_POSITIONS = [i for i in range(36) if i not in (8, 13, 18, 23)]
 
-    logger.debug(f'Final datasets frame = {getsizeof(all_df) / 1024 ** 2:.1f} MiB')
-    return all_df.sort_index()
+
+def dataset_batches(backend: str = 'orm'):
+    """
+    Return the function that iterates over a dataset queryset as record batches.
+
+    :param backend: The extraction backend, one of BACKENDS
+    :return: iter_dataset_batches for 'orm' or copy_dataset_batches for 'copy'
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend "{backend}"; expected one of {BACKENDS}')
+    return copy_dataset_batches if backend == 'copy' else iter_dataset_batches
+
+
+def iter_dataset_batches(ds: QuerySet, batch_size: int = 100_000, partitioned: bool = False,
+                         exists_field: str | None = None):
+    """
+    Iterate over a dataset queryset as record batches of the datasets table.
+
+    The datasets are ordered by session and dataset UUID, i.e. the sort order of the table index,
+    and fetched from a server-side cursor, so that only one batch is held in memory at a time.
+
+    :param ds: A Dataset queryset
+    :param batch_size: The number of datasets per batch
+    :param partitioned: If true, add the session lab, year and month partition columns and
+     order the datasets by these first
+    :param exists_field: The name of a boolean annotation of ds to use as the 'exists' column;
+     if None, all datasets exist (the cache tables only contain datasets that exist)
+    :return: A generator of pyarrow RecordBatch objects with the DATASETS_SCHEMA schema, or the
+     DATASETS_SCHEMA followed by the PARTITIONING schema fields if partitioned
+    """
+    fields = [
+        'session_id', 'id', 'file_size', 'hash', 'default_dataset', 'qc',
+        'collection', 'revision__name', 'name'
+    ]
+    if exists_field:
+        fields.append(exists_field)
+    if partitioned:
+        fields.extend(['session__lab__name', 'session__start_time'])
+    schema = DATASETS_PARTITIONED_SCHEMA if partitioned else DATASETS_SCHEMA
+    order = ('session_id', 'pk')
+    if partitioned:  # Sort by partition first so that the partitions can be written in turn
+        ds = ds.annotate(year=ExtractYear('session__start_time'),
+                         month=ExtractMonth('session__start_time'))
+        order = ('session__lab__name', 'year', 'month', *order)
+    rows = ds.order_by(*order).values_list(*fields).iterator(chunk_size=batch_size)
+    while batch := list(islice(rows, batch_size)):
+        eid, pk, file_size, hash_, default, qc, collection, revision, name, *other = zip(*batch)
+        if exists_field:
+            exists = pa.array(other.pop(0), type=pa.bool_())
+        else:  # The datasets are assumed to have been filtered by existence
+            exists = pa.repeat(True, len(batch))
+        # UUIDs converted to str: not supported by parquet; QC enum int to category code
+        arrays = [
+            pa.array(file_size, type=pa.uint64()),
+            pa.array(hash_, type=pa.string()),
+            pa.array(default, type=pa.bool_()),
+            qc_dictionary_array(pa.array(qc, type=pa.int8())),
+            exists,
+            relative_paths(collection, revision, name),
+            uuid_strings(eid),
+            uuid_strings(pk),
+        ]
+        if partitioned:
+            lab, start_time = other
+            start_time = pa.array(start_time, type=pa.timestamp('us'))
+            arrays.extend([
+                pa.array(lab, type=pa.string()),
+                pc.year(start_time).cast(pa.int16()),
+                pc.month(start_time).cast(pa.int8()),
+            ])
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def copy_query(query: QuerySet, column_types: dict | None = None, batch_size: int = 100_000):
+    """
+    Iterate over the rows of a values queryset as record batches fetched with COPY.
+
+    The query is run through `COPY (SELECT ...) TO STDOUT` in CSV format, as in
+    misc.management.commands.backup.backup_tsv.  The output is spooled to a temporary file and
+    parsed by the pyarrow CSV reader, so that no Python objects are created per row.  The
+    columns are named after the values() fields; any columns added to the query for ordering are
+    dropped.
+
+    :param query: A values queryset.  NB: Any ordering is preserved.
+    :param column_types: A map of column name to pyarrow type; other columns are inferred
+    :param batch_size: The number of rows per batch
+    :return: A generator of pyarrow RecordBatch objects
+    """
+    sql, params = query.query.sql_with_params()
+    with tempfile.TemporaryFile() as fp:
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(sql, params).decode()
+            cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)', fp)
+        fp.seek(0)
+        # Unquoted empty fields are NULL, quoted empty fields are empty strings
+        convert_options = pa_csv.ConvertOptions(
+            column_types=column_types or {}, include_columns=query._fields,
+            true_values=['t'], false_values=['f'],
+            strings_can_be_null=True, quoted_strings_can_be_null=False)
+        reader = pa_csv.open_csv(fp, convert_options=convert_options)
+        # The reader's batches are sized in bytes; re-slice them to batch_size rows
+        buffer = reader.schema.empty_table()
+        for batch in reader:
+            buffer = pa.concat_tables([buffer, pa.Table.from_batches([batch])])
+            while buffer.num_rows >= batch_size:
+                yield from buffer.slice(0, batch_size).combine_chunks().to_batches()
+                buffer = buffer.slice(batch_size)
+        if buffer.num_rows:
+            yield from buffer.combine_chunks().to_batches()
+
+
+def copy_dataset_batches(ds: QuerySet, batch_size: int = 100_000, partitioned: bool = False):
+    """
+    Iterate over a dataset queryset as record batches of the datasets table, using COPY.
+
+    Equivalent to iter_dataset_batches except that the relative path is built, and the UUIDs
+    converted to str, in the query, and the rows are parsed by pyarrow instead of the ORM.
+
+    :param ds: A Dataset queryset
+    :param batch_size: The number of datasets per batch
+    :param partitioned: If true, add the session lab, year and month partition columns and
+     order the datasets by these first
+    :return: A generator of pyarrow RecordBatch objects with the DATASETS_SCHEMA schema, or the
+     DATASETS_SCHEMA followed by the PARTITIONING schema fields if partitioned
+    """
+    revision = Func(Value('#'), NullIf('revision__name', Value('')), Value('#'),
+                    template='(%(expressions)s)', arg_joiner=' || ', output_field=TextField())
+    ds = ds.annotate(
+        eid_=Cast('session_id', TextField()),
+        id_=Cast('pk', TextField()),
+        rel_path=Func(Value('/'), NullIf('collection', Value('')), revision, 'name',
+                      function='CONCAT_WS', output_field=TextField()))
+    fields = ['eid_', 'id_', 'file_size', 'hash', 'default_dataset', 'qc', 'rel_path']
+    order = ('session_id', 'pk')
+    schema = DATASETS_SCHEMA
+    if partitioned:
+        ds = ds.annotate(lab=F('session__lab__name'),
+                         year=ExtractYear('session__start_time'),
+                         month=ExtractMonth('session__start_time'))
+        fields.extend(PARTITIONING.names)
+        order = (*PARTITIONING.names, *order)
+        schema = DATASETS_PARTITIONED_SCHEMA
+    column_types = {
+        'eid_': pa.string(), 'id_': pa.string(), 'file_size': pa.uint64(), 'hash': pa.string(),
+        'default_dataset': pa.bool_(), 'qc': pa.int8(), 'rel_path': pa.string(),
+        **{field.name: field.type for field in PARTITIONING}
+    }
+    query = ds.order_by(*order).values(*fields)
+    for batch in copy_query(query, column_types, batch_size):
+        arrays = [
+            batch['file_size'],
+            batch['hash'],
+            batch['default_dataset'],
+            qc_dictionary_array(batch['qc']),
+            pa.repeat(True, len(batch)),
+            batch['rel_path'],
+            batch['eid_'],
+            batch['id_'],
+        ]
+        if partitioned:
+            arrays.extend(batch[name] for name in PARTITIONING.names)
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def relative_paths(collection, revision, name) -> pa.StringArray:
+    """
+    Join dataset collections, revisions and names into paths relative to the session.
+
+    Empty collections and revisions are omitted, e.g. ('alf', '', 'foo.bar.npy') ->
+    'alf/foo.bar.npy' and ('alf', '2020-01-01', 'foo.bar.npy') -> 'alf/#2020-01-01#/foo.bar.npy'.
+
+    :param collection: A sequence or string array of dataset collections
+    :param revision: A sequence or string array of revision names, may be null
+    :param name: A sequence or string array of dataset names
+    :return: A string array of relative paths
+    """
+    collection, revision, name = (pa.array(x, type=pa.string())
+                                  for x in (collection, revision, name))
+    revision = pc.binary_join_element_wise('#', _empty_to_null(revision), '#', '')
+    return pc.binary_join_element_wise(
+        _empty_to_null(collection), revision, name, '/', null_handling='skip')
+
+
+def _empty_to_null(values: pa.StringArray) -> pa.StringArray:
+    return pc.if_else(pc.equal(values, ''), pa.scalar(None, type=pa.string()), values)
+
+
+def uuid_strings(values) -> pa.StringArray:
+    """
+    Convert UUIDs to their canonical 36 character hex strings.
+
+    The UUIDs' 16 byte binary values are formatted by a lookup of each half byte in a hex digit
+    table, rather than by calling str on each UUID.
+
+    :param values: A sequence of uuid.UUID objects, or a fixed size binary(16) array without
+     nulls
+    :return: A string array of lowercase, hyphenated UUIDs
+    """
+    if isinstance(values, pa.FixedSizeBinaryArray):
+        start = values.offset * 16
+        raw = np.frombuffer(values.buffers()[1], np.uint8)[start:start + len(values) * 16]
+    else:
+        raw = np.frombuffer(b''.join(x.bytes for x in values), np.uint8)
+    raw = raw.reshape(-1, 16)
+    n = len(raw)
+    nibbles = np.empty((n, 32), np.uint8)
+    nibbles[:, 0::2] = raw >> 4
+    nibbles[:, 1::2] = raw & 0x0F
+    chars = np.full((n, 36), ord('-'), np.uint8)
+    chars[:, _UUID_HEX_POSITIONS] = _HEX_DIGITS[nibbles]
+    offsets = np.arange(0, 36 * (n + 1), 36, dtype=np.int32)
+    return pa.StringArray.from_buffers(n, pa.py_buffer(offsets), pa.py_buffer(chars))
+
+
+def qc_dictionary_array(values) -> pa.DictionaryArray:
+    """
+    Convert an array of QC enumeration values to a dictionary array of QC_TYPE categories.
+
+    :param values: A pyarrow integer array of QC enumeration values
+    :return: A pyarrow DictionaryArray with the QC_TYPE categories as its dictionary
+    """
+    codes = pc.take(_QC_CODE_LOOKUP, pc.index_in(values, value_set=_QC_VALUES))
+    return pa.DictionaryArray.from_arrays(codes, _QC_DICTIONARY, ordered=True)
+
+
+def choices_dictionary_array(values, choices) -> pa.DictionaryArray:
+    """
+    Convert an array of model field choice values to a dictionary array of their labels.
+
+    :param values: A pyarrow integer array of choice values
+    :param choices: The field choices, a sequence of (value, label) tuples
+    :return: A pyarrow DictionaryArray of the labels; values not in the choices are null
+    """
+    value_set = pa.array([value for value, _ in choices], type=values.type)
+    labels = pa.array([label for _, label in choices], type=pa.string())
+    codes = pc.index_in(values, value_set=value_set).cast(pa.int8())
+    return pa.DictionaryArray.from_arrays(codes, labels)
+
+
+def write_batches(filename: str, batches, schema: pa.Schema, metadata: dict = None) -> dict:
+    """
+    Write record batches to a parquet file, one row group per batch.
+
+    :param filename: Parquet save location, may be local file path or S3 location (s3://)
+    :param batches: An iterable of pyarrow RecordBatch objects
+    :param schema: The table schema
+    :param metadata: A dict of optional ONE metadata
+    :return: A dict of the number of records ('nrecs'), row groups ('row_groups') and the
+     file size in bytes ('size'), as reported by the writer
+    """
+    schema = schema.with_metadata({
+        **(schema.metadata or {}), b'one_metadata': json.dumps(metadata or {}).encode()})
+    path, filesystem = _output_path(filename)
+    sink = filesystem.open_output_stream(path) if filesystem else pa.OSFile(path, 'wb')
+    with sink:
+        with pq.ParquetWriter(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+        size = sink.tell()
+    file_metadata = writer.writer.metadata
+    return {'nrecs': file_metadata.num_rows, 'size': size,
+            'row_groups': file_metadata.num_row_groups}
+
+
+def _partition_dir(keys) -> str:
+    """Return the Hive-style directory of a partition, e.g. 'lab=cortexlab/year=2020/month=1'."""
+    return '/'.join(
+        f'{name}=' + ('__HIVE_DEFAULT_PARTITION__' if value is None
+                      else urllib.parse.quote(str(value), safe=''))
+        for name, value in zip(PARTITIONING.names, keys))
+
+
+def write_partitioned(base_dir: str, batches, schema: pa.Schema, metadata: dict | None = None,
+                      row_group_size: int = 100_000) -> dict:
+    """
+    Write record batches as a Hive-style parquet dataset partitioned by lab, year and month.
+
+    The batches must be sorted by the PARTITIONING columns, so that each partition file is
+    written in turn.  Partition files are named <base_dir>/lab=<lab>/year=<year>/month=<month>/
+    part-0.parquet and do not contain the PARTITIONING columns.  The rows keep their order
+    within each partition and the files contain min/max column statistics for each row group,
+    so that readers may skip files and row groups using the partition keys and sort key.
+
+    Any previous partitions in base_dir are replaced once the new ones are complete.  Local
+    datasets are written to a partial <base_dir>.part directory, which is then renamed to
+    base_dir.  On S3, where each file is replaced when its upload completes, the previous
+    partition files that weren't overwritten are removed after writing.
+
+    :param base_dir: Dataset save location, may be local path or S3 location (s3://)
+    :param batches: An iterable of pyarrow RecordBatch objects, including the PARTITIONING
+     columns
+    :param schema: The table schema, including the PARTITIONING columns
+    :param metadata: A dict of optional ONE metadata
+    :param row_group_size: The maximum number of rows per row group
+    :return: A dict of the number of records ('nrecs'), the size in bytes ('size'), the
+     partitioning field names ('partitioning') and the partitions ('partitions'), a list of
+     dicts with the file path relative to base_dir ('path'), the partition keys, 'nrecs' and
+     'size'
+    """
+    n_keys = len(PARTITIONING)
+    file_schema = pa.schema(list(schema)[:-n_keys], metadata={
+        **(schema.metadata or {}), b'one_metadata': json.dumps(metadata or {}).encode()})
+    path, filesystem = _output_path(base_dir)
+    if filesystem is None:
+        filesystem, path = pa.fs.LocalFileSystem(), str(Path(path).absolute())
+        # Write to a partial directory so that the previous partitions are served until complete
+        out_dir = f'{path}.part'
+    else:
+        out_dir = path
+    filesystem.create_dir(out_dir)
+    if out_dir != path:
+        filesystem.delete_dir_contents(out_dir)  # Remove any previous partial dataset
+
+    partitions, pending = [], []
+    sink = writer = None
+
+    def flush():
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending, schema=file_schema))
+            pending.clear()
+
+    def close():
+        flush()
+        writer.close()
+        partitions[-1]['size'] = sink.tell()
+        sink.close()
+
+    try:
+        for batch in batches:
+            for key, offset, length in _key_runs(batch.columns[-n_keys:]):
+                if not partitions or partitions[-1]['key'] != key:
+                    if writer:  # Close the previous partition
+                        close()
+                    relative_path = f'{_partition_dir(key)}/part-0.parquet'
+                    filesystem.create_dir(f'{out_dir}/{_partition_dir(key)}')
+                    sink = filesystem.open_output_stream(f'{out_dir}/{relative_path}')
+                    writer = pq.ParquetWriter(sink, file_schema)
+                    partitions.append({'key': key, 'path': relative_path, 'nrecs': 0})
+                pending.append(pa.RecordBatch.from_arrays(
+                    batch.slice(offset, length).columns[:-n_keys], schema=file_schema))
+                partitions[-1]['nrecs'] += length
+                if sum(map(len, pending)) >= row_group_size:
+                    flush()
+        if writer:
+            close()
+        _replace_dir(filesystem, out_dir, path, keep=[x['path'] for x in partitions])
+    finally:
+        if sink is not None and not sink.closed:
+            if writer is not None:
+                writer.close()
+            sink.close()
+        if out_dir != path and filesystem.get_file_info(out_dir).type != pa.fs.FileType.NotFound:
+            filesystem.delete_dir(out_dir)  # Writing failed
+
+    for partition in partitions:
+        partition.update(zip(PARTITIONING.names, partition.pop('key')))
+    return {'nrecs': sum(x['nrecs'] for x in partitions),
+            'size': sum(x['size'] for x in partitions),
+            'partitioning': PARTITIONING.names,
+            'partitions': partitions}
+
+
+def _replace_dir(filesystem: pa.fs.FileSystem, src: str, dst: str, keep=()):
+    """
+    Replace a directory with another one, or remove the files of a directory that weren't kept.
+
+    :param filesystem: The pyarrow filesystem of the directories
+    :param src: The directory with the new files; if the same as dst, the files of dst not in
+     keep are removed
+    :param dst: The directory to replace
+    :param keep: The file paths relative to dst to keep when src is the same as dst
+    """
+    if src == dst:
+        keep = {f'{dst}/{x}' for x in keep}
+        for info in filesystem.get_file_info(pa.fs.FileSelector(dst, recursive=True)):
+            if info.type == pa.fs.FileType.File and info.path not in keep:
+                filesystem.delete_file(info.path)
+        return
+    # A directory can't be renamed over another one: the previous directory is moved aside
+    # first, so that dst is only missing between the two renames
+    old_dir = f'{dst}.old'
+    if filesystem.get_file_info(old_dir).type != pa.fs.FileType.NotFound:
+        filesystem.delete_dir(old_dir)
+    if filesystem.get_file_info(dst).type != pa.fs.FileType.NotFound:
+        filesystem.move(dst, old_dir)
+    filesystem.move(src, dst)
+    if filesystem.get_file_info(old_dir).type != pa.fs.FileType.NotFound:
+        filesystem.delete_dir(old_dir)
+
+
+def _key_runs(columns) -> list:
+    """
+    Find the runs of consecutive rows with equal keys.
+
+    :param columns: A list of equal length key arrays
+    :return: A list of tuples of the key values, the run offset and length
+    """
+    n = len(columns[0])
+    changed = np.zeros(n, dtype=bool)
+    changed[:1] = True
+    for column in columns:
+        if not pa.types.is_integer(column.type):
+            column = column.dictionary_encode().indices
+        codes = pc.fill_null(column, -1).to_numpy()
+        changed[1:] |= codes[1:] != codes[:-1]
+    offsets = np.flatnonzero(changed)
+    lengths = np.diff(offsets, append=n)
+    keys = zip(*(column.take(offsets).to_pylist() for column in columns))
+    return list(zip(keys, offsets.tolist(), lengths.tolist()))
+
+
+def sessions_partitioned_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert a sessions frame to a table with the PARTITIONING columns.
+
+    The table is sorted by the PARTITIONING columns then the session UUID.
+
+    :param df: A sessions frame, as returned by generate_sessions_frame
+    :return: A pyarrow table with the PARTITIONING columns last
+    """
+    table = pa.Table.from_pandas(df)
+    date = table['date'].cast(pa.date32())
+    lab = table['lab']
+    table = (table
+             .drop_columns(['lab'])
+             .append_column(PARTITIONING.field('lab'), lab)
+             .append_column(PARTITIONING.field('year'), pc.year(date).cast(pa.int16()))
+             .append_column(PARTITIONING.field('month'), pc.month(date).cast(pa.int8())))
+    return table.sort_by([(x, 'ascending') for x in (*PARTITIONING.names, 'id')])
+
+
+def dataset_queryset_to_dataframe(ds: QuerySet, batch_size: int = 100_000,
+                                  backend: str = 'orm') -> pd.DataFrame:
+    batches = dataset_batches(backend)(ds, batch_size)
+    table = pa.Table.from_batches(batches, schema=DATASETS_SCHEMA)
+    df = table.to_pandas()
+    logger.debug(f'Final datasets frame = {getsizeof(df) / 1024 ** 2:.1f} MiB')
+    return df
 
 
 @measure_time
-def generate_sessions_frame(tags=None) -> pd.DataFrame:
+def generate_sessions_frame(tags=None, modified_since=None, session_ids=None,
+                            backend='orm') -> pd.DataFrame:
     """SESSIONS_COLUMNS = (
         'id',               # uuid str
         'lab',              # str
@@ -390,24 +1208,29 @@ def generate_sessions_frame(tags=None) -> pd.DataFrame:
     query = (Session
              .objects
              .select_related('subject', 'lab')
-             .prefetch_related('projects')
-             .annotate(all_projects=ArrayAgg('projects__name'))
              .order_by('-start_time', 'subject__nickname', '-number'))  # FIXME Ignores nickname :(
     if tags:
         if not isinstance(tags, str):
             query = query.filter(data_dataset_session_related__tags__name__in=tags)
         else:
             query = query.filter(data_dataset_session_related__tags__name=tags)
+    if modified_since:
+        query = query.filter(auto_datetime__gte=modified_since)
+    if session_ids is not None:
+        query = query.filter(pk__in=session_ids)
 
     if query.count() == 0:
         logger.warning(f'No datasets associated with sessions found for {tags}, '
                        f'returning empty dataframe')
         return pd.DataFrame(columns=SESSIONS_COLUMNS).set_index('id')
+    if backend == 'copy':
+        return session_queryset_to_dataframe_copy(query)
     return session_queryset_to_dataframe(query)
 
 
 @measure_time
-def generate_datasets_frame(tags=None, batch_size=100_000) -> pd.DataFrame:
+def generate_datasets_frame(tags=None, batch_size=100_000, modified_since=None,
+                            backend='orm') -> pd.DataFrame:
     """DATASETS_COLUMNS = (
         'id',               # uuid str
         'eid',              # uuid str
@@ -417,6 +1240,22 @@ def generate_datasets_frame(tags=None, batch_size=100_000) -> pd.DataFrame:
         'exists'            # bool
     )
     """
+    ds = datasets_queryset(tags=tags, modified_since=modified_since)
+    df = dataset_queryset_to_dataframe(ds, batch_size, backend=backend)
+    if df.empty:
+        logger.warning(f'No datasets associated with sessions found for {tags}, '
+                       f'returning empty dataframe')
+    return df
+
+
+def datasets_queryset(tags=None, modified_since=None) -> QuerySet:
+    """
+    Return the datasets of the datasets table.
+
+    :param tags: List of tag names to filter datasets by
+    :param modified_since: If given, only return the datasets modified at or after this time
+    :return: A Dataset queryset of datasets with a session that exist on FlatIron or AWS
+    """
     # Determine which file records are on AWS and which are on FlatIron
     fr = FileRecord.objects.select_related('data_repository')
     on_flatiron = fr.filter(dataset=OuterRef('pk'),
@@ -428,20 +1267,425 @@ def generate_datasets_frame(tags=None, batch_size=100_000) -> pd.DataFrame:
     # Fetch datasets and their related tables
     ds = Dataset.objects
     if tags:
-        kw = {'tags__name__in' if not isinstance(tags, str) else 'tags__name': tags}
-        ds = ds.prefetch_related('tag').filter(**kw)
+        tags = [tags] if isinstance(tags, str) else tags
+        # NB: Unlike a join, the subquery returns datasets with several of the tags once
+        tagged = Dataset.tags.through.objects.filter(dataset=OuterRef('pk'), tag__name__in=tags)
+        ds = ds.filter(Exists(tagged))
     # Filter out datasets that do not exist on either repository or have no associated session
     ds = ds.annotate(exists_flatiron=Exists(on_flatiron), exists_aws=Exists(on_aws))
     ds = ds.filter(Q(exists_flatiron=True) | Q(exists_aws=True), session__isnull=False)
+    if modified_since:
+        ds = ds.filter(auto_datetime__gte=modified_since)
+    return ds
+
+
+def save_tag_membership(filename, batch_size: int = 100_000) -> list:
+    """
+    Save the dataset tag membership to a parquet table with columns ('tag', 'id', 'eid').
+
+    :param filename: The parquet file path
+    :param batch_size: The number of memberships to fetch and write at a time
+    :return: The sorted names of the tags with datasets
+    """
+    schema = pa.schema([('tag', pa.string()), ('id', pa.string()), ('eid', pa.string())])
+    rows = (Dataset.tags.through.objects
+            .filter(dataset__session__isnull=False)
+            .order_by('tag__name')
+            .values_list('tag__name', 'dataset_id', 'dataset__session_id')
+            .iterator(chunk_size=batch_size))
+    tags = set()
+    with pq.ParquetWriter(filename, schema) as writer:
+        while batch := list(islice(rows, batch_size)):
+            tag, pk, eid = zip(*batch)
+            tags.update(tag)
+            writer.write_batch(pa.RecordBatch.from_arrays([
+                pa.array(tag, type=pa.string()),
+                uuid_strings(pk),
+                uuid_strings(eid),
+            ], schema=schema))
+    return sorted(tags)
 
-    if ds.count() == 0:
-        logger.warning(f'No datasets associated with sessions found for {tags}, '
-                       f'returning empty dataframe')
-        return (pd.DataFrame(columns=DATASETS_COLUMNS)
-                .set_index(['eid', 'id'])
-                .astype({'qc': QC_TYPE, 'file_size': np.uint64}))
 
-    return dataset_queryset_to_dataframe(ds)
+def tagged_sessions(tags) -> QuerySet:
+    """
+    Return the sessions with datasets that have any of the given tags.
+
+    :param tags: A tag name or list of tag names
+    :return: A Session queryset
+    """
+    tags = [tags] if isinstance(tags, str) else tags
+    tagged = Dataset.tags.through.objects.filter(
+        dataset__session=OuterRef('pk'), tag__name__in=tags)
+    return Session.objects.filter(Exists(tagged))
+
+
+def register_table(name: str, schema: pa.Schema, eid_column: str | None = 'eid'):
+    """
+    Register a generator of an additional cache table, saved as <name>.pqt.
+
+    The decorated function takes a Session queryset to restrict the table to (None for all
+    sessions) and a batch size, and returns an iterable of record batches with the schema.
+
+    :param name: The table name, as passed to the --tables option
+    :param schema: The pyarrow schema of the table
+    :param eid_column: The column of session UUIDs by which the table is filtered for each tag
+     with --all-tags; if None the table can't be generated with --all-tags
+    """
+    def decorator(func):
+        TABLES[name] = (schema, func, eid_column)
+        return func
+    return decorator
+
+
+def _indexed_schema(*fields) -> pa.Schema:
+    """Return the schema of the fields, including the pandas metadata of an 'id' index."""
+    schema = pa.schema(fields)
+    df = schema.empty_table().to_pandas().set_index('id')
+    return pa.Table.from_pandas(df, schema=schema).schema
+
+
+# Additional cache tables: name -> (schema, batch generator, eid column); see register_table
+TABLES = {}
+TRAJECTORY_FIELDS = ('x', 'y', 'z', 'depth', 'theta', 'phi', 'roll')
+_DICTIONARY = pa.dictionary(pa.int8(), pa.string())
+INSERTIONS_SCHEMA = _indexed_schema(
+    ('eid', pa.string()), ('name', pa.string()), ('model', pa.string()),
+    ('serial', pa.string()), ('qc', DATASETS_SCHEMA.field('qc').type),
+    ('provenance', _DICTIONARY), *((x, pa.float64()) for x in TRAJECTORY_FIELDS),
+    ('brain_regions', pa.string()), ('id', pa.string()))
+SUBJECTS_SCHEMA = _indexed_schema(
+    ('nickname', pa.string()), ('lab', pa.string()), ('sex', pa.string()),
+    ('species', pa.string()), ('strain', pa.string()), ('line', pa.string()),
+    ('birth_date', pa.date32()), ('death_date', pa.date32()), ('projects', pa.string()),
+    ('id', pa.string()))
+TASKS_SCHEMA = _indexed_schema(
+    ('eid', pa.string()), ('name', pa.string()), ('status', _DICTIONARY),
+    ('version', pa.string()), ('graph', pa.string()), ('executable', pa.string()),
+    ('time_elapsed_secs', pa.float64()), ('datetime', pa.timestamp('us')), ('id', pa.string()))
+
+
+@register_table('insertions', INSERTIONS_SCHEMA)
+def iter_insertion_batches(sessions: QuerySet | None = None, batch_size: int = 10_000):
+    """
+    Iterate over probe insertions as record batches of the insertions table.
+
+    Each insertion is summarized by its trajectory estimate of highest provenance and the sorted
+    acronyms of the brain regions of that trajectory's channels.  The trajectories of a batch
+    of insertions are fetched in one query and aligned to the insertions by a pyarrow lookup.
+
+    :param sessions: A Session queryset of the insertions to include; if None, all insertions
+    :param batch_size: The number of insertions per batch
+    :return: A generator of pyarrow RecordBatch objects with the INSERTIONS_SCHEMA schema
+    """
+    query = ProbeInsertion.objects.filter(session__isnull=False)
+    if sessions is not None:
+        query = query.filter(session__in=sessions.values('pk'))
+    rows = (query
+            .annotate(qc=KeyTextTransform('qc', 'json'))
+            .order_by('session', 'name')
+            .values_list('pk', 'session', 'name', 'model__probe_model', 'serial', 'qc')
+            .iterator(chunk_size=batch_size))
+    regions = (Channel.objects
+               .filter(trajectory_estimate=OuterRef('pk'))
+               .values('trajectory_estimate')
+               .annotate(acronyms=StringAgg('brain_region__acronym', ',', distinct=True,
+                                            order_by='brain_region__acronym'))
+               .values('acronyms'))
+    fields = ('provenance', *TRAJECTORY_FIELDS, 'brain_regions')
+    while batch := list(islice(rows, batch_size)):
+        pk, eid, name, model, serial, qc = zip(*batch)
+        pids = uuid_strings(pk)
+        # The trajectory of highest provenance of each insertion
+        trajectories = list(TrajectoryEstimate.objects
+                            .filter(probe_insertion__in=pk)
+                            .order_by('probe_insertion', '-provenance')
+                            .distinct('probe_insertion')
+                            .annotate(brain_regions=Coalesce(Subquery(regions), Value(''),
+                                                          output_field=TextField()))
+                            .values_list('probe_insertion', *fields))
+        trajectory_pid, provenance, *coordinates, brain_regions = \
+            zip(*trajectories) if trajectories else ((),) * (len(fields) + 1)
+        index = pc.index_in(pids, value_set=uuid_strings(trajectory_pid))
+        qc = pc.fill_null(pa.array(qc, type=pa.string()), QC.NOT_SET.name)
+        arrays = [
+            uuid_strings(eid),
+            pa.array(name, type=pa.string()),
+            pa.array(model, type=pa.string()),
+            pa.array(serial, type=pa.string()),
+            pa.DictionaryArray.from_arrays(
+                pc.index_in(qc, value_set=_QC_DICTIONARY).cast(pa.int8()), _QC_DICTIONARY,
+                ordered=True),
+            choices_dictionary_array(pc.take(pa.array(provenance, type=pa.int64()), index),
+                                     TrajectoryEstimate.INSERTION_DATA_SOURCES),
+            *(pc.take(pa.array(x, type=pa.float64()), index) for x in coordinates),
+            pc.take(pa.array(brain_regions, type=pa.string()), index),
+            pids,
+        ]
+        yield pa.RecordBatch.from_arrays(arrays, schema=INSERTIONS_SCHEMA)
+
+
+@register_table('subjects', SUBJECTS_SCHEMA, eid_column=None)
+def iter_subject_batches(sessions: QuerySet | None = None, batch_size: int = 10_000):
+    """
+    Iterate over subjects as record batches of the subjects table.
+
+    :param sessions: A Session queryset of the subjects to include; if None, all subjects
+    :param batch_size: The number of subjects per batch
+    :return: A generator of pyarrow RecordBatch objects with the SUBJECTS_SCHEMA schema
+    """
+    query = Subject.objects.all()
+    if sessions is not None:
+        query = query.filter(Exists(sessions.filter(subject=OuterRef('pk'))))
+    rows = (_annotate_projects(query)
+            .order_by('lab__name', 'nickname')
+            .values_list('pk', 'nickname', 'lab__name', 'sex', 'species__nickname',
+                         'strain__name', 'line__nickname', 'birth_date', 'death_date',
+                         'projects_csv')
+            .iterator(chunk_size=batch_size))
+    while batch := list(islice(rows, batch_size)):
+        pk, *columns = zip(*batch)
+        arrays = [pa.array(x, type=field.type) for x, field in zip(columns, SUBJECTS_SCHEMA)]
+        yield pa.RecordBatch.from_arrays([*arrays, uuid_strings(pk)], schema=SUBJECTS_SCHEMA)
+
+
+@register_table('tasks', TASKS_SCHEMA)
+def iter_task_batches(sessions: QuerySet | None = None, batch_size: int = 10_000):
+    """
+    Iterate over the tasks of sessions as record batches of the tasks table.
+
+    :param sessions: A Session queryset of the tasks to include; if None, the tasks of all
+     sessions
+    :param batch_size: The number of tasks per batch
+    :return: A generator of pyarrow RecordBatch objects with the TASKS_SCHEMA schema
+    """
+    query = Task.objects.filter(session__isnull=False)
+    if sessions is not None:
+        query = query.filter(session__in=sessions.values('pk'))
+    rows = (query
+            .order_by('session', 'level', 'name')
+            .values_list('pk', 'session', 'name', 'status', 'version', 'graph', 'executable',
+                         'time_elapsed_secs', 'datetime')
+            .iterator(chunk_size=batch_size))
+    while batch := list(islice(rows, batch_size)):
+        pk, eid, name, status, version, graph, executable, time_elapsed, modified = zip(*batch)
+        arrays = [
+            uuid_strings(eid),
+            pa.array(name, type=pa.string()),
+            choices_dictionary_array(pa.array(status, type=pa.int64()),
+                                     Task.STATUS_DATA_SOURCES),
+            pa.array(version, type=pa.string()),
+            pa.array(graph, type=pa.string()),
+            pa.array(executable, type=pa.string()),
+            pa.array(time_elapsed, type=pa.float64()),
+            pa.array(modified, type=pa.timestamp('us')),
+            uuid_strings(pk),
+        ]
+        yield pa.RecordBatch.from_arrays(arrays, schema=TASKS_SCHEMA)
+
+
+def build_tag_tables(tag, tmp, dst_dir, tables, metadata, compress=False, export_qc=False):
+    """
+    Save the tables of a dataset tag to <dst_dir>/<tag>/.
+
+    The tables are filtered from the tables of all tagged datasets in the tmp directory, as
+    saved by Command.generate_all_tag_tables.
+
+    :param tag: The tag name
+    :param tmp: The directory of the membership table and the tables of all tagged datasets
+    :param dst_dir: The cache directory, may be local path or s3 URI starting s3://
+    :param tables: A tuple of table names
+    :param metadata: The ONE metadata of the tables
+    :param compress: If true, save the tables into a compressed folder
+    :param export_qc: If true, the extended QC will be saved to a JSON file
+    :return: A dict with keys ('tag', 'sessions', 'datasets', 'files', 'time')
+    """
+    t0 = time()
+    command = Command()
+    scheme = urllib.parse.urlparse(dst_dir).scheme or 'file'
+    if scheme == 'file':
+        command.dst_dir = str(Path(dst_dir) / tag)
+    else:
+        command.dst_dir = f'{dst_dir.rstrip("/")}/{tag}'
+    command.compress = compress
+    previous_metadata = load_metadata(command.dst_dir, tables)
+    command.metadata = {**metadata, 'database_tags': [tag],
+                        'cache_version': int(previous_metadata.get('cache_version', 0)) + 1}
+    members = pq.read_table(Path(tmp) / 'membership.pqt', filters=[('tag', '=', tag)])
+    eids = pc.unique(members['eid'])
+    to_compress, counts = {}, {'sessions': None, 'datasets': None}
+    with command._staging():
+        for name in tables:
+            table = pq.read_table(Path(tmp) / f'{name}.pqt', memory_map=True)
+            ids = members['id'] if name == 'datasets' else eids
+            column = TABLES[name][2] if name in TABLES else 'id'
+            table = table.filter(pc.is_in(table[column], value_set=ids))
+            filename = command._filename(f'{name}.pqt')
+            info = write_batches(filename, table.to_batches(), table.schema, command.metadata)
+            to_compress[filename] = info
+            counts[name] = info['nrecs']
+        if export_qc:
+            with open(Path(tmp) / 'QC.jsonl') as fp:
+                eid_set = set(eids.to_pylist())
+                records = map(json.loads, fp)
+                qc = (d for d in records if d['eid'] in eid_set)
+                _, filename = command._save_qc(qc=qc)
+            if filename is not None:
+                to_compress[filename] = None
+        if compress and to_compress:
+            files = list(command._compress_tables(to_compress))
+        else:
+            files = list(to_compress.keys())
+    return {'tag': tag, **counts, 'files': [str(x) for x in files], 'time': time() - t0}
+
+
+def format_timing_report(report: dict) -> str:
+    """Format the timing report returned by Command.generate_all_tag_tables."""
+    lines = [f'{"tag":<40} {"sessions":>10} {"datasets":>12} {"seconds":>9}']
+    for row in report['tags']:
+        n_sessions, n_datasets = (
+            '-' if row[x] is None else f'{row[x]:,}' for x in ('sessions', 'datasets'))
+        lines.append(f'{row["tag"]:<40} {n_sessions:>10} {n_datasets:>12} {row["time"]:>9.2f}')
+    lines.append(f'Queried all tags in {report["query_time"]:.2f} seconds; '
+                 f'saved {len(report["tags"])} tag(s) with {report["workers"]} worker(s) '
+                 f'in {report["total_time"]:.2f} seconds in total')
+    return '\n'.join(lines)
+
+
+def iter_qc_records(tags=None, batch_size: int = 1000):
+    """
+    Iterate over the QC of sessions and their probe insertions.
+
+    Sessions are fetched from a server-side cursor in batches, and the insertions of each batch
+    are indexed by session, so that only one batch of extended QC is held in memory at a time.
+
+    :param tags: List of tag names to filter sessions by
+    :param batch_size: The number of sessions to fetch at a time
+    :return: A generator of session QC dicts with keys ('eid', 'qc_outcome', 'extended_qc') and
+     optionally 'probe_insertions'
+    """
+    sessions = tagged_sessions(tags) if tags else Session.objects.all()
+    rows = (sessions
+            .order_by('pk')
+            .values_list('pk', 'qc', 'extended_qc')
+            .iterator(chunk_size=batch_size))
+    outcome_map = dict(Session.QC_CHOICES)
+    n_records = 0
+    while batch := list(islice(rows, batch_size)):
+        # Fetch insertion QC for this batch of sessions, indexed by session
+        insertions = (ProbeInsertion.objects
+                      .filter(session__in=[pk for pk, *_ in batch], json__has_key='extended_qc')
+                      .order_by('session', 'name')
+                      .values_list('session', 'pk', 'name', 'json'))
+        insertion_qc = {}
+        for eid, pk, name, data in insertions:
+            insertion_qc.setdefault(eid, []).append({
+                'pid': str(pk),
+                'probe_name': name,
+                'qc_outcome': data.get('qc', 'NOT_SET'),
+                'extended_qc': data['extended_qc']
+            })
+        for eid, qc, extended_qc in batch:
+            d = {'eid': str(eid), 'qc_outcome': outcome_map[qc], 'extended_qc': extended_qc}
+            if eid in insertion_qc:
+                d['probe_insertions'] = insertion_qc[eid]
+            yield d
+        n_records += len(batch)
+    logger.debug('Fetched %i QC records', n_records)
+
+
+def write_qc(filename: str, records) -> int:
+    """
+    Write QC records to a JSON file, one record at a time.
+
+    The file contains a JSON array of the records, as for json.dump, but the records are
+    encoded and written as they are iterated over.
+
+    :param filename: Save location, may be local file path or S3 location (starting s3://)
+    :param records: An iterable of QC dicts, e.g. from iter_qc_records
+    :return: The number of records written
+    """
+    path, filesystem = _output_path(filename)
+    sink = filesystem.open_output_stream(path) if filesystem else pa.OSFile(path, 'wb')
+    n_records = 0
+    with sink:
+        sink.write(b'[')
+        for record in records:
+            if n_records:
+                sink.write(b', ')
+            sink.write(json.dumps(record).encode())
+            n_records += 1
+        sink.write(b']')
+    return n_records
+
+
+def get_deleted(since: datetime) -> tuple:
+    """
+    Return the sessions and datasets deleted since a given time.
+
+    :param since: The earliest deletion time
+    :return: A set of deleted session UUID strings and a set of deleted dataset UUID strings
+    """
+    tombstones = Tombstone.objects.filter(deleted_datetime__gte=since)
+    content_types = ContentType.objects.get_for_models(Session, Dataset)
+    sessions, datasets = (
+        set(map(str, tombstones
+                .filter(content_type=content_types[model])
+                .values_list('object_id', flat=True)))
+        for model in (Session, Dataset))
+    logger.debug('%i sessions and %i datasets deleted since %s',
+                 len(sessions), len(datasets), since)
+    return sessions, datasets
+
+
+@measure_time
+def update_sessions_frame(previous: pd.DataFrame, since: datetime,
+                          deleted_sessions=()) -> pd.DataFrame:
+    """
+    Update a sessions frame with the sessions modified or deleted since a given time.
+
+    :param previous: The previous sessions frame
+    :param since: Sessions modified at or after this time are updated
+    :param deleted_sessions: The UUID strings of deleted sessions to remove
+    :return: The updated sessions frame
+    """
+    modified = Session.objects.filter(auto_datetime__gte=since).values_list('pk', flat=True)
+    removed = set(map(str, modified)) | set(deleted_sessions)
+    updated = generate_sessions_frame(modified_since=since)
+    keep = ~previous.index.isin(removed)
+    df = previous[keep]
+    if not updated.empty:
+        df = pd.concat([df, updated])
+    logger.debug('Sessions frame updated: %i removed or modified, %i (re)added',
+                 (~keep).sum(), len(updated))
+    return sort_sessions_frame(df)
+
+
+@measure_time
+def update_datasets_frame(previous: pd.DataFrame, since: datetime,
+                          deleted_sessions=(), deleted_datasets=()) -> pd.DataFrame:
+    """
+    Update a datasets frame with the datasets modified or deleted since a given time.
+
+    Modified datasets are removed from the frame and re-added if they still exist on a
+    repository.
+
+    :param previous: The previous datasets frame
+    :param since: Datasets modified at or after this time are updated
+    :param deleted_sessions: The UUID strings of deleted sessions whose datasets to remove
+    :param deleted_datasets: The UUID strings of deleted datasets to remove
+    :return: The updated datasets frame
+    """
+    modified = Dataset.objects.filter(auto_datetime__gte=since).values_list('pk', flat=True)
+    removed = set(map(str, modified)) | set(deleted_datasets)
+    updated = generate_datasets_frame(modified_since=since)
+    keep = ~(previous.index.get_level_values('id').isin(removed) |
+             previous.index.get_level_values('eid').isin(set(deleted_sessions)))
+    df = previous[keep]
+    if not updated.empty:
+        df = pd.concat([df, updated])
+    logger.debug('Datasets frame updated: %i removed or modified, %i (re)added',
+                 (~keep).sum(), len(updated))
+    return df.sort_index()
 
 
 def create_metadata() -> dict:
@@ -453,8 +1697,8 @@ def create_metadata() -> dict:
 
 def update_table_metadata(table: pa.Table, metadata: dict) -> pa.Table:
     """Add ONE metadata to parquet table"""
-    # Add user metadata
+    # Add user metadata, replacing any existing ONE metadata
     return table.replace_schema_metadata({
-        'one_metadata': json.dumps(metadata or {}).encode(),
-        **table.schema.metadata
+        **(table.schema.metadata or {}),
+        b'one_metadata': json.dumps(metadata or {}).encode()
     })
@@ -0,0 +1,293 @@
+import io
+import logging
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from data.models import DataFormat, DataRepository, DatasetType, Revision, Tag
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from one.alf.spec import QC
+from subjects.models import Project, Subject
+
+from misc.management.commands.one_cache import uuid_strings
+from misc.models import Lab
+
+logger = logging.getLogger(__name__)
+# Dataset collections and their frequencies
+COLLECTIONS = {
+    'alf': .35, 'alf/probe00': .15, 'alf/probe01': .15, 'raw_ephys_data/probe00': .1,
+    'raw_ephys_data/probe01': .1, 'raw_video_data': .1, 'raw_behavior_data': .05
+}
+# Session and dataset QC frequencies
+QC_FREQUENCIES = {QC.NOT_SET: .5, QC.PASS: .3, QC.WARNING: .1, QC.FAIL: .07, QC.CRITICAL: .03}
+TASK_PROTOCOLS = ('ephysChoiceWorld', 'trainingChoiceWorld', 'biasedChoiceWorld',
+                  'passiveChoiceWorld', 'habituationChoiceWorld')
+N_DATASET_TYPES = 60
+
+
+class Command(BaseCommand):
+    """
+        ./manage.py synthetic_db --datasets 1000000
+        ./manage.py synthetic_db --datasets 10000000 --labs 20 --tags 40 --seed 1
+    """
+    help = "Bulk-generate a synthetic archive of sessions, datasets, file records and tags."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasets', type=int, required=True,
+                            help='Number of datasets to generate')
+        parser.add_argument('--datasets-per-session', type=int, default=100,
+                            help='Mean number of datasets per session')
+        parser.add_argument('--labs', type=int, default=10)
+        parser.add_argument('--subjects', type=int, default=None,
+                            help='Number of subjects; by default one per 20 sessions')
+        parser.add_argument('--tags', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the generated distributions')
+
+    def handle(self, *args, **options):
+        t0 = time.perf_counter()
+        with transaction.atomic():
+            counts = generate_synthetic_db(
+                options['datasets'], datasets_per_session=options['datasets_per_session'],
+                n_labs=options['labs'], n_subjects=options['subjects'], n_tags=options['tags'],
+                seed=options['seed'])
+        for table, n in counts.items():
+            self.stdout.write(f'{table:>16}: {n:12,}')
+        self.stdout.write(f'generated in {time.perf_counter() - t0:.1f} s')
+
+
+def generate_synthetic_db(n_datasets, datasets_per_session=100, n_labs=10, n_subjects=None,
+                          n_tags=20, seed=0, chunk_size=1_000_000) -> dict:
+    """
+    Generate a synthetic archive of sessions, datasets, file records and tags.
+
+    The sessions, datasets, file records, probe insertions and tag memberships are written with
+    PostgreSQL COPY, in chunks of sessions of about chunk_size datasets; the labs, subjects,
+    repositories, dataset types and tags are created with the ORM.  The distributions are
+    skewed as in a real archive:
+
+    - subjects per lab follow a Zipf law, and the i-th tag covers 30% / i of the sessions;
+    - sessions per subject and datasets per session are log-normal, and sessions become more
+      frequent over time;
+    - most datasets are in a few collections and of a few dataset types, most have no QC set,
+      and file sizes are log-normal;
+    - all datasets have a FlatIron file record, of which 3% don't exist; 70% are also on AWS
+      and 20% have a missing file record on their lab's server;
+    - 40% of sessions have two probe insertions, and half of the sessions have extended QC.
+
+    :param n_datasets: The number of datasets to generate
+    :param datasets_per_session: The mean number of datasets per session
+    :param n_labs: The number of labs
+    :param n_subjects: The number of subjects; by default one per 20 sessions
+    :param n_tags: The number of dataset tags
+    :param seed: The seed of the distributions; the UUIDs and names are always unique
+    :param chunk_size: The approximate number of datasets to copy at a time
+    :return: A dict of table names and the number of rows added
+    """
+    rng = np.random.default_rng(seed)
+    token = uuid.uuid4().hex[:8]  # Unique names, so that archives can be added repeatedly
+    n_sessions = max(1, n_datasets // datasets_per_session)
+    n_subjects = n_subjects or max(1, n_sessions // 20)
+    now = timezone.now()
+
+    labs = Lab.objects.bulk_create(Lab(name=f'synthetic_{token}_{i:03d}') for i in range(n_labs))
+    projects = Project.objects.bulk_create(
+        Project(name=f'synthetic_{token}_{i:03d}') for i in range(max(1, n_labs // 2)))
+    subject_lab = rng.choice(n_labs, n_subjects, p=_zipf(n_labs))
+    subjects = Subject.objects.bulk_create(
+        Subject(nickname=f'SYN{i:06d}', lab=labs[lab], sex='MF'[i % 2])
+        for i, lab in enumerate(subject_lab))
+    repositories = {
+        name: DataRepository.objects.create(
+            name=f'{name}_{token}', globus_path='/', globus_is_personal=name == 'server')
+        for name in ('flatiron', 'aws', 'server')}
+    dtypes = [DatasetType.objects.get_or_create(name=f'synthetic{i:02d}.times')[0]
+              for i in range(N_DATASET_TYPES)]
+    dformat, _ = DataFormat.objects.get_or_create(name='npy')
+    revisions = [Revision.objects.create(name=f'synthetic_{token}_{i}') for i in range(3)]
+    tags = Tag.objects.bulk_create(Tag(name=f'synthetic_{token}_{i:03d}') for i in range(n_tags))
+
+    # Sessions: subjects have log-normal numbers of sessions, which grow more frequent in time
+    subject = rng.choice(n_subjects, n_sessions, p=_normalize(rng.lognormal(0, 1, n_subjects)))
+    start = np.datetime64('2017-01-01T00:00', 's')
+    seconds = (np.datetime64('2025-01-01T00:00', 's') - start).astype(np.int64)
+    start_time = start + (rng.random(n_sessions) ** .5 * seconds).astype('timedelta64[s]')
+    # Sessions are numbered per subject and day
+    day = start_time.astype('datetime64[D]')
+    number = pd.DataFrame({'subject': subject, 'day': day}).groupby(
+        ['subject', 'day']).cumcount().to_numpy() + 1
+    session_ids = _random_uuids(n_sessions)
+    subject_ids = uuid_strings([x.pk for x in subjects])
+    lab_ids = uuid_strings([x.pk for x in labs])
+    session_lab = pc.take(pa.array(subject_lab), pa.array(subject))
+    extended_qc = [
+        f'{{"_task_iti_delays": {x:.3f}, "_task_stimOn_delays": {1 - x:.3f}}}' if x < .5
+        else None for x in rng.random(n_sessions)]
+    with connection.cursor() as cursor:
+        _copy(cursor, 'actions_session', {
+            'id': session_ids,
+            'name': pa.repeat('', n_sessions),
+            'narrative': pa.repeat('', n_sessions),
+            'subject_id': pc.take(subject_ids, pa.array(subject)),
+            'lab_id': pc.take(lab_ids, session_lab),
+            'start_time': pa.array(start_time, type=pa.timestamp('s')),
+            'number': pa.array(number),
+            'type': pa.repeat('Experiment', n_sessions),
+            'task_protocol': pc.take(
+                pa.array(TASK_PROTOCOLS), rng.choice(len(TASK_PROTOCOLS), n_sessions,
+                                                     p=_zipf(len(TASK_PROTOCOLS)))),
+            'qc': _choice(rng, QC_FREQUENCIES, n_sessions),
+            'extended_qc': pa.array(extended_qc, type=pa.string()),
+            'auto_datetime': pa.repeat(pa.scalar(now, pa.timestamp('us')), n_sessions),
+        })
+        project_ids = uuid_strings([x.pk for x in projects])
+        _copy(cursor, 'actions_session_projects', {
+            'session_id': session_ids,
+            'project_id': pc.take(project_ids, rng.choice(
+                len(projects), n_sessions, p=_zipf(len(projects))))
+        })
+        # Probe insertions of 40% of the sessions, with extended QC
+        ephys = pc.filter(session_ids, pa.array(rng.random(n_sessions) < .4))
+        n_insertions = 2 * len(ephys)
+        _copy(cursor, 'experiments_probeinsertion', {
+            'id': _random_uuids(n_insertions),
+            'name': pa.array(['probe00', 'probe01'] * len(ephys)),
+            'serial': pa.repeat('', n_insertions),
+            'session_id': pc.take(ephys, np.repeat(np.arange(len(ephys)), 2)),
+            'json': pa.repeat('{"qc": "PASS", "extended_qc": {"tracing_exists": true}}',
+                              n_insertions),
+            'auto_datetime': pa.repeat(pa.scalar(now, pa.timestamp('us')), n_insertions),
+        })
+
+        # Session paths, e.g. 'lab/Subjects/subject/2020-01-01/001'
+        session_path = pc.binary_join_element_wise(
+            pc.take(pa.array([x.name for x in labs]), session_lab), 'Subjects',
+            pc.take(pa.array([x.nickname for x in subjects]), pa.array(subject)),
+            pc.strftime(pa.array(start_time, type=pa.timestamp('s')), '%Y-%m-%d'),
+            pc.utf8_lpad(pc.cast(pa.array(number), pa.string()), 3, '0'), '/')
+        # The i-th tag covers 30% / i of the sessions, with 80% of their datasets
+        session_tags = rng.random((n_sessions, n_tags)) < .3 / np.arange(1, n_tags + 1)
+        n_datasets_per_session = rng.multinomial(
+            n_datasets, _normalize(rng.lognormal(0, 1, n_sessions)))
+        counts = {'sessions': n_sessions, 'probe insertions': n_insertions,
+                  'datasets': 0, 'file records': 0, 'dataset tags': 0}
+        bounds = np.searchsorted(np.cumsum(n_datasets_per_session),
+                                 np.arange(chunk_size, n_datasets, chunk_size))
+        for chunk in np.split(np.arange(n_sessions), bounds + 1):
+            if len(chunk) == 0:
+                continue
+            n = _copy_datasets(cursor, rng, chunk, n_datasets_per_session[chunk], now,
+                               session_ids=session_ids, session_path=session_path,
+                               session_tags=session_tags, dtypes=dtypes, dformat=dformat,
+                               revisions=revisions, repositories=repositories, tags=tags)
+            for key, value in n.items():
+                counts[key] += value
+        cursor.execute('ANALYZE actions_session, experiments_probeinsertion, data_dataset, '
+                       'data_filerecord, data_dataset_tags')
+    logger.info('Generated synthetic archive %s: %s', token, counts)
+    return counts
+
+
+def _copy_datasets(cursor, rng, sessions, n_per_session, now, *, session_ids, session_path,
+                   session_tags, dtypes, dformat, revisions, repositories, tags) -> dict:
+    """Copy the datasets, file records and tag memberships of a chunk of sessions."""
+    session = np.repeat(sessions, n_per_session)
+    n = len(session)
+    ids = _random_uuids(n)
+    dtype = rng.choice(len(dtypes), n, p=_zipf(len(dtypes)))
+    # File names are unique within a session, e.g. 'synthetic00.times.0001.npy'
+    index = np.arange(n) - np.repeat(np.cumsum(n_per_session) - n_per_session, n_per_session)
+    name = pc.binary_join_element_wise(
+        pc.take(pa.array([x.name for x in dtypes]), dtype),
+        pc.utf8_lpad(pc.cast(pa.array(index), pa.string()), 4, '0'), 'npy', '.')
+    collection = pc.take(pa.array(list(COLLECTIONS)), rng.choice(
+        len(COLLECTIONS), n, p=list(COLLECTIONS.values())))
+    revision = pc.if_else(pa.array(rng.random(n) < .02),
+                          pc.take(uuid_strings([x.pk for x in revisions]),
+                                  rng.choice(len(revisions), n)),
+                          pa.scalar(None, pa.string()))
+    _copy(cursor, 'data_dataset', {
+        'id': ids,
+        'name': name,
+        'generating_software': pa.repeat('', n),
+        'data_format_id': pa.repeat(str(dformat.pk), n),
+        'dataset_type_id': pc.take(uuid_strings([x.pk for x in dtypes]), dtype),
+        'collection': collection,
+        'revision_id': revision,
+        'hash': pc.replace_substring(_random_uuids(n), '-', ''),
+        'version': pa.repeat('', n),
+        'default_dataset': pa.repeat(True, n),
+        'qc': _choice(rng, QC_FREQUENCIES, n),
+        'session_id': pc.take(session_ids, session),
+        'file_size': pa.array(rng.lognormal(np.log(1e6), 2.5, n).astype(np.int64)),
+        'auto_datetime': pa.repeat(pa.scalar(now, pa.timestamp('us')), n),
+    })
+    rel_path = pc.binary_join_element_wise(
+        pc.take(session_path, session), collection, name, '/')
+    n_records = 0
+    for repo, fraction, exists in (('flatiron', 1, .97), ('aws', .7, 1), ('server', .2, 0)):
+        on_repo = pa.array(rng.random(n) < fraction)
+        m = pc.sum(on_repo).as_py() or 0
+        _copy(cursor, 'data_filerecord', {
+            'id': _random_uuids(m),
+            'name': pa.repeat('', m),
+            'relative_path': pc.filter(rel_path, on_repo),
+            'exists': pa.array(rng.random(m) < exists),
+            'data_repository_id': pa.repeat(str(repositories[repo].pk), m),
+            'dataset_id': pc.filter(ids, on_repo),
+        })
+        n_records += m
+    n_members = 0
+    for i, tag in enumerate(tags):
+        tagged = pa.array(session_tags[session, i] & (rng.random(n) < .8))
+        m = pc.sum(tagged).as_py() or 0
+        _copy(cursor, 'data_dataset_tags', {
+            'dataset_id': pc.filter(ids, tagged),
+            'tag_id': pa.repeat(str(tag.pk), m),
+        })
+        n_members += m
+    return {'datasets': n, 'file records': n_records, 'dataset tags': n_members}
+
+
+def _copy(cursor, table, columns: dict):
+    """Copy the columns, a dict of column names and pyarrow arrays, into a table."""
+    data = pa.table(columns)
+    if data.num_rows == 0:
+        return
+    buffer = io.BytesIO()
+    pa_csv.write_csv(data, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def _random_uuids(n) -> pa.StringArray:
+    """Return n random version 4 UUID strings."""
+    raw = np.frombuffer(os.urandom(16 * n), np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = raw[:, 6] & 0x0F | 0x40
+    raw[:, 8] = raw[:, 8] & 0x3F | 0x80
+    return uuid_strings(pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(16), n, [None, pa.py_buffer(raw.tobytes())]))
+
+
+def _choice(rng, frequencies: dict, n) -> pa.Int64Array:
+    """Draw n of the keys of a dict of values and their frequencies."""
+    keys = np.array([int(x) for x in frequencies])
+    return pa.array(keys[rng.choice(len(keys), n, p=_normalize(list(frequencies.values())))])
+
+
+def _zipf(n, a=1.2) -> np.ndarray:
+    """Return the probabilities of n ranks following a Zipf law with exponent a."""
+    return _normalize(1 / np.arange(1, n + 1) ** a)
+
+
+def _normalize(weights) -> np.ndarray:
+    weights = np.asarray(weights, dtype=float)
+    return weights / weights.sum()
@@ -1,21 +1,33 @@
+import io
+import json
+import multiprocessing
 import zipfile
 from pathlib import Path
 from datetime import datetime, timedelta
 import tempfile
+import uuid
 import unittest
+from unittest import mock
+from django.core.management import call_command, CommandError
 from django.test import TestCase
 from one.alf.spec import QC
 from one.alf.cache import DATASETS_COLUMNS, SESSIONS_COLUMNS
 import pandas as pd
 
-from subjects.models import Subject
+from subjects.models import Subject, Project
 from misc.models import Housing, HousingSubject, CageType, LabMember, Lab
 from actions.models import Session
-from data.models import Dataset, DatasetType, DataRepository, FileRecord, DataFormat
+from data.models import (
+    Dataset, DatasetType, DataRepository, FileRecord, DataFormat, Tag, Revision)
+from experiments.models import BrainRegion, Channel, ProbeInsertion, TrajectoryEstimate
+from jobs.models import Task
 
 SKIP_ONE_CACHE = False
 try:
     import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
     from misc.management.commands import one_cache
 except ImportError as ex:
     print(f'Failed to import one_cache: {ex}')
@@ -192,7 +204,9 @@ class ONECache(TestCase):
             tables=('sessions', 'datasets')
         )
         self.assertCountEqual(
-            ['date_created', 'origin', 'min_api_version'], self.command.metadata)
+            ['date_created', 'origin', 'min_api_version', 'cache_version', 'database_timestamp'],
+            self.command.metadata)
+        self.assertEqual(1, self.command.metadata['cache_version'])
         tables = sorted(self.tmp.glob('*.pqt'))
         self.assertEqual(len(tables), 2)
         datasets, sessions = pd.read_parquet(tables[0]), pd.read_parquet(tables[1])
@@ -209,6 +223,395 @@ class ONECache(TestCase):
         self.assertTrue(cache_info.exists())
         zip = zipfile.ZipFile(zip_file)
         self.assertCountEqual(['sessions.pqt', 'cache_info.json', 'QC.json'], zip.namelist())
+        # Check table info is taken from the written files
+        self.command.handle(
+            destination=str(self.tmp), compress=True, verbosity=1, tables=('datasets',))
+        zip = zipfile.ZipFile(zip_file)
+        self.assertIsNone(zip.testzip())
+        with open(cache_info) as fp:
+            info = json.load(fp)
+        self.assertEqual(10, info['tables']['datasets']['nrecs'])
+        self.assertEqual(zip.getinfo('datasets.pqt').file_size, info['tables']['datasets']['size'])
+        self.assertEqual(3, info['cache_version'])
+        self.assertEqual(['cache.zip', 'cache_info.json', 'datasets.pqt', 'sessions.pqt'],
+                         sorted(x.name for x in self.tmp.iterdir()))
+
+    def test_write_batches(self):
+        """Test streaming the datasets table to parquet in batches."""
+        filename = str(self.tmp / 'datasets.pqt')
+        ds = one_cache.datasets_queryset()
+        batches = one_cache.iter_dataset_batches(ds, batch_size=3)
+        meta = one_cache.write_batches(
+            filename, batches, one_cache.DATASETS_SCHEMA, metadata={'foo': 'bar'})
+        self.assertEqual(10, meta['nrecs'])
+        self.assertEqual(4, meta['row_groups'])  # One row group per batch
+        self.assertEqual(Path(filename).stat().st_size, meta['size'])
+        datasets = pd.read_parquet(filename)
+        self.assertTrue(datasets.index.is_monotonic_increasing)
+        self.assertEqual(['eid', 'id'], datasets.index.names)
+        self.assertEqual(one_cache.QC_TYPE, datasets['qc'].dtype)
+        self.assertTrue(all(datasets['qc'] == 'PASS'))
+        self.assertEqual('UInt64', datasets['file_size'].dtype)
+        self.assertEqual(2, datasets['file_size'].isna().sum())
+        pd.testing.assert_frame_equal(one_cache.dataset_queryset_to_dataframe(ds), datasets)
+        table = pq.read_table(filename)
+        self.assertEqual({'foo': 'bar'}, one_cache.schema_metadata(table.schema))
+
+    def test_copy_backend(self):
+        """Test fetching the tables through PostgreSQL COPY."""
+        # Datasets with a revision and no collection
+        dataset = Dataset.objects.first()
+        dataset.revision = Revision.objects.create(name='2020-01-01')
+        dataset.save()
+        Dataset.objects.filter(pk=Dataset.objects.last().pk).update(collection='')
+        session = Session.objects.get(number=2)
+        session.projects.add(*(Project.objects.create(name=x) for x in ('foo', 'bar')))
+        for backend in ('copy', 'orm'):
+            with self.subTest(backend=backend):
+                datasets = one_cache.generate_datasets_frame(backend=backend, batch_size=3)
+                sessions = one_cache.generate_sessions_frame(backend=backend)
+                if backend == 'copy':
+                    expected_datasets, expected_sessions = datasets, sessions
+                    continue
+                pd.testing.assert_frame_equal(expected_datasets, datasets)
+                pd.testing.assert_frame_equal(expected_sessions, sessions)
+        rel_path = f'alf/#2020-01-01#/{dataset.name}'
+        self.assertIn(rel_path, expected_datasets['rel_path'].values)
+        self.assertEqual(1, (~expected_datasets['rel_path'].str.startswith('alf/')).sum())
+        self.assertEqual('bar,foo', expected_sessions.loc[str(session.pk), 'projects'])
+        # Check batch sizes and partition columns
+        ds = one_cache.datasets_queryset()
+        batches = list(one_cache.copy_dataset_batches(ds, batch_size=4, partitioned=True))
+        self.assertEqual([4, 4, 2], [len(x) for x in batches])
+        self.assertEqual(one_cache.DATASETS_PARTITIONED_SCHEMA, batches[0].schema)
+        expected = list(one_cache.iter_dataset_batches(ds, batch_size=4, partitioned=True))
+        self.assertTrue(pa.Table.from_batches(expected).equals(pa.Table.from_batches(batches)))
+        # Check command option
+        self.command.handle(destination=str(self.tmp), verbosity=1, backend='copy',
+                            tables=('sessions', 'datasets'))
+        pd.testing.assert_frame_equal(
+            expected_datasets, pd.read_parquet(self.tmp / 'datasets.pqt'))
+        with self.assertRaises(ValueError):
+            one_cache.dataset_batches('foo')
+        # Check benchmark of both backends on generated datasets, which are rolled back
+        stdout, output = io.StringIO(), self.tmp / 'benchmark.json'
+        call_command('benchmark_one_cache', synthetic=[500], datasets_per_session=20,
+                     output=str(output), stdout=stdout)
+        self.assertIn('generate_datasets_frame (copy)', stdout.getvalue())
+        with open(output) as fp:
+            run = json.load(fp)['runs'][0]
+        self.assertEqual(500, run['generated']['datasets'])
+        steps = {(x['step'], x['backend']): x for x in run['steps']}
+        self.assertEqual(steps[('generate_datasets_frame', 'orm')]['rows'],
+                         steps[('generate_datasets_frame', 'copy')]['rows'])
+        self.assertGreater(steps[('generate_datasets_frame', 'copy')]['rows'], 10)
+        self.assertEqual(5 + 25, steps[('_save_qc', None)]['rows'])  # QC of all sessions
+        self.assertIn('peak_memory_mb', steps[('_compress_tables', None)])
+        self.assertEqual(10, Dataset.objects.count())
+
+    def test_synthetic_db(self):
+        """Test generating a synthetic archive with COPY."""
+        stdout = io.StringIO()
+        call_command('synthetic_db', datasets=2000, datasets_per_session=50, labs=3, tags=4,
+                     stdout=stdout)
+        self.assertIn('generated in', stdout.getvalue())
+        datasets = Dataset.objects.filter(name__startswith='synthetic')
+        self.assertEqual(2000, datasets.count())
+        self.assertEqual(40, Session.objects.filter(lab__name__startswith='synthetic').count())
+        # All datasets have a FlatIron file record and most exist
+        records = FileRecord.objects.filter(data_repository__name__startswith='flatiron_')
+        self.assertEqual(2000, records.count())
+        self.assertGreater(records.filter(exists=True).count(), 1800)
+        # Datasets that exist on FlatIron or AWS are in the cache
+        on_server = datasets.filter(file_records__exists=True,
+                                    file_records__data_repository__globus_is_personal=False)
+        self.assertEqual(10 + on_server.distinct().count(),
+                         len(one_cache.generate_datasets_frame()))
+        # The first tags have the most datasets
+        counts = [Dataset.objects.filter(tags=tag).count()
+                  for tag in Tag.objects.filter(name__startswith='synthetic').order_by('name')]
+        self.assertEqual(4, len(counts))
+        self.assertGreater(counts[0], counts[-1])
+
+    def test_vectorized_columns(self):
+        """Test the vectorized conversion of UUIDs, relative paths and partition keys."""
+        uuids = [uuid.uuid4() for _ in range(3)]
+        self.assertEqual(list(map(str, uuids)), one_cache.uuid_strings(uuids).to_pylist())
+        binary = pa.array([x.bytes for x in uuids], type=pa.binary(16))
+        self.assertEqual([str(uuids[2])], one_cache.uuid_strings(binary.slice(2)).to_pylist())
+        self.assertEqual([], one_cache.uuid_strings([]).to_pylist())
+        rel_path = one_cache.relative_paths(
+            ['alf', '', 'raw_ephys_data/probe00', ''],
+            [None, '2020-01-01', '', None],
+            ['foo.bar.npy', 'bar.baz.bin', 'baz.qux.npy', 'qux.foo.npy'])
+        expected = ['alf/foo.bar.npy', '#2020-01-01#/bar.baz.bin',
+                    'raw_ephys_data/probe00/baz.qux.npy', 'qux.foo.npy']
+        self.assertEqual(expected, rel_path.to_pylist())
+        columns = [pa.array(['a', 'a', 'b', 'b', None, None]),
+                   pa.array([1, 2, 2, 2, None, None], type=pa.int16())]
+        expected = [(('a', 1), 0, 1), (('a', 2), 1, 1), (('b', 2), 2, 2), ((None, None), 4, 2)]
+        self.assertEqual(expected, one_cache._key_runs(columns))
+
+    def test_save_qc(self):
+        """Test streaming the session and insertion QC to QC.json."""
+        sessions = Session.objects.order_by('pk')
+        sessions.filter(pk=sessions[0].pk).update(extended_qc={'foo': 1})
+        for i, name in enumerate(('probe01', 'probe00', 'probe02')):
+            data = None if i == 2 else {'qc': 'FAIL', 'extended_qc': {'bar': i}}
+            ProbeInsertion.objects.create(session=sessions[0], name=name, json=data)
+        ProbeInsertion.objects.create(session=sessions[1], name='probe00', json={'qc': 'PASS'})
+        self.command.dst_dir = str(self.tmp)
+        n_records, filename = self.command._save_qc()
+        self.assertEqual(5, n_records)
+        with open(filename) as fp:
+            qc = json.load(fp)
+        self.assertEqual([str(s.pk) for s in sessions], [d['eid'] for d in qc])
+        self.assertEqual({'foo': 1}, qc[0]['extended_qc'])
+        self.assertEqual('PASS', qc[0]['qc_outcome'])
+        expected = [{'pid': str(ProbeInsertion.objects.get(name=name, session=sessions[0]).pk),
+                     'probe_name': name, 'qc_outcome': 'FAIL', 'extended_qc': {'bar': i}}
+                    for name, i in (('probe00', 1), ('probe01', 0))]
+        self.assertEqual(expected, qc[0]['probe_insertions'])
+        # Insertions without extended QC are excluded
+        self.assertTrue(all('probe_insertions' not in d for d in qc[1:]))
+        # Records are fetched in batches
+        self.assertEqual(qc, list(one_cache.iter_qc_records(batch_size=2)))
+        # No records
+        self.assertEqual((None, None), self.command._save_qc(qc=iter([])))
+
+    def test_registered_tables(self):
+        """Test generating the additional insertions, subjects and tasks tables."""
+        sessions = Session.objects.order_by('number')
+        pid = ProbeInsertion.objects.create(
+            session=sessions[0], name='probe00', json={'qc': 'FAIL'}).pk
+        ProbeInsertion.objects.create(session=sessions[1], name='probe00')
+        for provenance in (10, 50):
+            TrajectoryEstimate.objects.create(
+                probe_insertion_id=pid, provenance=provenance, x=provenance, depth=4000)
+        trajectory = TrajectoryEstimate.objects.get(provenance=50)
+        for i, acronym in enumerate(('VISp', 'CA1', 'VISp')):
+            region, _ = BrainRegion.objects.get_or_create(
+                acronym=acronym, defaults={'id': 100 + i, 'name': acronym})
+            Channel.objects.create(trajectory_estimate=trajectory, axial=i, lateral=0,
+                                   brain_region=region)
+        Task.objects.create(name='Ephys', session=sessions[0], status=40, version='1.0')
+        Task.objects.create(name='Training', session=sessions[2], status=60)
+        Task.objects.create(name='Unattached', status=60)
+        Subject.objects.create(nickname='no_sessions', lab=Lab.objects.first(), sex='F')
+        tables = ('sessions', 'insertions', 'subjects', 'tasks')
+        self.command.handle(destination=str(self.tmp), compress=True, verbosity=1,
+                            tables=tables)
+        # The tables are included in the zip file and cache info
+        archive = zipfile.ZipFile(self.tmp / 'cache.zip')
+        self.assertCountEqual([f'{x}.pqt' for x in tables] + ['cache_info.json'],
+                              archive.namelist())
+        with open(self.tmp / 'cache_info.json') as fp:
+            info = json.load(fp)['tables']
+        self.assertEqual({'sessions': 5, 'insertions': 2, 'subjects': 2, 'tasks': 2},
+                         {k: v['nrecs'] for k, v in info.items()})
+
+        insertions = one_cache.load_table(str(self.tmp), 'insertions')
+        self.assertEqual(one_cache.INSERTIONS_SCHEMA.remove_metadata(),
+                         insertions.schema.remove_metadata())
+        insertions = insertions.to_pandas()
+        self.assertEqual(['id'], insertions.index.names)
+        self.assertEqual('FAIL', insertions.loc[str(pid), 'qc'])
+        # Summarized by the trajectory of highest provenance
+        self.assertEqual('Histology track', insertions.loc[str(pid), 'provenance'])
+        self.assertEqual(50, insertions.loc[str(pid), 'x'])
+        self.assertEqual('CA1,VISp', insertions.loc[str(pid), 'brain_regions'])
+        other = insertions.drop(str(pid)).iloc[0]
+        self.assertEqual('NOT_SET', other['qc'])
+        self.assertTrue(other[['provenance', 'x', 'brain_regions']].isna().all())
+
+        subjects = one_cache.load_table(str(self.tmp), 'subjects').to_pandas()
+        self.assertEqual(['586', 'no_sessions'], subjects['nickname'].tolist())
+        self.assertEqual('F', subjects['sex'].iloc[1])
+        tasks = one_cache.load_table(str(self.tmp), 'tasks').to_pandas()
+        self.assertEqual({str(sessions[0].pk): 'Errored', str(sessions[2].pk): 'Complete'},
+                         dict(zip(tasks['eid'], tasks['status'])))
+
+        # Tag caches only include the rows of the tagged sessions
+        tag = Tag.objects.create(name='tag')
+        tag.datasets.set(Dataset.objects.filter(session=sessions[0]))
+        self.command.handle(destination=str(self.tmp / 'tag'), compress=False, verbosity=1,
+                            tables=tables[1:], tag=['tag'], partitioned=True)
+        for name, n in (('insertions', 1), ('subjects', 1), ('tasks', 1)):
+            self.assertEqual(n, len(pd.read_parquet(self.tmp / 'tag' / f'{name}.pqt')))
+        # With --all-tags the tables are filtered by session
+        (self.tmp / 'all').mkdir()
+        self.command.dst_dir = str(self.tmp / 'all')
+        self.command.generate_all_tag_tables(('insertions', 'tasks'), workers=1)
+        for name in ('insertions', 'tasks'):
+            table = pd.read_parquet(self.tmp / 'all' / 'tag' / f'{name}.pqt')
+            self.assertEqual([str(sessions[0].pk)], table['eid'].tolist())
+        # The subjects table can't be filtered from the tables of all tags
+        self.assertRaises(ValueError, self.command.generate_all_tag_tables, ('subjects',))
+
+    def test_incremental(self):
+        """Test incremental ONE cache table updates."""
+        # Without previous tables, all tables are generated
+        kwargs = {'destination': str(self.tmp), 'compress': False, 'verbosity': 1,
+                  'incremental': True, 'tables': ('sessions', 'datasets')}
+        self.command.handle(**kwargs)
+        self.assertEqual(1, self.command.metadata['cache_version'])
+        # Modify, add and delete some sessions and datasets
+        dataset = Dataset.objects.filter(name='foo.bar.npy').order_by('session__number').first()
+        dataset.file_size = 2048
+        dataset.save()
+        record = FileRecord.objects.filter(dataset__name='bar.baz.bin').first()
+        record.exists = False
+        record.save()
+        Dataset.objects.filter(name='foo.bar.npy', session__number=2).delete()
+        Session.objects.get(number=3).delete()
+        session = Session.objects.create(subject=Subject.objects.first(), number=6,
+                                         type='Experiment', task_protocol='bar')
+        new = Dataset.objects.create(session=session, name='foo.bar.npy', collection='alf')
+        FileRecord.objects.create(relative_path='586/2020-01-01/006/alf/foo.bar.npy',
+                                  dataset=new, exists=True,
+                                  data_repository=DataRepository.objects.first())
+        # Adding a project or renaming a subject modifies the sessions through triggers
+        project_session = Session.objects.get(number=1)
+        project_session.projects.add(Project.objects.create(name='incremental'))
+        Subject.objects.filter(nickname='586').update(nickname='587')
+        expected_sessions = one_cache.generate_sessions_frame()
+        expected_datasets = one_cache.generate_datasets_frame()
+        with mock.patch.object(one_cache, 'INCREMENTAL_OVERLAP', timedelta(0)), \
+                mock.patch.object(one_cache, 'generate_datasets_frame',
+                                  wraps=one_cache.generate_datasets_frame) as generate:
+            self.command.handle(**kwargs)
+        # Only the modified datasets should have been queried
+        generate.assert_called_once()
+        self.assertIn('modified_since', generate.call_args.kwargs)
+        self.assertEqual(2, self.command.metadata['cache_version'])
+        sessions = pd.read_parquet(self.tmp / 'sessions.pqt')
+        datasets = pd.read_parquet(self.tmp / 'datasets.pqt')
+        pd.testing.assert_frame_equal(expected_sessions, sessions, check_index_type=False)
+        pd.testing.assert_frame_equal(expected_datasets, datasets, check_index_type=False)
+        self.assertEqual(2048, datasets.loc[(slice(None), str(dataset.pk)), 'file_size'].iloc[0])
+        self.assertNotIn(str(record.dataset.pk), datasets.index.get_level_values('id'))
+        self.assertEqual(['incremental', '587'],
+                         sessions.loc[str(project_session.pk), ['projects', 'subject']].tolist())
+        # Incremental updates of tag caches are not supported
+        self.assertRaises(ValueError, self.command.handle, **kwargs, tag=['foo'])
+
+    def test_all_tags(self):
+        """Test generating the tables of all tags."""
+        tag1, tag2 = Tag.objects.create(name='tag1'), Tag.objects.create(name='tag2')
+        for dataset in Dataset.objects.all():
+            dataset.tags.add(tag1 if dataset.name == 'foo.bar.npy' else tag2)
+            if dataset.session.number < 3:
+                dataset.tags.add(tag1 if dataset.name == 'bar.baz.bin' else tag2)
+        stdout = io.StringIO()
+        call_command('one_cache', all_tags=True, workers=1, destination=str(self.tmp),
+                     qc=True, stdout=stdout)
+        self.assertIn('Queried all tags', stdout.getvalue())
+        # Compare with the tables of a single tag
+        for tag, n_datasets in (('tag1', 7), ('tag2', 7)):
+            with self.subTest(tag=tag):
+                self.assertIn(tag, stdout.getvalue())
+                command = one_cache.Command()
+                command.handle(destination=str(self.tmp / 'expected'), tag=[tag],
+                               tables=('sessions', 'datasets'), qc=True, verbosity=1)
+                for name in ('sessions', 'datasets'):
+                    expected = pd.read_parquet(self.tmp / 'expected' / f'{name}.pqt')
+                    table = pq.read_table(self.tmp / tag / f'{name}.pqt')
+                    pd.testing.assert_frame_equal(expected, table.to_pandas())
+                    meta = one_cache.schema_metadata(table.schema)
+                    self.assertEqual([tag], meta['database_tags'])
+                    self.assertEqual(1, meta['cache_version'])
+                self.assertEqual(n_datasets, len(table))
+                with open(self.tmp / tag / 'QC.json') as fp:
+                    self.assertEqual(5, len(json.load(fp)))
+        # Check compression and parallel builds
+        if multiprocessing.current_process().daemon:
+            self.skipTest('daemonic processes cannot start a process pool')
+        call_command('one_cache', all_tags=True, workers=2, destination=str(self.tmp),
+                     compress=True, stdout=stdout)
+        for tag in ('tag1', 'tag2'):
+            self.assertTrue((self.tmp / tag / 'cache.zip').exists())
+            with open(self.tmp / tag / 'cache_info.json') as fp:
+                self.assertEqual(2, json.load(fp)['cache_version'])
+        with self.assertRaises(CommandError):
+            call_command('one_cache', all_tags=True, tag=['tag1'])
+
+    def test_partitioned(self):
+        """Test saving tables partitioned by lab and session year and month."""
+        session = Session.objects.get(number=1)
+        session.start_time = datetime(2020, 1, 1, 12)
+        session.save()
+        call_command('one_cache', partitioned=True, destination=str(self.tmp), qc=True)
+        with open(self.tmp / 'cache_info.json') as fp:
+            info = json.load(fp)
+        lab = Lab.objects.first().name
+        expected = {}
+        for name, n_records in (('sessions', 5), ('datasets', 10)):
+            table_info = info['tables'][name]
+            self.assertEqual(n_records, table_info['nrecs'])
+            self.assertEqual(['lab', 'year', 'month'], table_info['partitioning'])
+            self.assertEqual(2, len(table_info['partitions']))
+            partition = table_info['partitions'][0]
+            self.assertEqual(
+                f'lab={lab}/year=2020/month=1/part-0.parquet', partition['path'])
+            self.assertEqual({'lab': lab, 'year': 2020, 'month': 1}, {
+                k: partition[k] for k in table_info['partitioning']})
+            self.assertEqual(n_records // 5, partition['nrecs'])
+            filename = self.tmp / name / partition['path']
+            self.assertEqual(filename.stat().st_size, partition['size'])
+            # Row groups should be sorted and have statistics
+            metadata = pq.ParquetFile(filename).metadata
+            column = metadata.schema.names.index('eid' if name == 'datasets' else 'id')
+            self.assertTrue(metadata.row_group(0).column(column).statistics.has_min_max)
+            # Read a single partition through the partition keys
+            dataset = ds.dataset(self.tmp / name, partitioning='hive')
+            expected[name] = dataset.to_table().to_pandas().sort_index()
+            partition = dataset.to_table(filter=ds.field('year') == 2020)
+            self.assertEqual(n_records // 5, partition.num_rows)
+            eids = pc.unique(partition['eid' if name == 'datasets' else 'id']).to_pylist()
+            self.assertEqual([str(session.pk)], eids)
+        self.assertTrue((self.tmp / 'QC.json').exists())
+        # Check partitioned tables contain the same data as the unpartitioned tables
+        sessions = one_cache.generate_sessions_frame().assign(lab=lab)
+        datasets = one_cache.generate_datasets_frame()
+        self.assertCountEqual(sessions.index, expected['sessions'].index)
+        self.assertCountEqual(datasets.index, expected['datasets'].index)
+        pd.testing.assert_series_equal(datasets['rel_path'], expected['datasets']['rel_path'])
+        with self.assertRaises(CommandError):
+            call_command('one_cache', partitioned=True, compress=True)
+
+    def test_write_partitioned(self):
+        """Test the previous partitions are replaced only once the new ones are written."""
+        schema = pa.unify_schemas([pa.schema([('n', pa.int64())]), one_cache.PARTITIONING])
+        base_dir = self.tmp / 'table'
+
+        def batches(*keys, fail=False):
+            for n, (lab, year) in enumerate(keys):
+                yield pa.RecordBatch.from_pylist(
+                    [{'n': n, 'lab': lab, 'year': year, 'month': 1}], schema=schema)
+            if fail:
+                raise RuntimeError
+
+        def files():
+            return sorted(str(x.relative_to(base_dir)) for x in base_dir.rglob('*.parquet'))
+
+        one_cache.write_partitioned(str(base_dir), batches(('a', 2020), ('b', 2021)), schema)
+        previous = files()
+        self.assertEqual(2, len(previous))
+        # The previous partitions are kept if writing fails
+        with self.assertRaises(RuntimeError):
+            one_cache.write_partitioned(str(base_dir), batches(('c', 2022), fail=True), schema)
+        self.assertEqual(previous, files())
+        self.assertEqual([base_dir], list(self.tmp.glob('table*')))
+        # The previous partitions are replaced
+        info = one_cache.write_partitioned(
+            str(base_dir), batches(('a', 2020), ('c', 2022)), schema)
+        self.assertEqual([x['path'] for x in info['partitions']], files())
+        self.assertNotIn(previous[1], files())
+        self.assertEqual([base_dir], list(self.tmp.glob('table*')))
+        # Written in place, e.g. on S3, the files of previous partitions are removed afterwards
+        filesystem = pa.fs.LocalFileSystem()
+        one_cache._replace_dir(filesystem, str(base_dir), str(base_dir), keep=files()[:1])
+        self.assertEqual(files()[:1], files())
 
     def test_s3_filesystem(self):
         """Test the _s3_filesystem function"""
@@ -9,6 +9,7 @@ from django.contrib.auth import get_user_model
 
 from alyx.base import BaseTests
 from misc.models import LabMembership, Lab
+from misc import views
 from misc.views import _get_cache_info
 from data.models import Tag
 
@@ -82,6 +83,8 @@ class TestCacheView(BaseTests):
         self.superuser = get_user_model().objects.create_user('test', 'test', 'test')
         self.client.login(username='test', password='test')
         self.tag = Tag.objects.create(name='2022_Q1_paper')
+        views._cache_info_cache.clear()
+        self.addCleanup(views._cache_info_cache.clear)
 
     def test_cache_version_view(self):
         r = self.client.get(reverse('cache-info', args=['TAG_NAME_2021']), follow=True)
@@ -93,6 +96,62 @@ class TestCacheView(BaseTests):
             r = self.client.get(reverse('cache-info'), follow=True)
             self.assertEqual(200, r.status_code)
             self.assertEqual(r.json(), cache_info)
+            # Check the cache info is cached and the validators
+            self.assertIn('ETag', r.headers)
+            self.assertEqual('Wed, 10 Aug 2022 13:33:00 GMT', r.headers['Last-Modified'])
+            r = self.client.get(reverse('cache-info'), HTTP_IF_NONE_MATCH=r.headers['ETag'])
+            self.assertEqual(304, r.status_code)
+            self.assertEqual(1, req.get.call_count - 1)  # NB: Called once when mocked
+            # Check the cache info is reloaded after CACHE_INFO_TTL seconds
+            req.get().json.return_value = {**cache_info, 'date_created': '2022-08-11 13:33'}
+            with self.settings(CACHE_INFO_TTL=0), mock.patch('misc.views.time') as time_mock:
+                time_mock.monotonic.return_value = 1e12
+                r = self.client.get(reverse('cache-info'), HTTP_IF_NONE_MATCH=r.headers['ETag'])
+            self.assertEqual(200, r.status_code)
+            self.assertEqual('2022-08-11 13:33', r.json()['date_created'])
+
+    def test_cache_download_view(self):
+        with tempfile.TemporaryDirectory() as URI, mock.patch('misc.views.TABLES_ROOT', URI):
+            r = self.client.get(reverse('cache-download'))
+            self.assertEqual(404, r.status_code)
+            content = bytes(range(256)) * 4
+            Path(URI, 'cache.zip').write_bytes(content)
+            r = self.client.get(reverse('cache-download'))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(content, b''.join(r.streaming_content))
+            self.assertEqual('bytes', r.headers['Accept-Ranges'])
+            etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+            # Conditional requests
+            r = self.client.get(reverse('cache-download'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(304, r.status_code)
+            self.assertEqual(etag, r.headers['ETag'])
+            r = self.client.get(reverse('cache-download'), HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(304, r.status_code)
+            # Range requests
+            for header, expected in (('bytes=0-9', (0, 9)), ('bytes=1000-', (1000, 1023)),
+                                     ('bytes=-24', (1000, 1023)), ('bytes=1020-2000', (1020, 1023))):
+                with self.subTest(range=header):
+                    r = self.client.get(reverse('cache-download'), HTTP_RANGE=header)
+                    self.assertEqual(206, r.status_code)
+                    first, last = expected
+                    self.assertEqual(f'bytes {first}-{last}/1024', r.headers['Content-Range'])
+                    self.assertEqual(content[first:last + 1], b''.join(r.streaming_content))
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=2000-')
+            self.assertEqual(416, r.status_code)
+            self.assertEqual('bytes */1024', r.headers['Content-Range'])
+            # Multiple ranges are not supported: the full file is returned
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=0-1,5-6')
+            self.assertEqual(200, r.status_code)
+            # If-Range: the range is only returned if the file is unchanged
+            r = self.client.get(
+                reverse('cache-download'), HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+            self.assertEqual(206, r.status_code)
+            r = self.client.get(
+                reverse('cache-download'), HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"foo"')
+            self.assertEqual(200, r.status_code)
+            r = self.client.get(
+                reverse('cache-download'), HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=last_modified)
+            self.assertEqual(206, r.status_code)
 
     def test_get_cache_info(self):
         # First test with local file path
@@ -1,14 +1,23 @@
+from datetime import datetime
 from pathlib import Path
+import os
 import os.path as op
+import hashlib
 import json
+import re
+import time
 
 import urllib.parse
 import requests
 from one.remote.aws import get_s3_virtual_host
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.http import (
-    HttpResponse, FileResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotFound
+    HttpResponse, FileResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotFound,
+    StreamingHttpResponse
 )
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
 from rest_framework import views
 from rest_framework.response import Response
@@ -17,7 +26,8 @@ from rest_framework.reverse import reverse
 from rest_framework import generics
 
 from alyx.base import BaseFilterSet, rest_permission_classes
-from data.models import Tag
+from alyx.response_cache import CachedResponseMixin
+from data.models import DataRepository, Tag
 from .serializers import UserSerializer, LabSerializer, NoteSerializer
 from .models import Lab, Note
 from alyx.settings import TABLES_ROOT, MEDIA_ROOT
@@ -108,7 +118,8 @@ class LabFilter(BaseFilterSet):
         exclude = ['json']
 
 
-class LabList(generics.ListCreateAPIView):
+class LabList(CachedResponseMixin, generics.ListCreateAPIView):
+    cache_models = (Lab, DataRepository)
     queryset = Lab.objects.all()
     serializer_class = LabSerializer
     permission_classes = rest_permission_classes()
@@ -208,23 +219,146 @@ def _get_cache_info(tag=None):
     return cache_info
 
 
+# Cache info by tag name, as a tuple of the time loaded and the cache info dict
+_cache_info_cache = {}
+
+
+def get_cache_info(tag=None):
+    """
+    Return the cache info of a tag, as loaded by _get_cache_info.
+
+    The cache info is kept in memory and reloaded at most every CACHE_INFO_TTL seconds, so that
+    the many clients polling for cache updates don't each read the file from the table store.
+
+    :param: optional tag name for fetching a specific cache
+    :return: dict of cache table information
+    """
+    ttl = getattr(settings, 'CACHE_INFO_TTL', 60)
+    loaded, cache_info = _cache_info_cache.get(tag, (None, None))
+    if loaded is None or time.monotonic() - loaded > ttl:
+        cache_info = _get_cache_info(tag)
+        _cache_info_cache[tag] = (time.monotonic(), cache_info)
+    return cache_info
+
+
+def _cache_info_validators(cache_info):
+    """Return the ETag and last modified timestamp (or None) of a cache info dict."""
+    digest = hashlib.md5(json.dumps(cache_info, sort_keys=True).encode()).hexdigest()
+    try:
+        last_modified = datetime.fromisoformat(cache_info['date_created']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        last_modified = None
+    return quote_etag(digest), last_modified
+
+
+def _set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 class CacheVersionView(views.APIView):
+    """
+    Return the cache info of the ONE cache tables, optionally of a given dataset tag.
+
+    The response has an ETag and Last-Modified header; requests with a matching If-None-Match
+    or If-Modified-Since header return 304 Not Modified.
+    """
     permission_classes = rest_permission_classes()
 
     def get(self, request=None, tag=None, **kwargs):
         try:
-            return JsonResponse(_get_cache_info(tag))
+            cache_info = get_cache_info(tag)
         except Tag.DoesNotExist as ex:
             return HttpResponseNotFound(str(ex))
+        etag, last_modified = _cache_info_validators(cache_info)
+        response = _set_validators(JsonResponse(cache_info), etag, last_modified)
+        return get_conditional_response(request, etag, last_modified, response)
+
+
+def _parse_range(header, size):
+    """
+    Parse a single HTTP byte range.
+
+    :param header: The Range header value, e.g. 'bytes=0-499', 'bytes=500-' or 'bytes=-500'
+    :param size: The size of the file in bytes
+    :return: A tuple of the first and last byte positions, None if the header is not a single
+     byte range, or an empty tuple if the range is not satisfiable
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':  # The last n bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last) if last else size - 1, size - 1)
+    if first > last or first >= size:
+        return ()
+    return first, last
+
+
+def _iter_file_range(filename, first, last, chunk_size=FileResponse.block_size):
+    """Yield the bytes of a file from position first to last inclusive."""
+    with open(filename, 'br') as file:
+        file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0 and (chunk := file.read(min(chunk_size, remaining))):
+            remaining -= len(chunk)
+            yield chunk
 
 
 class CacheDownloadView(views.APIView):
+    """
+    Download the ONE cache tables zip file.
+
+    The response has an ETag and Last-Modified header, derived from the file's size and
+    modification time, and supports conditional requests and single HTTP byte ranges
+    (optionally with If-Range) for resuming downloads.
+    """
     permission_classes = rest_permission_classes()
 
     def get(self, request=None, **kwargs):
         if TABLES_ROOT.startswith('http'):
-            response = HttpResponseRedirect(TABLES_ROOT.strip('/') + '/cache.zip')
+            return HttpResponseRedirect(TABLES_ROOT.strip('/') + '/cache.zip')
+        cache_file = Path(TABLES_ROOT).joinpath('cache.zip')
+        try:
+            stat = os.stat(cache_file)
+        except FileNotFoundError:
+            return HttpResponseNotFound('cache.zip not found')
+        etag = quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+        last_modified = int(stat.st_mtime)
+        if (response := get_conditional_response(request, etag, last_modified)) is not None:
+            return _set_validators(response, etag, last_modified)
+
+        size = stat.st_size
+        byte_range = None
+        if (header := request.META.get('HTTP_RANGE')) and self._if_range_passes(
+                request, etag, last_modified):
+            byte_range = _parse_range(header, size)
+        if byte_range == ():
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif byte_range:
+            first, last = byte_range
+            response = StreamingHttpResponse(
+                _iter_file_range(cache_file, first, last),
+                status=206, content_type='application/zip')
+            response['Content-Range'] = f'bytes {first}-{last}/{size}'
+            response['Content-Length'] = str(last - first + 1)
         else:
-            cache_file = Path(TABLES_ROOT).joinpath('cache.zip')
-            response = FileResponse(open(cache_file, 'br'))
-        return response
+            response = FileResponse(open(cache_file, 'br'), content_type='application/zip')
+        response['Accept-Ranges'] = 'bytes'
+        return _set_validators(response, etag, last_modified)
+
+    @staticmethod
+    def _if_range_passes(request, etag, last_modified):
+        """Return True if there is no If-Range header or it matches the current file."""
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            return parse_etags(if_range) == [etag]  # NB: Weak validators never match
+        return parse_http_date_safe(if_range) == last_modified
@@ -892,10 +892,10 @@ class ZygosityFinder(object):
             self._create_zygosity(subject, allele, z, force=force)
 
 
-@receiver(post_delete)
+@receiver(post_delete, sender='subjects.ZygosityRule')
 def delete_zygosity_rule(sender, instance, **kwargs):
-    if isinstance(instance, ZygosityRule):
-        _update_zygosities(instance.line, instance.sequence0)
+    # NB: A receiver of all models would stop Django from deleting any cascaded rows in bulk
+    _update_zygosities(instance.line, instance.sequence0)
 
 
 class AlleleManager(models.Manager):
@@ -5,6 +5,7 @@ from actions.serializers import (WeighingDetailSerializer,
                                  WaterAdministrationDetailSerializer,
                                  )
 from django.contrib.auth import get_user_model
+from alyx.base import SparseFieldsetMixin
 from misc.models import Lab
 
 SUBJECT_LIST_SERIALIZER_FIELDS = ('nickname', 'url', 'id', 'responsible_user', 'birth_date',
@@ -78,7 +79,7 @@ class ZygosityListSerializer(serializers.ModelSerializer):
         fields = ('allele', 'zygosity')
 
 
-class SubjectListSerializer(_WaterRestrictionBaseSerializer):
+class SubjectListSerializer(SparseFieldsetMixin, _WaterRestrictionBaseSerializer):
     genotype = serializers.ListField(
         source='zygosity_strings',
         required=False)
@@ -145,13 +146,20 @@ class SubjectListSerializer(_WaterRestrictionBaseSerializer):
         many=False,
         required=True,)
 
-    @staticmethod
-    def setup_eager_loading(queryset):
-        """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related(
-            'responsible_user', 'species', 'strain', 'line', 'litter')
-        queryset = queryset.prefetch_related('zygosity_set', 'zygosity_set__allele')
-        return queryset
+    field_loading = {
+        'responsible_user': {'select_related': ('responsible_user',)},
+        'species': {'select_related': ('species',)},
+        'strain': {'select_related': ('strain',)},
+        'line': {'select_related': ('line',)},
+        'litter': {'select_related': ('litter',)},
+        'source': {'select_related': ('source',)},
+        'lab': {'select_related': ('lab',)},
+        'projects': {'prefetch_related': ('projects',)},
+        'genotype': {'select_related': ('line',),
+                     'prefetch_related': ('zygosity_set', 'zygosity_set__allele', 'line__alleles')},
+        'description': {'columns': ('description',)},
+        'json': {'columns': ('json',)},
+    }
 
     class Meta:
         model = Subject
@@ -20,6 +20,15 @@ class APISubjectsTests(BaseTests):
         self.assertTrue({'nickname', 'id', 'responsible_user', 'death_date',
                          'line', 'litter', 'sex', 'genotype', 'url'} <= set(d[0]))
 
+    def test_list_subjects_fields(self):
+        url = reverse('subject-list')
+        # The relations of the requested fields are loaded in a constant number of queries
+        for fields, n_queries in (('nickname,lab', 4), ('nickname,source,projects,genotype', 8)):
+            with self.assertNumQueries(n_queries):
+                d = self.ar(self.client.get(url, data={'limit': 300, 'fields': fields}))
+            self.assertTrue(len(d) > 200)
+            self.assertEqual(set(fields.split(',')), set(d[0]))
+
     def test_list_alive_subjects(self):
         url = reverse('subject-list') + '?alive=True&stock=True&limit=300'
         d = self.ar(self.client.get(url))
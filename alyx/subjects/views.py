@@ -4,6 +4,7 @@ import django_filters
 from django.utils import timezone
 
 from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.response_cache import CachedResponseMixin
 from .models import Subject, Project
 from .serializers import (SubjectListSerializer,
                           SubjectDetailSerializer,
@@ -53,12 +54,19 @@ class SubjectFilter(BaseFilterSet):
 
 
 class SubjectList(generics.ListCreateAPIView):
+    """
+    get: **FIELDS**: `/subjects?fields=nickname,lab` returns only these fields and
+    `/subjects?omit=expected_water,remaining_water` all fields but these
+    """
     queryset = Subject.objects.all()
-    queryset = SubjectListSerializer.setup_eager_loading(queryset)
     serializer_class = SubjectListSerializer
     permission_classes = rest_permission_classes()
     filterset_class = SubjectFilter
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return self.serializer_class.setup_eager_loading(queryset, self.request)
+
 
 class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = Subject.objects.all()
@@ -67,7 +75,7 @@ class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'nickname'
 
 
-class ProjectList(generics.ListCreateAPIView):
+class ProjectList(CachedResponseMixin, generics.ListCreateAPIView):
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
     permission_classes = rest_permission_classes()
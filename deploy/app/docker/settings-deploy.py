@@ -206,6 +206,17 @@ REST_FRAMEWORK = {
         'docs': os.getenv('THROTTLE_DOCS_RATE', '20/minute'),
     },
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
+    'DEFAULT_RENDERER_CLASSES': [
+        'alyx.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'alyx.renderers.ArrowStreamRenderer',
+        'alyx.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'alyx.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'STRICT_JSON': False,
     'DEFAULT_PAGINATION_CLASS': 'alyx.base.LimitedLimitOffsetPagination',
     'EXCEPTION_HANDLER': 'alyx.base.rest_filters_exception_handler',
@@ -228,6 +239,35 @@ UPLOADED_IMAGE_WIDTH = 800
 # The location for saving and/or serving the cache tables.
 # May be a local path, http address or s3 uri (i.e. s3://)
 TABLES_ROOT = os.getenv('DJANGO_TABLES_ROOT') or str(BASE_DIR.joinpath('tables'))
+# Seconds for which the cache_info.json of the ONE cache tables is kept in memory
+CACHE_INFO_TTL = int(os.getenv('DJANGO_CACHE_INFO_TTL', '60'))
+
+# Seconds for which the data format, data repository and dataset type tables are cached during
+# registration
+REGISTRATION_CACHE_TTL = int(os.getenv('DJANGO_REGISTRATION_CACHE_TTL', '60'))
+
+# Admin changelists, and REST lists requested with ?count=estimate, whose estimated number of rows
+# reaches this threshold report the PostgreSQL planner's estimate instead of an exact count;
+# 0 always counts exactly
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv('DJANGO_COUNT_ESTIMATE_THRESHOLD', '100000'))
+
+# The local memory cache is per process: with several processes (e.g. gunicorn workers), a change
+# only invalidates the cached responses of the process that made it.  Deployments with several
+# processes should use a shared backend, e.g. DJANGO_CACHE_BACKEND=
+# django.core.cache.backends.redis.RedisCache and DJANGO_CACHE_LOCATION=redis://redis:6379
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('DJANGO_CACHE_BACKEND',
+                             'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+# Seconds for which the rendered responses of the reference table lists (e.g. /dataset-types) are
+# cached; they are invalidated when the tables change.  With the local memory cache, this is how
+# long the other processes may return stale lists, hence the default of a few seconds; with a
+# shared backend, an hour.  0 disables the cache
+_SHARED_CACHE = not CACHES['default']['BACKEND'].endswith('LocMemCache')
+RESPONSE_CACHE_TTL = int(os.getenv('DJANGO_RESPONSE_CACHE_TTL', '3600' if _SHARED_CACHE else '5'))
 
 # storage configurations
 STORAGES = {